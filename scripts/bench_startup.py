@@ -0,0 +1,99 @@
+#############################################################################
+# A script to benchmark the startup time of phyloacc_interface.py and
+# phyloacc_post.py for the invocations that exit early and are often called
+# from other scripts. Each command is run several times and the median wall
+# time is reported, along with any of the heavy libraries (matplotlib, Bio,
+# numpy) it imported, found with python -X importtime.
+#
+# Usage: python scripts/bench_startup.py [runs] [max median seconds]
+#
+# Exits with 1 if any command imports a heavy library or, when given, takes
+# longer than the max median seconds.
+#############################################################################
+
+import os
+import sys
+import time
+import tempfile
+import statistics
+import subprocess
+
+#############################################################################
+
+INTERFACE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "interface");
+INTERFACE = os.path.join(INTERFACE_DIR, "phyloacc_interface.py");
+POST = os.path.join(INTERFACE_DIR, "phyloacc_post.py");
+
+HEAVY_MODULES = ["matplotlib", "Bio", "numpy"];
+# Top level packages that should only be imported by the code that needs them
+
+#############################################################################
+
+def importedModules(cmd):
+# Runs a command once with python -X importtime and returns the set of top level packages it imported
+    result = subprocess.run([sys.executable, "-X", "importtime"] + cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True);
+    modules = set();
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or line.count("|") < 2:
+            continue;
+        module = line.split("|")[2].strip();
+        modules.add(module.split(".")[0]);
+    return modules;
+
+#############################################################################
+
+def timeCommand(cmd, runs):
+# Runs a command the given number of times and returns the median wall time in seconds
+    times = [];
+    for run in range(runs):
+        start = time.time();
+        subprocess.run([sys.executable] + cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL);
+        times.append(time.time() - start);
+    return statistics.median(times);
+
+#############################################################################
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5;
+    max_secs = float(sys.argv[2]) if len(sys.argv) > 2 else False;
+
+    tmp_dir = tempfile.mkdtemp(prefix="phyloacc-bench-startup-");
+    mod_file = os.path.join(tmp_dir, "bench.mod");
+    with open(mod_file, "w") as modfile:
+        modfile.write("ALPHABET: A C G T\nORDER: 0\nSUBST_MOD: REV\n");
+        modfile.write("TREE: (((s1:0.1,s2:0.1):0.05,(s3:0.1,s4:0.1):0.05):0.02,s5:0.2);\n");
+    # A minimal mod file for --labeltree, which only reads the tree
+
+    cases = [
+        ("interface --version", [INTERFACE, "--version"]),
+        ("interface --options", [INTERFACE, "--options"]),
+        ("interface -h", [INTERFACE, "-h"]),
+        ("interface --depcheck", [INTERFACE, "--depcheck", "-path", os.path.join(tmp_dir, "PhyloAcc")]),
+        ("interface --labeltree", [INTERFACE, "--labeltree", "-m", mod_file]),
+        ("post --version", [POST, "--version"]),
+        ("post -h", [POST, "-h"]),
+    ];
+    # --depcheck is pointed at a missing binary so it always runs the same checks and exits
+
+    baseline = timeCommand(["-c", "pass"], runs);
+
+    print("\t".join(["command", "median (s)", "over python (s)", "heavy imports"]));
+    print("\t".join(["python -c pass", str(round(baseline, 3)), "0", "NA"]));
+
+    failed = False;
+    for name, cmd in cases:
+        median = timeCommand(cmd, runs);
+        heavy = sorted(importedModules(cmd) & set(HEAVY_MODULES));
+        print("\t".join([name, str(round(median, 3)), str(round(median - baseline, 3)), ",".join(heavy) if heavy else "none"]));
+
+        if heavy or (max_secs and median > max_secs):
+            failed = True;
+    ## End command loop
+
+    for filename in os.listdir(tmp_dir):
+        os.remove(os.path.join(tmp_dir, filename));
+    os.rmdir(tmp_dir);
+
+    sys.exit(1 if failed else 0);
+
+#############################################################################
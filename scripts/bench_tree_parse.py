@@ -0,0 +1,280 @@
+#############################################################################
+# A script to benchmark the single pass Newick parser in phyloacc_lib/tree.py
+# against the regex-driven parser it replaced. Random trees are generated,
+# parsed with both, and the outputs are checked to be the same.
+#
+# Usage: python scripts/bench_tree_parse.py [max tips] [num trees]
+#############################################################################
+
+import os
+import re
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "interface"));
+import phyloacc_lib.tree as TREE
+
+#############################################################################
+
+def legacyTreeParse(tree, debug=False):
+# The regex-driven treeParse from phyloacc_lib/tree.py before it was replaced with a single pass parser,
+# kept here only to compare speed and output
+# The treeParse function takes as input a rooted phylogenetic tree with or without branch lengths and labels and returns the tree with nodes
+# labeled in order for a post-order traversal and a dictionary with usable info about the tree in the following format:
+# treeParse node label : [ branch length, ancestral node, node type, node label ]
+#
+# If branch length or node label is not present, they will have "NA" as the value
+# node type can be one of: 'tip', 'internal', 'root'
+# treeParse node label is in the format <N>, with N being a positive integer
+
+    tree = tree.strip();
+    if tree[-1] != ";":
+        tree += ";";
+    # Some string handling to remove any extra lines in the tree string and add the semi-colon if not present
+
+    nodes, bl, supports, ancs = {}, {}, {}, {};
+    # Initialization of all the tracker dicts
+
+    topology = TREE.remBranchLength(tree);
+
+    if debug:
+        print("TOPOLOGY:", topology);
+
+    nodes = {};
+    for n in topology.replace("(","").replace(")","").replace(";","").split(","):
+        nodes[n] = 'tip';
+    # nodes = { n : 'tip' for n in topology.replace("(","").replace(")","").replace(";","").split(",") };
+    # Retrieval of the tip labels
+
+    if debug:
+        print("NODES:", nodes);
+
+    new_tree = "";
+    z = 0;
+    numnodes = 1;
+    while z < (len(tree)-1):
+        new_tree += tree[z];
+        if tree[z] == ")":
+            node_label = "<" + str(numnodes) + ">";
+            new_tree += node_label;
+            nodes[node_label] = 'internal';
+            numnodes += 1;
+        z += 1;
+    nodes[node_label] = 'root';
+    rootnode = node_label;
+    # This labels the original tree as new_tree and stores the nodes and their types in the nodes dict
+
+    if debug:
+        print("NEW TREE:", new_tree);
+        print("TREE:", tree);
+        print("NODES:", nodes);
+        print("ROOTNODE:", rootnode);
+        #sys.exit();
+    topo = "";
+    z = 0;
+    numnodes = 1;
+    while z < (len(topology)-1):
+        topo += topology[z];
+        if topology[z] == ")":
+            node_label = "<" + str(numnodes) + ">";
+            topo += node_label;
+            numnodes += 1;
+        z += 1;
+    # This labels the topology with the same internal labels
+
+    if debug:
+        print("TOPO:", topo);
+        print("----------");
+        print("TOPOLOGY:", topo);
+
+    for node in nodes:
+        if node + node in new_tree:
+            new_tree = new_tree.replace(node + node, node);
+
+    for node in nodes:
+    # One loop through the nodes to retrieve all other info
+        if debug == 1:
+            print("NODE:", node);
+
+        if nodes[node] == 'tip':
+            supports[node] = "NA";
+            if node + ":" in tree:
+                cur_bl = re.findall(node + ":[\d.Ee-]+", new_tree);
+                cur_bl = cur_bl[0].replace(node + ":", "");
+                if debug == 1:
+                    print("FOUND BL:", cur_bl);
+                bl[node] = cur_bl;                
+            else:
+                bl[node] = "NA";
+
+        elif nodes[node] == 'internal':
+            if node + node in new_tree:
+                new_tree = new_tree.replace(node + node, node);
+
+            if node + "(" in new_tree or node + "," in new_tree or node + ")" in new_tree:
+                if debug == 1:
+                    print("NO BL OR LABEL");
+                supports[node] = "NA";
+                bl[node] = "NA";
+
+            elif node + ":" in new_tree:
+                supports[node] = "NA";
+                cur_bl = re.findall(node + ":[\d.Ee-]+", new_tree);
+                cur_bl = cur_bl[0].replace(node + ":", "");
+                if debug == 1:
+                    print("FOUND BL:", cur_bl);
+                bl[node] = cur_bl;                                
+
+            else:
+                cur_bsl = re.findall(node + "[\d\w<>_*+.Ee/-]+:[\d.Ee-]+", new_tree);
+                if cur_bsl:
+                # If the pattern above is found then the node has both support and branch length
+                    cur_bs = cur_bsl[0].replace(node, "");
+                    cur_bs = cur_bs[:cur_bs.index(":")];
+                    cur_bl = cur_bsl[0].replace(node, "").replace(cur_bs, "").replace(":", "");
+                    if debug == 1:
+                        print("FOUND BL AND LABEL:", cur_bl, cur_bs);
+                    supports[node] = cur_bs;
+                    bl[node] = cur_bl;
+                    #new_tree = new_tree.replace(cur_bs, "");
+                else:
+                # If it is not found then the branch only has a label
+                    cur_bs = re.findall(node + "[\w*+.<> -]+", new_tree);
+                    cur_bs = cur_bs[0].replace(node, "");
+                    if debug == 1:
+                        print("FOUND LABEL:", cur_bs);
+                    supports[node] = cur_bs;
+                    bl[node] = "NA";
+                    #new_tree = new_tree.replace(cur_bs, "");
+
+        elif nodes[node] == 'root':
+            bl[node] = "NA";
+            supports[node] = new_tree[new_tree.index(node)+len(node):];
+            ancs[node] = "NA";
+            continue;
+
+        # Next we get the ancestral nodes. If the node is the root this is set to NA.
+        anc_match = re.findall('[(),]' + node, new_tree);
+
+        #if nodes[node] == 'internal':
+        #    sys.exit();
+        # anc_match = re.findall(node + '[\d:(),]+', new_tree);
+        anc_match = re.findall(node, topo);
+        if debug:
+            print("ANC MATCH:", anc_match);
+
+        anc_tree = new_tree[new_tree.index(anc_match[0]):][1:];
+        # Ancestral labels are always to the right of the node label in the text of the tree, so we start our scan from the node label
+
+        if debug:
+            print("NODE:", node);
+            print("ANC_MATCH:", anc_match);
+            print("ANC_TREE:", anc_tree);
+            
+        cpar_count = 0;
+        cpar_need = 1;
+
+        for i in range(len(anc_tree)):
+        # We find the ancestral label by finding the ) which matches the nesting of the number of ('s found
+            if anc_tree[i] == "(":
+                cpar_need = cpar_need + 1;
+            if anc_tree[i] == ")" and cpar_need != cpar_count:
+                cpar_count = cpar_count + 1;
+            if anc_tree[i] == ")" and cpar_need == cpar_count:
+                anc_tree = anc_tree[i+1:];
+                ancs[node] = anc_tree[:anc_tree.index(">")+1];
+                break;
+
+        if debug:
+            print("FOUND ANC:", ancs[node]);
+            print("---");
+    nofo = {};
+    for node in nodes:
+        nofo[node] = [bl[node], ancs[node], nodes[node], supports[node]];
+    # Now we just restructure everything to the old format for legacy support
+
+    if debug:
+    # Debugging options to print things out
+        print(("\ntree:\n" + tree + "\n"));
+        print(("new_tree:\n" + new_tree + "\n"));
+        print(("topology:\n" + topo + "\n"));
+        print("nodes:");
+        print(nodes);
+        print()
+        print("bl:");
+        print(bl);
+        print()
+        print("supports:");
+        print(supports);
+        print()
+        print("ancs:");
+        print(ancs);
+        print()
+        print("-----------------------------------");
+        print()
+        print("nofo:");
+        print(nofo);
+        print()
+
+    return nofo, topo, rootnode;
+
+#############################################################################
+
+def randomTree(num_tips, seed):
+# Generates a random rooted binary tree with branch lengths and internal node labels. Tip names are zero-padded
+# so that no name is a prefix of another, which the legacy parser can't handle, and node labels are not numbers
+# so they can't be found within a branch length
+    rng = random.Random(seed);
+    width = len(str(num_tips));
+    nodes = [ "t" + str(i).zfill(width) + ":" + str(round(rng.random(), 6)) for i in range(num_tips) ];
+    while len(nodes) > 1:
+        left = nodes.pop(rng.randrange(len(nodes)));
+        right = nodes.pop(rng.randrange(len(nodes)));
+        nodes.append("(" + left + "," + right + ")n" + str(rng.randint(1, 100)) + ":" + str(round(rng.random(), 6)));
+    return nodes[0] + ";";
+
+#############################################################################
+
+def timeParse(parser, trees, max_secs):
+# Parses every tree and returns the total time, or None if it took longer than max_secs
+    start = time.time();
+    results = [];
+    for tree in trees:
+        results.append(parser(tree));
+        if time.time() - start > max_secs:
+            return None, results;
+    return time.time() - start, results;
+
+#############################################################################
+
+if __name__ == '__main__':
+    max_tips = int(sys.argv[1]) if len(sys.argv) > 1 else 1000;
+    num_trees = int(sys.argv[2]) if len(sys.argv) > 2 else 1000;
+    max_secs = 120;
+
+    cases = [];
+    num_tips = 50;
+    while num_tips <= max_tips:
+        cases.append((num_tips, 1));
+        num_tips *= 2;
+    cases.append((50, num_trees));
+    # Single trees of increasing size and then many small trees, as with gene trees
+
+    print("\t".join(["tips", "trees", "legacy (s)", "single pass (s)", "speedup", "same output"]));
+    for num_tips, cur_num_trees in cases:
+        trees = [ randomTree(num_tips, seed) for seed in range(cur_num_trees) ];
+
+        new_time, new_results = timeParse(TREE.treeParse, trees, max_secs);
+        old_time, old_results = timeParse(legacyTreeParse, trees, max_secs);
+
+        if old_time is None:
+            print("\t".join([str(num_tips), str(cur_num_trees), ">" + str(max_secs), str(round(new_time, 4)), "NA", "NA"]));
+            continue;
+        # The legacy parser is quadratic or worse in the number of nodes, so stop timing it on big trees
+
+        same = new_results == old_results;
+        speedup = round(old_time / new_time, 1) if new_time > 0 else "NA";
+        print("\t".join([str(num_tips), str(cur_num_trees), str(round(old_time, 4)), str(round(new_time, 4)), str(speedup), str(same)]));
+
+#############################################################################
@@ -0,0 +1,84 @@
+#############################################################################
+# A script to check that the block reader for FASTA files in phyloacc_lib/seq.py
+# gives the same sequences for any block size. A fixed FASTA file with wrapped
+# lines, blank lines, a skipped record, a repeated header, and a last header
+# without a newline is read with joinFasta and indexFasta at every small block
+# size, so that block boundaries fall at every position in the file, and each
+# result is compared to a read of the whole file in a single block.
+#
+# Usage: python scripts/check_fasta_blocks.py [max block size]
+#
+# Exits with 1 if any check fails.
+#############################################################################
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "interface"));
+import phyloacc_lib.seq as SEQ
+
+#############################################################################
+
+FASTA = b""">a
+ACGT
+>b
+TTTT
+TT
+
+>skip
+CCCC
+>c
+GGGG
+>a
+AACC
+GGTT
+>d
+""";
+# d has no sequence and is on the last line without a newline
+
+TIPS = {'a', 'b', 'c', 'd'};
+
+#############################################################################
+
+def readIndexed(fasta_file, globs, block_size):
+# Reads the sequences back from the data file and index written by indexFasta
+    data_file, seq_index = SEQ.indexFasta(fasta_file, globs, block_size);
+    with open(data_file, "rb") as datafile:
+        data = datafile.read();
+    return { header : data[offset:offset+seq_len].decode() for header, (offset, seq_len) in seq_index.items() };
+
+#############################################################################
+
+if __name__ == '__main__':
+    max_size = int(sys.argv[1]) if len(sys.argv) > 1 else len(FASTA) + 1;
+
+    tmp_dir = tempfile.mkdtemp(prefix="phyloacc-check-fasta-");
+    fasta_file = os.path.join(tmp_dir, "check.fa");
+    with open(fasta_file, "wb") as fastafile:
+        fastafile.write(FASTA.rstrip(b"\n"));
+    globs = { 'seq-compression' : "none", 'tree-tips' : sorted(TIPS), 'outdir' : tmp_dir };
+
+    expected = SEQ.joinFasta(SEQ.iterFastaStream(io.BytesIO(FASTA.rstrip(b"\n")), TIPS, len(FASTA)));
+    # The sequences read in a single block
+
+    failed = [];
+    def check(name, passed):
+        print(("PASS" if passed else "FAIL") + "\t" + name);
+        if not passed:
+            failed.append(name);
+
+    check("single block: " + str(expected), expected == { 'a' : "AACCGGTT", 'b' : "TTTTTT", 'c' : "GGGG", 'd' : "" });
+
+    bad_join = [ bs for bs in range(1, max_size) if SEQ.joinFasta(SEQ.iterFastaStream(io.BytesIO(FASTA.rstrip(b"\n")), TIPS, bs)) != expected ];
+    check("joinFasta: same sequences at block sizes 1 to " + str(max_size - 1) + (" (wrong at " + str(bad_join) + ")" if bad_join else ""), not bad_join);
+
+    bad_index = [ bs for bs in range(1, max_size) if readIndexed(fasta_file, globs, bs) != expected ];
+    check("indexFasta: same sequences at block sizes 1 to " + str(max_size - 1) + (" (wrong at " + str(bad_index) + ")" if bad_index else ""), not bad_index);
+
+    shutil.rmtree(tmp_dir);
+    sys.exit(1 if failed else 0);
+
+#############################################################################
@@ -0,0 +1,225 @@
+#############################################################################
+# A script to check the SLURM array mode of the interface (--array) against
+# the fake sbatch and sacct in scripts/fake_slurm. A run is set up with the
+# array job template from phyloacc_lib/templates_2.py, a fake PhyloAcc that
+# writes the output file of each batch, and more batches than the max array
+# size. slurm_array.py is then used to submit the batches, check their status,
+# and resubmit the failed ones, and the results are checked at each step.
+#
+# Usage: python scripts/check_slurm_array.py [num st batches] [num gt batches] [max array size]
+#
+# Exits with 1 if any check fails.
+#############################################################################
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import subprocess
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__));
+sys.path.insert(0, os.path.join(SCRIPT_DIR, "..", "src", "interface"));
+import phyloacc_lib.templates_2 as TEMPLATES
+
+ARRAY_SCRIPT = os.path.join(SCRIPT_DIR, "..", "src", "interface", "phyloacc_lib", "slurm_array.py");
+FAKE_SLURM_DIR = os.path.join(SCRIPT_DIR, "fake_slurm");
+
+#############################################################################
+
+FAKE_PHYLOACC = """#!/bin/bash
+# Writes the _elem_lik.txt file of the batch in the cfg file unless the batch is in FAIL_BATCHES
+cfg=$1
+batch=$(basename $cfg | cut -d- -f1)
+outdir=$(grep RESULT_FOLDER $cfg | cut -d' ' -f2)
+case ",$FAIL_BATCHES," in *,$batch,*) exit 1;; esac
+mkdir -p $outdir
+echo "No.	ID	loglik_Null" > $outdir/${batch}_elem_lik.txt
+"""
+
+#############################################################################
+
+def setup(run_dir, num_st, num_gt, max_size):
+# Writes the config files, array job scripts, and array config of a run with num_st st batches followed by num_gt
+# gt batches, numbered from 1 like the interface does
+    cfg_dir, out_dir, smk_dir = [ os.path.join(run_dir, d) for d in ["cfgs", "phyloacc-output", "snakemake"] ];
+    for d in [cfg_dir, out_dir, smk_dir]:
+        os.makedirs(d);
+
+    fake_phyloacc = os.path.join(run_dir, "fake-phyloacc.sh");
+    with open(fake_phyloacc, "w") as fakefile:
+        fakefile.write(FAKE_PHYLOACC);
+    os.chmod(fake_phyloacc, 0o755);
+
+    config = { 'throttle' : 10, 'retry-scale' : 1.5, 'max-array-size' : max_size, 'missing-after' : 3600,
+               'output-dir' : out_dir, 'log-dir' : os.path.join(run_dir, "slurm-logs"), 'arrays' : {} };
+
+    batch_num = 1;
+    for model_type, num_batches in [("st", num_st), ("gt", num_gt)]:
+        batches = [ str(batch) for batch in range(batch_num, batch_num + num_batches) ];
+        batch_num += num_batches;
+
+        for batch in batches:
+            with open(os.path.join(cfg_dir, batch + "-" + model_type + ".cfg"), "w") as cfgfile:
+                cfgfile.write("RESULT_FOLDER " + os.path.join(out_dir, batch + "-phyloacc-" + model_type + "-out") + "\n");
+
+        script = os.path.join(smk_dir, "run_phyloacc_" + model_type + ".sh");
+        with open(script, "w") as scriptfile:
+            scriptfile.write(TEMPLATES.arrayJob().format(model_type=model_type, cmd="check_slurm_array.py", dt="", part="test", num_nodes="1",
+                                                         procs_per_job="1", cluster_logdir=config['log-dir'], outdir=out_dir,
+                                                         indir=cfg_dir, phyloacc_path=fake_phyloacc));
+
+        config['arrays'][model_type] = { 'script' : script, 'batches' : batches, 'mem' : 1000, 'time' : 60 };
+
+    config_file = os.path.join(smk_dir, "array-config.json");
+    with open(config_file, "w") as configfile:
+        json.dump(config, configfile, indent=4);
+
+    return config_file;
+
+#############################################################################
+
+def runArray(command, config_file, slurm_dir, mode="run", fail_batches=""):
+# Runs slurm_array.py with the fake sbatch and sacct first in the PATH. Returns the exit code and output.
+    env = dict(os.environ, PATH=FAKE_SLURM_DIR + os.pathsep + os.environ['PATH'], FAKE_SLURM_DIR=slurm_dir,
+               FAKE_SLURM_MODE=mode, FAIL_BATCHES=fail_batches);
+    result = subprocess.run([sys.executable, ARRAY_SCRIPT, command, "--config", config_file], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True);
+    return result.returncode, result.stdout;
+
+#############################################################################
+
+def statusCounts(output):
+# Gets the number of batches with each status from the output of status: { <model type> : { <status> : <count> } }
+    counts = {};
+    for line in output.splitlines():
+        if line.startswith("# ") and " batches: " in line:
+            model_type, statuses = line[2:].split(" batches: ");
+            counts[model_type] = { status.split()[1] : int(status.split()[0]) for status in statuses.split(", ") };
+    return counts;
+
+#############################################################################
+
+def submitted(slurm_dir, since=0):
+# Gets the submissions logged by the fake sbatch, starting from the given one
+    with open(os.path.join(slurm_dir, "submitted.jsonl")) as subfile:
+        return [ json.loads(line) for line in subfile ][since:];
+
+#############################################################################
+
+if __name__ == '__main__':
+    num_st = int(sys.argv[1]) if len(sys.argv) > 1 else 250;
+    num_gt = int(sys.argv[2]) if len(sys.argv) > 2 else 40;
+    max_size = int(sys.argv[3]) if len(sys.argv) > 3 else 100;
+
+    tmp_dir = tempfile.mkdtemp(prefix="phyloacc-check-array-");
+    run_dir, slurm_dir = os.path.join(tmp_dir, "run"), os.path.join(tmp_dir, "slurm");
+    os.makedirs(slurm_dir);
+    config_file = setup(run_dir, num_st, num_gt, max_size);
+
+    failed = [];
+    def check(name, passed):
+        print(("PASS" if passed else "FAIL") + "\t" + name);
+        if not passed:
+            failed.append(name);
+
+    ####################
+
+    fail_batches = ["2", str(num_st + 1)];
+    code, output = runArray("submit", config_file, slurm_dir, fail_batches=",".join(fail_batches));
+    subs = submitted(slurm_dir);
+    expected_arrays = -(-num_st // max_size) + -(-num_gt // max_size);
+    check("submit: " + str(expected_arrays) + " arrays of at most " + str(max_size) + " tasks", code == 0 and len(subs) == expected_arrays);
+
+    indices_ok = True;
+    for sub in subs:
+        indices = sub['opts']['array'].split("%")[0];
+        num_tasks = len(open(sub['args'][1]).read().split());
+        indices_ok = indices_ok and indices == "0-" + str(num_tasks - 1) and num_tasks <= max_size;
+    check("submit: array indices are 0 to the number of batches in the list - 1", indices_ok);
+
+    code, output = runArray("status", config_file, slurm_dir);
+    counts = statusCounts(output);
+    check("status: only the failing batches failed", code == 1 and counts['st']['failed'] == 1 and counts['gt']['failed'] == 1 and
+          counts['st']['finished'] == num_st - 1 and counts['gt']['finished'] == num_gt - 1);
+
+    ####################
+
+    num_subs = len(subs);
+    code, output = runArray("submit", config_file, slurm_dir);
+    subs = submitted(slurm_dir, num_subs);
+    resubmitted = sorted(batch for sub in subs for batch in open(sub['args'][1]).read().split());
+    check("resubmit: only the failed batches are resubmitted", code == 0 and resubmitted == sorted(fail_batches));
+    check("resubmit: with more memory", all(sub['opts']['mem'] == "1500M" for sub in subs));
+
+    code, output = runArray("status", config_file, slurm_dir);
+    counts = statusCounts(output);
+    check("status: all batches finished", code == 0 and counts['st']['finished'] == num_st and counts['gt']['finished'] == num_gt);
+
+    ####################
+
+    lost_batch = "3";
+    shutil.rmtree(os.path.join(run_dir, "phyloacc-output", lost_batch + "-phyloacc-st-out"));
+    code, output = runArray("status", config_file, slurm_dir);
+    check("status: a completed task without its output failed", code == 1 and statusCounts(output)['st']['failed'] == 1);
+
+    code, output = runArray("submit", config_file, slurm_dir, mode="lost");
+    code, output = runArray("status", config_file, slurm_dir);
+    check("status: a task sacct doesn't list yet is active", code == 1 and statusCounts(output)['st']['active'] == 1);
+
+    with open(config_file) as configfile:
+        config = json.load(configfile);
+    config['missing-after'] = 0;
+    with open(config_file, "w") as configfile:
+        json.dump(config, configfile);
+    code, output = runArray("status", config_file, slurm_dir);
+    check("status: a task sacct never lists fails after missing-after", code == 1 and statusCounts(output)['st']['failed'] == 1);
+
+    code, output = runArray("submit", config_file, slurm_dir);
+    code, output = runArray("status", config_file, slurm_dir);
+    check("resubmit: the lost batch finishes", code == 0);
+
+    ####################
+
+    run_dir, slurm_dir = os.path.join(tmp_dir, "run-pending"), os.path.join(tmp_dir, "slurm-pending");
+    os.makedirs(slurm_dir);
+    config_file = setup(run_dir, 8, 0, max_size);
+    with open(config_file) as configfile:
+        config = json.load(configfile);
+    config['throttle'] = 10;
+    with open(config_file, "w") as configfile:
+        json.dump(config, configfile);
+
+    code, output = runArray("submit", config_file, slurm_dir, mode="pending");
+    subs = submitted(slurm_dir);
+    check("throttle: an array smaller than -j can run all its tasks at once", code == 0 and subs[-1]['opts']['array'].endswith("%10"));
+
+    new_batches = [ str(batch) for batch in range(9, 13) ];
+    for batch in new_batches:
+        with open(os.path.join(run_dir, "cfgs", batch + "-st.cfg"), "w") as cfgfile:
+            cfgfile.write("RESULT_FOLDER " + os.path.join(run_dir, "phyloacc-output", batch + "-phyloacc-st-out") + "\n");
+    config['arrays']['st']['batches'] += new_batches;
+    with open(config_file, "w") as configfile:
+        json.dump(config, configfile);
+    # More batches to submit while the first 8 are still pending
+
+    code, output = runArray("submit", config_file, slurm_dir, mode="pending");
+    subs = submitted(slurm_dir, len(subs));
+    check("throttle: pending tasks from earlier submits count against -j", code == 0 and len(subs) == 1 and subs[0]['opts']['array'].endswith("%2"));
+
+    config['arrays']['st']['batches'].append("13");
+    with open(os.path.join(run_dir, "cfgs", "13-st.cfg"), "w") as cfgfile:
+        cfgfile.write("RESULT_FOLDER " + os.path.join(run_dir, "phyloacc-output", "13-phyloacc-st-out") + "\n");
+    with open(config_file, "w") as configfile:
+        json.dump(config, configfile);
+    num_subs = len(submitted(slurm_dir));
+    code, output = runArray("submit", config_file, slurm_dir, mode="pending");
+    subs = submitted(slurm_dir, num_subs);
+    check("throttle: a new array still runs one task at a time when -j is used up", code == 0 and len(subs) == 1 and subs[0]['opts']['array'].endswith("%1"));
+
+    ####################
+
+    shutil.rmtree(tmp_dir);
+    sys.exit(1 if failed else 0);
+
+#############################################################################
@@ -17,7 +17,8 @@ import phyloacc_lib.seq as SEQ
 import phyloacc_lib.tree as TREE
 import phyloacc_lib.output as OUT
 import phyloacc_lib.batch as BATCH
-import phyloacc_lib.plot as PLOT
+import phyloacc_lib.local as LOCAL
+import phyloacc_lib.profiling as PROFILE
 
 #############################################################################
 
@@ -76,39 +77,76 @@ if __name__ == '__main__':
     step_start_time = PC.report_step(globs, "", "", "", start=True);
     # Initialize the step headers
 
-    globs = SEQ.readSeq(globs);
+    with PROFILE.profileStage(globs, "readSeq"):
+        globs = SEQ.readSeq(globs);
     # Library to read input sequences
 
-    globs = SEQ.alnStats(globs);
-    # Calculate some basic alignment stats
+    if globs['run-mode'] == 'adaptive' and globs['fuse-stats']:
+        with PROFILE.profileStage(globs, "statsSCF"):
+            globs = TREE.statsSCF(globs);
+    # Calculate the alignment stats and avg. sCF per locus in a single pass
+    else:
+        with PROFILE.profileStage(globs, "alnStats"):
+            globs = SEQ.alnStats(globs);
+        # Calculate some basic alignment stats
 
-    if globs['run-mode'] == 'adaptive':
-        globs = TREE.scf(globs);
-    # Calculate avg. sCF per locus
+        if globs['run-mode'] == 'adaptive':
+            with PROFILE.profileStage(globs, "scf"):
+                globs = TREE.scf(globs);
+        # Calculate avg. sCF per locus
 
-    globs = OUT.writeAlnStats(globs);
-    # Write out the alignment summary stats
+    with PROFILE.profileStage(globs, "writeStats"):
+        globs = OUT.writeAlnStats(globs);
+        # Write out the alignment summary stats
 
-    if globs['run-mode'] == 'adaptive':
-        globs = OUT.writeSCFStats(globs);
-    # Write out the sCF summary stats
+        if globs['run-mode'] == 'adaptive':
+            globs = OUT.writeSCFStats(globs);
+        # Write out the sCF summary stats
 
-    globs = BATCH.genJobFiles(globs);
+    with PROFILE.profileStage(globs, "genJobFiles"):
+        globs = BATCH.genJobFiles(globs);
     # Generates the locus specific job files (aln, bed, config, etc.) for phyloacc
 
-    globs = BATCH.writeSnakemake(globs);
-    # Generates the snakemake config and cluster profile
+    with PROFILE.profileStage(globs, "writeJobs"):
+        if globs['array']:
+            globs = BATCH.writeArrayJobs(globs);
+            globs['smk-cmd'] = os.path.abspath(globs['array-script']) + " submit --dryrun";
+            # Generates the SLURM array jobs and the command to submit them with --array
+
+        elif globs['local']:
+            globs = BATCH.writeSnakemake(globs);
+            # Generates the snakemake config, but no cluster profile
+
+            globs['smk-cmd'] = globs['call'];
+            # The batches are run by this command with --local, and running it again runs any that didn't finish
+
+        else:
+            globs = BATCH.writeSnakemake(globs);
+            # Generates the snakemake config and cluster profile
 
-    globs['smk-cmd'] = "snakemake -p -s " + os.path.abspath(globs['smk']);
-    globs['smk-cmd'] += " --configfile " + os.path.abspath(globs['smk-config']);
-    globs['smk-cmd'] += " --profile " + os.path.abspath(globs['profile-dir']);
-    globs['smk-cmd'] += " --cluster-status " + os.path.abspath(globs['status-script']);
-    globs['smk-cmd'] += " --dryrun";
-    # The snakemake command to run PhyloAcc
+            globs['smk-cmd'] = "snakemake -p -s " + os.path.abspath(globs['smk']);
+            globs['smk-cmd'] += " --configfile " + os.path.abspath(globs['smk-config']);
+            globs['smk-cmd'] += " --profile " + os.path.abspath(globs['profile-dir']);
+            globs['smk-cmd'] += " --cluster-status \"" + os.path.abspath(globs['status-script']) + " --interval " + str(globs['status-interval']) + "\"";
+            globs['smk-cmd'] += " --dryrun";
+            # The snakemake command to run PhyloAcc
 
     if globs['plot']:
-        PLOT.genPlots(globs);
-        globs = PLOT.writeHTML(globs);
+        with PROFILE.profileStage(globs, "genPlots"):
+            import phyloacc_lib.plot as PLOT;
+            # The plotting libraries take longer to load than anything else, so they are only loaded with --plot
+
+            PLOT.genPlots(globs);
+            globs = PLOT.writeHTML(globs);
+
+    if globs['local']:
+        with PROFILE.profileStage(globs, "runLocal"):
+            globs = LOCAL.runLocal(globs);
+    # Run the batches on this machine with --local
+
+    if globs['profile']:
+        PROFILE.reportProfiles(globs);
+    # Merge the worker profiles and report the hot functions of each step with --profile
 
     PC.endProg(globs);
 
@@ -4,8 +4,16 @@
 #############################################################################
 
 import os
+import json
+import math
+import stat
+import heapq
+import shutil
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor
 import phyloacc_lib.core as PC
 import phyloacc_lib.tree as TREE
+import phyloacc_lib.runtime as RUNTIME
 import phyloacc_lib.templates_2 as TEMPLATES
 
 #############################################################################
@@ -83,144 +91,225 @@ def genJobFiles(globs):
     step_start_time = PC.report_step(globs, step, False, "In progress...");
     # Status update
 
-    st_alns = { aln : globs['alns'][aln] for aln in globs['alns'] if globs['aln-stats'][aln]['batch-type'] == "st" and aln not in globs['no-inf-sites-loci'] };
-    gt_alns = { aln : globs['alns'][aln] for aln in globs['alns'] if globs['aln-stats'][aln]['batch-type'] == "gt" and aln not in globs['no-inf-sites-loci'] };
+    no_inf_loci = set(globs['no-inf-sites-loci']);
+    st_loci = [ aln for aln in globs['alns'] if globs['aln-stats'][aln]['batch-type'] == "st" and aln not in no_inf_loci ];
+    gt_loci = [ aln for aln in globs['alns'] if globs['aln-stats'][aln]['batch-type'] == "gt" and aln not in no_inf_loci ];
     # Subset alignments based on model type. This is either specified by the user with '-r st' or '-r gt', or is decided
-    # by sCF with '-r adaptive'.
+    # by sCF with '-r adaptive'. Only the locus IDs are kept here, the alignments are read when each batch is written.
 
-    globs['st-loci'] = len(st_alns);
-    globs['gt-loci'] = len(gt_alns);
+    globs['st-loci'] = len(st_loci);
+    globs['gt-loci'] = len(gt_loci);
     # Adjust the counts after removing alignments with no informative sites
 
-    model_num = 0;
+    batches = [];
     batch_num = 0;
-    # Trakers for the model number and batch number
-    # model_num is just the index for the list [st_alns, gt_alns]
+    # The list of batches to write as (batch number, model type, loci in the batch) and the batch counter
 
-    for model_partition in [st_alns, gt_alns]:
+    for model_type, model_loci in [("st", st_loci), ("gt", gt_loci)]:
     # Go over the partitions for both models
 
-        if model_num == 0:
-            model_type = "st";
-        elif model_num == 1:
-            model_type = "gt";
-        model_num += 1;
-        # Decide the model type string based in the model_num
-
-        for batch in PC.dictChunk(model_partition, globs['batch-size']):
-        # Split the sequence dictionary by batches and yield the result here
+        for cur_batch_loci, cur_batch_cost in planBatches(globs, model_loci, model_type):
+        # Split the loci into batches with about the same predicted runtime
 
             batch_num += 1;
             batch_num_str = str(batch_num);
-            if model_type == "st":
-                globs['st-batches'].append(batch_num_str);
-                coal_tree_line = "";
-            elif model_type == "gt":
-                globs['gt-batches'].append(batch_num_str);
-                coal_tree_line = "\nTREE_IN_COALESCENT_UNIT " + globs['coal-tree-file'];
+            globs[model_type + '-batches'].append(batch_num_str);
+            globs['batch-costs'][batch_num_str] = cur_batch_cost;
+            batches.append((batch_num_str, model_type, cur_batch_loci));
             # Batch counting
-
-            cur_out_dir = os.path.join(globs['job-out'], batch_num_str + "-phyloacc-" + model_type + "-out");
-            if not os.path.isdir(cur_out_dir):
-                os.makedirs(cur_out_dir);
-            # Make the phyloacc output directory for the current batch
-
-            batch_concat = { label : "" for label in globs['tree-tips'] };
-            # Dictionary to concatenate alignments for the current batch
-
-            batch_aln_list = [];
-            # As we concatenate, add the alignment name to this list so we can go through
-            # in the same order as we make the bed file
-
-            for aln in batch:
-                #print(aln);
-                batch_aln_list.append(aln);
-                for label in globs['tree-tips']:
-                    batch_concat[label] += batch[aln][label];
-                # May need a check here for missing sequences
-            # Concatenate alignments in the current batch together
-
-            cur_aln_file = os.path.join(globs['job-alns'], batch_num_str + "-" + model_type + ".fa");
-            with open(cur_aln_file, "w") as alnfile:
-                for spec in globs['tree-tips']:
-                    alnfile.write(">" + spec + "\n");
-                    alnfile.write(batch_concat[spec] + "\n");
-            # Write the current concatenated alignment to file
-
-            len_sum = 0;
-            # Keeps track of the last coordinate written in the bed file
-
-            cur_bed_file = os.path.join(globs['job-bed'], batch_num_str + "-" + model_type + ".bed");
-            with open(cur_bed_file, "w") as bedfile:
-                batch_aln_id = 0;
-                ## NOTE: Right phyloacc requires element IDs to be integers starting from 0. I think this should be changed.
-                for aln in batch_aln_list:
-
-                    aln_len = globs['aln-stats'][aln]['length'];
-                    # Get the alignment length for the bed file
-
-                    end_coord = len_sum + aln_len;
-                    # Get the end coordinate of the current locus in the concatenated alignment by
-                    # adding the length to the previous length sum
-
-                    outline = [str(batch_aln_id), str(len_sum), str(end_coord), aln];
-                    bedfile.write("\t".join(outline) + "\n");
-                    # Write the info for the current locus
-
-                    len_sum += aln_len;
-
-                    batch_aln_id += 1;
-                    # Add the length to the length sum as the start coordinate for the next locus
-            # Write a bed file that contains all coordinates for the current alignment
-
-            if globs['id-flag']:
-                cur_id_file = os.path.join(globs['job-ids'], batch_num_str + "-" + model_type + ".id");
-                cur_id_file = os.path.abspath(cur_id_file);
-                with open(cur_id_file, "w") as idfile:
-                    batch_aln_id = 0;
-                    for aln in batch_aln_list:
-                        idfile.write(str(batch_aln_id) + "\n");
-                        batch_aln_id += 1;
-            # Write an ID file
-
-            phyloacc_opt_str = "";
-            if globs['phyloacc-opts']:
-                phyloacc_opt_str = "\n".join(globs['phyloacc-opts']);
-
-            id_line_str = "";
-            if globs['id-flag']:
-                id_line_str = "\nID_FILE " + cur_id_file;
-
-            cur_cfg_file = os.path.join(globs['job-cfgs'], batch_num_str + "-" + model_type + ".cfg");
-            with open(cur_cfg_file, "w") as cfgfile:
-                cfgfile.write(TEMPLATES.phyloaccConfig().format(mod_file=os.path.abspath(globs['mod-file']),
-                                                                        bed_file=os.path.abspath(cur_bed_file),
-                                                                        id_line=id_line_str,
-                                                                        aln_file=os.path.abspath(cur_aln_file),
-                                                                        coal_tree_line=coal_tree_line,
-                                                                        outdir=os.path.abspath(cur_out_dir),
-                                                                        batch=batch_num_str,
-                                                                        burnin=str(globs['burnin']),
-                                                                        mcmc=str(globs['mcmc']),
-                                                                        chain=str(globs['chain']),
-                                                                        targets= ";".join(globs['targets']),
-                                                                        outgroup=";".join(globs['outgroup']),
-                                                                        conserved=";".join(globs['conserved']),
-                                                                        procs_per_job=str(globs['procs-per-job']),
-                                                                        phyloacc_opts=phyloacc_opt_str
-                                                                        ))
-            # Write the phyloacc config file for the current concatenated alignment
         ## End batch loop
     ## End model partition loop
 
-    step_start_time = PC.report_step(globs, step, step_start_time, "Success: " + str(batch_num) + " jobs written");
+    globs['batch-costs-file'] = os.path.join(globs['job-cfgs'], "predicted-batch-costs.tsv");
+    with open(globs['batch-costs-file'], "w") as costfile:
+        costfile.write("\t".join(["batch", "model", "loci", "sites", "informative-sites", "seq-sites", "seq-informative-sites", "predicted-seconds", "predicted-mem-mb"]) + "\n");
+        for batch_num_str, model_type, cur_batch_loci in batches:
+            cur_stats = [ globs['aln-stats'][aln] for aln in cur_batch_loci ];
+            num_sites = sum(stats['length'] for stats in cur_stats);
+            num_inf_sites = sum(stats['informative-sites'] for stats in cur_stats);
+            seq_sites = sum(stats['num-seqs'] * stats['length'] for stats in cur_stats);
+            seq_inf_sites = sum(stats['num-seqs'] * stats['informative-sites'] for stats in cur_stats);
+            # The number of sites and informative sites in the batch, and the same summed over every sequence
+
+            cur_mem = RUNTIME.predictMem(globs, model_type, seq_sites);
+            if cur_mem is not None:
+                globs['batch-mems'][batch_num_str] = cur_mem;
+            # The predicted memory of the batch if a runtime model with memory was given (-runtime-model)
+
+            outline = [batch_num_str, model_type, str(len(cur_batch_loci)), str(num_sites), str(num_inf_sites), str(seq_sites), str(seq_inf_sites),
+                        str(round(globs['batch-costs'][batch_num_str], 1)), str(round(cur_mem, 1)) if cur_mem is not None else "NA"];
+            costfile.write("\t".join(outline) + "\n");
+    # Write the predicted runtime of every batch next to the config files. The numbers of sites are read by
+    # phyloacc_post.py to fit a runtime model for the next run
+
+    with ThreadPoolExecutor(max_workers=globs['num-procs']) as executor:
+        cfg_files = list(executor.map(writeBatch, repeat(globs), batches));
+    # Batches are independent, so they are written concurrently. Batch numbers are assigned above so the files are
+    # the same regardless of the order they finish in, and any error writing a batch is raised here
+
+    step_start_time = PC.report_step(globs, step, step_start_time, "Success: " + str(len(cfg_files)) + " jobs written");
     # Status update
 
+    globs = RUNTIME.setResources(globs);
+    # Set the time and memory for each job from the predicted batches when a runtime model is given
+
+    if globs['batch-costs']:
+        max_cost = max(globs['batch-costs'].values());
+        PC.printWrite(globs['logfilename'], globs['log-v'], "# INFO: Predicted runtime per batch: " + str(round(min(globs['batch-costs'].values()) / 60, 1)) + " to " + str(round(max_cost / 60, 1)) + " minutes. See " + globs['batch-costs-file']);
+
+        if max_cost > RUNTIME.timeSecs(globs['time']):
+            PC.printWrite(globs['logfilename'], globs['log-v'], "# WARNING: The longest batch is predicted to take longer than the time per job (-time " + globs['time'] + "). Consider a longer -time or a shorter -batch-time.");
+    # Report the range of predicted batch runtimes and check them against the time limit for each job
+
     globs['num-batches'] = batch_num;
     # Can only compute this here after we've split the number of input alignments by batch size
 
     return(globs);
 
+#############################################################################
+
+def predictCost(globs, aln, model_type):
+# Predicts the runtime of PhyloAcc on one locus in seconds from its alignment stats. The cost of each MCMC step is a fixed
+# cost for the locus plus a cost per site and per informative site for every sequence, with separate coefficients for
+# the species tree and gene tree models in globs['cost-model'].
+
+    coefs = globs['cost-model'][model_type];
+    cur_stats = globs['aln-stats'][aln];
+
+    step_cost = coefs['locus'] + cur_stats['num-seqs'] * (coefs['site'] * cur_stats['length'] + coefs['informative-site'] * cur_stats['informative-sites']);
+    return step_cost * int(globs['mcmc']) * int(globs['chain']);
+
+#############################################################################
+
+def planBatches(globs, model_loci, model_type):
+# Splits the loci for one model into batches with about the same predicted runtime. The number of batches is set by the
+# target runtime per batch (-batch-time) if given, or otherwise by the number of loci per batch (-batch). Loci are then
+# assigned from most to least costly to the batch with the lowest predicted runtime so far. Returns a list of
+# (<loci in batch>, <predicted runtime of batch>) with loci in their input order.
+
+    if not model_loci:
+        return [];
+
+    costs = [ predictCost(globs, aln, model_type) for aln in model_loci ];
+    # The predicted runtime of every locus
+
+    if globs['batch-time']:
+        num_batches = math.ceil(sum(costs) / (globs['batch-time'] * 60));
+    else:
+        num_batches = math.ceil(len(model_loci) / globs['batch-size']);
+    num_batches = max(1, min(num_batches, len(model_loci)));
+    # The number of batches needed for the current model
+
+    batch_heap = [ (0.0, batch_index) for batch_index in range(num_batches) ];
+    batch_indices = [ [] for batch_index in range(num_batches) ];
+    # A heap of the current predicted runtime of each batch and the loci assigned to each batch
+
+    for locus_index in sorted(range(len(model_loci)), key=lambda i: costs[i], reverse=True):
+        batch_cost, batch_index = heapq.heappop(batch_heap);
+        batch_indices[batch_index].append(locus_index);
+        heapq.heappush(batch_heap, (batch_cost + costs[locus_index], batch_index));
+    # Add each locus to the batch with the lowest predicted runtime, starting with the most costly loci
+
+    batch_indices = sorted(sorted(cur_indices) for cur_indices in batch_indices);
+    # Keep the loci in each batch and the batches themselves in the input order
+
+    return [ ([ model_loci[i] for i in cur_indices ], sum(costs[i] for i in cur_indices)) for cur_indices in batch_indices ];
+
+#############################################################################
+
+def writeBatch(globs, batch_info):
+# Writes the concatenated alignment, bed file, ID file, and PhyloAcc config file for one batch of loci.
+# Each sequence of the concatenated alignment is streamed to the file locus by locus instead of
+# building the concatenated strings in memory.
+
+    batch_num_str, model_type, batch_loci = batch_info;
+
+    if model_type == "st":
+        coal_tree_line = "";
+    elif model_type == "gt":
+        coal_tree_line = "\nTREE_IN_COALESCENT_UNIT " + globs['coal-tree-file'];
+    # The coalescent tree is only needed for the gene tree model
+
+    cur_out_dir = os.path.join(globs['job-out'], batch_num_str + "-phyloacc-" + model_type + "-out");
+    if not os.path.isdir(cur_out_dir):
+        os.makedirs(cur_out_dir);
+    # Make the phyloacc output directory for the current batch
+
+    batch_alns = [ globs['alns'][aln] for aln in batch_loci ];
+    # Read the alignments in the current batch once, in the same order as the bed file
+
+    cur_aln_file = os.path.join(globs['job-alns'], batch_num_str + "-" + model_type + ".fa");
+    with open(cur_aln_file, "w") as alnfile:
+        for spec in globs['tree-tips']:
+            alnfile.write(">" + spec + "\n");
+            alnfile.writelines(aln[spec] for aln in batch_alns);
+            # May need a check here for missing sequences
+            alnfile.write("\n");
+    # Write the current concatenated alignment to file, one locus at a time for each sequence
+
+    del batch_alns;
+    # The alignments aren't needed anymore
+
+    bed_lines = [];
+    len_sum = 0;
+    # The lines of the bed file and the last coordinate written in it
+
+    for batch_aln_id, aln in enumerate(batch_loci):
+    ## NOTE: Right phyloacc requires element IDs to be integers starting from 0. I think this should be changed.
+
+        aln_len = globs['aln-stats'][aln]['length'];
+        end_coord = len_sum + aln_len;
+        # Get the end coordinate of the current locus in the concatenated alignment by
+        # adding the length to the previous length sum
+
+        bed_lines.append("\t".join([str(batch_aln_id), str(len_sum), str(end_coord), aln]) + "\n");
+        # The info for the current locus
+
+        len_sum = end_coord;
+        # The end of the current locus is the start coordinate for the next locus
+
+    cur_bed_file = os.path.join(globs['job-bed'], batch_num_str + "-" + model_type + ".bed");
+    with open(cur_bed_file, "w") as bedfile:
+        bedfile.writelines(bed_lines);
+    # Write a bed file that contains all coordinates for the current alignment
+
+    if globs['id-flag']:
+        cur_id_file = os.path.join(globs['job-ids'], batch_num_str + "-" + model_type + ".id");
+        cur_id_file = os.path.abspath(cur_id_file);
+        with open(cur_id_file, "w") as idfile:
+            idfile.writelines(str(batch_aln_id) + "\n" for batch_aln_id in range(len(batch_loci)));
+    # Write an ID file
+
+    phyloacc_opt_str = "";
+    if globs['phyloacc-opts']:
+        phyloacc_opt_str = "\n".join(globs['phyloacc-opts']);
+
+    id_line_str = "";
+    if globs['id-flag']:
+        id_line_str = "\nID_FILE " + cur_id_file;
+
+    cur_cfg_file = os.path.join(globs['job-cfgs'], batch_num_str + "-" + model_type + ".cfg");
+    with open(cur_cfg_file, "w") as cfgfile:
+        cfgfile.write(TEMPLATES.phyloaccConfig().format(mod_file=os.path.abspath(globs['mod-file']),
+                                                                bed_file=os.path.abspath(cur_bed_file),
+                                                                id_line=id_line_str,
+                                                                aln_file=os.path.abspath(cur_aln_file),
+                                                                coal_tree_line=coal_tree_line,
+                                                                outdir=os.path.abspath(cur_out_dir),
+                                                                batch=batch_num_str,
+                                                                burnin=str(globs['burnin']),
+                                                                mcmc=str(globs['mcmc']),
+                                                                chain=str(globs['chain']),
+                                                                targets= ";".join(globs['targets']),
+                                                                outgroup=";".join(globs['outgroup']),
+                                                                conserved=";".join(globs['conserved']),
+                                                                procs_per_job=str(globs['procs-per-job']),
+                                                                phyloacc_opts=phyloacc_opt_str
+                                                                ))
+    # Write the phyloacc config file for the current concatenated alignment
+
+    return cur_cfg_file;
+
 ############################################################################# 
 
 def writeSnakemake(globs):
@@ -259,18 +348,28 @@ def writeSnakemake(globs):
 
     globs['smk-config'] = os.path.join(globs['job-smk'], "phyloacc-config.yaml");
 
+    batch_resources = RUNTIME.batchResources(globs);
+    resource_lines = [ "  '" + batch + "': {mem: " + str(batch_resources[batch]['mem']) + ", time: " + str(batch_resources[batch]['time']) + "}" for batch in globs['st-batches'] + globs['gt-batches'] ];
+    # The memory (MB) and time (minutes) for each batch from its predicted runtime and memory, as a YAML mapping
+
     with open(globs['smk-config'], "w") as configfile:
         configfile.write(TEMPLATES.snakemakeConfig().format(indir=os.path.abspath(globs['job-cfgs']),
                                                             outdir=os.path.abspath(globs['job-out']),
                                                             st_batches=str(globs['st-batches']),
                                                             gt_batches=str(globs['gt-batches']),
                                                             iqtree=os.path.abspath(globs['iqtree']),
-                                                            astral=os.path.abspath(globs['astral'])
+                                                            astral=os.path.abspath(globs['astral']),
+                                                            retry_scale=str(globs['retry-scale']),
+                                                            batch_resources="\n".join(resource_lines) if resource_lines else "  {}"
                                                             ))
 
     step_start_time = PC.report_step(globs, step, step_start_time, "Success: Snakemake config written");
     # Status update  
 
+    if globs['local']:
+        return globs;
+    # With --local the batches are run on this machine, so the SLURM profile and status script aren't needed
+
     ####################
 
     step = "Writing Snakemake cluster profile";
@@ -295,12 +394,106 @@ def writeSnakemake(globs):
                                                           part=globs['partition'],
                                                           num_nodes=globs['num-nodes'],
                                                           mem=globs['mem'],
-                                                          time=globs['time']
+                                                          time=globs['time'],
+                                                          restart_times=str(globs['job-retries'])
                                                         ))
 
     step_start_time = PC.report_step(globs, step, step_start_time, "Success: Snakemake profile written");
     # Status update     
 
+    ####################
+
+    step = "Writing cluster status script";
+    step_start_time = PC.report_step(globs, step, False, "In progress...");
+    # Status update
+
+    globs['status-script'] = copyScript(globs, globs['status-script']);
+    # Copy the status script into the snakemake directory so the cache of job states it keeps there is specific to this run
+
+    cache_file = os.path.join(globs['job-smk'], "slurm-status-cache.json");
+    if os.path.isfile(cache_file):
+        os.remove(cache_file);
+    # Job states from an earlier run aren't needed
+
+    step_start_time = PC.report_step(globs, step, step_start_time, "Success: Status script written");
+    # Status update
+
     return globs; 
 
-#############################################################################
\ No newline at end of file
+#############################################################################
+
+def copyScript(globs, script):
+# Copies one of the standalone cluster scripts in phyloacc_lib to the snakemake directory of the run and makes
+# it executable. Returns the path to the copy.
+    script_file = os.path.join(globs['job-smk'], os.path.basename(script));
+    shutil.copyfile(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.path.basename(script)), script_file);
+    os.chmod(script_file, os.stat(script_file).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH);
+    return script_file;
+
+#############################################################################
+
+def writeArrayJobs(globs):
+# Writes a SLURM array job script for each model type and the config file read by slurm_array.py, which submits
+# the batches as job arrays with one task per batch instead of one job per batch with snakemake (--array)
+
+    step = "Writing SLURM array jobs";
+    step_start_time = PC.report_step(globs, step, False, "In progress...");
+    # Status update
+
+    cluster_logdir = os.path.abspath(os.path.join(globs['job-dir'], "slurm-logs"));
+    # A directory to save the log files from the cluster
+
+    batch_resources = RUNTIME.batchResources(globs);
+    # The memory (MB) and time (minutes) for each batch from its predicted runtime and memory
+
+    array_config = { 'throttle' : globs['num-jobs'],
+                     'retry-scale' : globs['retry-scale'],
+                     'max-array-size' : globs['max-array-size'],
+                     'missing-after' : 10 * globs['status-interval'],
+                     'output-dir' : os.path.abspath(globs['job-out']),
+                     'log-dir' : cluster_logdir,
+                     'arrays' : {} };
+    # missing-after is the number of seconds after an array is submitted that a task sacct doesn't list is taken to
+    # have failed, several times the interval between sacct queries
+
+    for model_type, phyloacc_path in [("st", globs['phyloacc']), ("gt", globs['phyloacc-gt'])]:
+        if not globs[model_type + '-batches']:
+            continue;
+
+        array_file = os.path.join(globs['job-smk'], "run_phyloacc_" + model_type + ".sh");
+        with open(array_file, "w") as arrayfile:
+            arrayfile.write(TEMPLATES.arrayJob().format(model_type=model_type,
+                                                        cmd=globs['call'],
+                                                        dt=PC.getDateTime(),
+                                                        part=globs['partition'],
+                                                        num_nodes=globs['num-nodes'],
+                                                        procs_per_job=str(globs['procs-per-job']),
+                                                        cluster_logdir=cluster_logdir,
+                                                        outdir=os.path.abspath(globs['job-out']),
+                                                        indir=os.path.abspath(globs['job-cfgs']),
+                                                        phyloacc_path=os.path.abspath(phyloacc_path)
+                                                        ));
+
+        array_config['arrays'][model_type] = { 'script' : os.path.abspath(array_file),
+                                               'batches' : globs[model_type + '-batches'],
+                                               'mem' : max(batch_resources[batch]['mem'] for batch in globs[model_type + '-batches']),
+                                               'time' : max(batch_resources[batch]['time'] for batch in globs[model_type + '-batches']) };
+        # Every task in an array gets the same time and memory, so use those of the largest batch
+    ## End model type loop
+
+    with open(os.path.join(globs['job-smk'], "array-config.json"), "w") as configfile:
+        json.dump(array_config, configfile, indent=4);
+
+    submission_file = os.path.join(globs['job-smk'], "array-submissions.json");
+    if os.path.isfile(submission_file):
+        os.remove(submission_file);
+    # Arrays submitted for an earlier run of the interface may have had different batches
+
+    globs['array-script'] = copyScript(globs, globs['array-script']);
+
+    step_start_time = PC.report_step(globs, step, step_start_time, "Success: Array jobs written");
+    # Status update
+
+    return globs;
+
+#############################################################################
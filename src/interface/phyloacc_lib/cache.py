@@ -0,0 +1,211 @@
+#############################################################################
+# Functions to cache per-locus alignment stats and sCF between runs of the
+# interface. Results are stored in a sqlite database in the cache directory
+# (-cache) and keyed by a hash of each locus alignment and everything else
+# that goes into the calculation (tree, quartets, skip-chars, etc.)
+#############################################################################
+
+import os
+import time
+import pickle
+import sqlite3
+import hashlib
+import phyloacc_lib.core as PC
+import phyloacc_lib.store as STORE
+
+#############################################################################
+
+CACHE_VERSION = "1";
+# Change this whenever the per-locus results change so that old cached results are never used
+
+#############################################################################
+
+def getCache(globs):
+# Opens the cache database on first use. Returns False if no cache directory was given.
+
+    if not globs['cache-dir']:
+        return False;
+
+    if not globs['cache-db']:
+        if not os.path.isdir(globs['cache-dir']):
+            os.makedirs(globs['cache-dir']);
+
+        globs['cache-db'] = sqlite3.connect(os.path.join(globs['cache-dir'], "phyloacc-cache.sqlite"));
+        globs['cache-db'].execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value BLOB, size INTEGER, atime REAL)");
+        globs['cache-db'].execute("CREATE INDEX IF NOT EXISTS results_atime ON results (atime)");
+        globs['cache-db'].execute("CREATE TABLE IF NOT EXISTS quartets (key TEXT PRIMARY KEY, value BLOB)");
+        # Open the database and create the tables of results and quartets if this is a new cache. The quartets
+        # are small and are kept separately so they are never evicted before the results that depend on them
+
+        if globs['clear-cache']:
+            globs['cache-db'].execute("DELETE FROM results");
+            globs['cache-db'].execute("DELETE FROM quartets");
+            globs['cache-db'].commit();
+            globs['cache-db'].execute("VACUUM");
+        # --clearcache: remove all cached results before the run
+
+        globs['cache-db'].commit();
+
+    return globs['cache-db'];
+
+#############################################################################
+
+def hashKey(*parts):
+# A key for the cache from the repr of all the given parts
+    h = hashlib.sha1(CACHE_VERSION.encode());
+    for part in parts:
+        h.update(repr(part).encode());
+        h.update(b"\0");
+    return h.hexdigest();
+
+#############################################################################
+
+def locusKey(context_key, locus, seqs):
+# A key for the result of one locus: the key of everything that is the same for all loci (e.g. the function,
+# tree, and quartets) plus the locus ID and every sequence in the alignment, given as the list of
+# (<sequence id>, <encoded sequence>) from STORE.getRawSeqs
+    h = hashlib.sha1(context_key.encode());
+    h.update(locus.encode() + b"\0");
+    for spec, seq in seqs:
+        h.update(spec.encode() + b"\0");
+        h.update(seq);
+        h.update(b"\0");
+    return h.hexdigest();
+
+#############################################################################
+
+def getResults(globs, keys):
+# Gets results from the cache for all given keys that are in it. Returns a dict of <key> : <result>
+
+    db = getCache(globs);
+    if not db:
+        return {};
+
+    results = {};
+    for i in range(0, len(keys), 500):
+        cur_keys = keys[i:i+500];
+        query = "SELECT key, value FROM results WHERE key IN (" + ",".join("?" * len(cur_keys)) + ")";
+        for key, value in db.execute(query, cur_keys):
+            results[key] = pickle.loads(value);
+    # Look up keys in chunks to stay under the sqlite limit on query parameters
+
+    now = time.time();
+    db.executemany("UPDATE results SET atime = ? WHERE key = ?", [ (now, key) for key in results ]);
+    db.commit();
+    # Mark the results as used so they are evicted last
+
+    return results;
+
+#############################################################################
+
+def putResults(globs, items):
+# Adds a list of (<key>, <result>) to the cache and evicts the least recently used results if the cache
+# is over the size limit (-cache-size)
+
+    db = getCache(globs);
+    if not db or not items:
+        return;
+
+    now = time.time();
+    rows = [];
+    for key, result in items:
+        value = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL);
+        rows.append((key, value, len(value), now));
+    db.executemany("INSERT OR REPLACE INTO results (key, value, size, atime) VALUES (?, ?, ?, ?)", rows);
+    db.commit();
+    # Add the new results
+
+    max_size = globs['cache-size'] * 1024**3;
+    total_size = db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0];
+    if total_size > max_size:
+        evict_keys = [];
+        for key, size in db.execute("SELECT key, size FROM results ORDER BY atime"):
+            evict_keys.append((key,));
+            total_size -= size;
+            if total_size <= max_size:
+                break;
+        db.executemany("DELETE FROM results WHERE key = ?", evict_keys);
+        db.commit();
+    # Evict the least recently used results until the cache is under the size limit
+
+#############################################################################
+
+def getQuartets(globs, key):
+# Gets the quartets sampled in an earlier run for the same tree topology, or False if there are none
+
+    db = getCache(globs);
+    if not db:
+        return False;
+
+    row = db.execute("SELECT value FROM quartets WHERE key = ?", (key,)).fetchone();
+    if not row:
+        return False;
+    return pickle.loads(row[0]);
+
+#############################################################################
+
+def putQuartets(globs, key, quartets):
+# Saves the sampled quartets so that later runs on the same tree topology use the same quartets
+
+    db = getCache(globs);
+    if not db:
+        return;
+
+    db.execute("INSERT OR REPLACE INTO quartets (key, value) VALUES (?, ?)", (key, pickle.dumps(quartets, protocol=pickle.HIGHEST_PROTOCOL)));
+    db.commit();
+
+#############################################################################
+
+def imapCached(globs, pool, func, context_file, args):
+# Runs func over every locus in the store with the pool like pool.imap over STORE.tasks, but results
+# for loci that are already in the cache are loaded instead of sent to the pool. Results are yielded in
+# the order of the loci in the store, like pool.imap, and new results are added to the cache as they
+# come in. args are the same extra arguments passed to the workers in context_file, which are part of the key.
+
+    if not getCache(globs):
+        globs['cache-hits'] = 0;
+        yield from pool.imap(STORE.locusTask, STORE.tasks(globs, func, context_file), chunksize=STORE.chunkSize(globs));
+        return;
+    # Without a cache, run every locus through the pool
+
+    context_key = hashKey(func.__module__, func.__name__, args);
+    keys = [ locusKey(context_key, *STORE.getRawSeqs(globs['aln-store'], locus_index)) for locus_index in range(STORE.numLoci(globs)) ];
+    # The key for every locus, hashed from the bytes in the store without decoding the alignments
+
+    cached = getResults(globs, keys);
+    globs['cache-hits'] = len(cached);
+
+    missing = [ locus_index for locus_index, key in enumerate(keys) if key not in cached ];
+    chunk_size = max(1, min(100, len(missing) // (globs['num-procs'] * 4)));
+    new_iter = pool.imap(STORE.locusTask, STORE.tasks(globs, func, context_file, missing), chunksize=chunk_size) if missing else iter([]);
+    # Only the loci not in the cache are sent to the pool. pool.imap keeps their order, so the results can be
+    # merged back in with the cached ones in store order
+
+    new_results = [];
+    for key in keys:
+        if key in cached:
+            yield cached[key];
+            continue;
+        # Results for loci in the cache
+
+        result = next(new_iter);
+        new_results.append((key, result));
+        if len(new_results) >= 1000:
+            putResults(globs, new_results);
+            new_results = [];
+        # Add results to the cache in chunks
+
+        yield result;
+    ## End locus loop
+
+    putResults(globs, new_results);
+    # Results for loci not in the cache
+
+#############################################################################
+
+def reportHits(globs):
+# Reports how many loci were loaded from the cache in the last call to imapCached
+    if globs['cache-dir']:
+        PC.printWrite(globs['logfilename'], globs['log-v'], "# INFO: " + str(globs['cache-hits']) + " of " + str(globs['num-loci']) + " loci loaded from the cache in " + globs['cache-dir']);
+
+#############################################################################
@@ -0,0 +1,257 @@
+#############################################################################
+# Functions to read the outputs of each batch of a PhyloAcc run in parallel
+# and combine them for phyloacc_post.py
+#############################################################################
+
+import os
+import json
+# numpy is imported in the functions that use it, so phyloacc_post.py doesn't load it for --version or -h
+
+#############################################################################
+
+FILE_SUFFIXES = ["_elem_lik.txt", "_M0_elem_Z.txt", "_M1_elem_Z.txt", "_M2_elem_Z.txt", "_rate_postZ_M0.txt", "_rate_postZ_M1.txt", "_rate_postZ_M2.txt"];
+# The files created by the various PhyloAcc runs that we care about have these suffixes
+# _elem_lik.txt MUST be first to get the locus IDs and associated numbers for each batch
+
+LIK_COLS = ['loglik_Null', 'loglik_Acc', 'loglik_Full', 'logBF1', 'logBF2'];
+MODEL_COLS = ['loglik_Null', 'loglik_Acc', 'loglik_Full'];
+# The columns of _elem_lik.txt kept in memory after combining: the marginal likelihoods of each model, used to get
+# the best model for each locus, and the Bayes factors used for the summary plots
+
+MANIFEST_VERSION = 2;
+# Change this whenever the format of the manifest file changes
+
+#############################################################################
+
+def batchDirs(globs):
+# Gets the output directory of every batch in the PhyloAcc output directory as a list of (<batch>, <model type>, <directory>),
+# sorted by batch number so the combined files are always in the same order
+    batch_dirs = [];
+    for batch_dir in os.listdir(globs['phyloacc-out-dir']):
+        batch_dir = batch_dir.split("-");
+        if len(batch_dir) != 4 or not batch_dir[0].isdigit() or batch_dir[2] not in ["st", "gt"]:
+            continue;
+        batch_dirs.append((batch_dir[0], batch_dir[2], "-".join(batch_dir)));
+    # Batch directories are named <batch>-phyloacc-<model type>-out
+
+    return sorted(batch_dirs, key=lambda batch_dir: int(batch_dir[0]));
+
+#############################################################################
+
+def toArray(rows, num_cols):
+# Converts the values of an output file to an array of floats, with NaN for any value that isn't a number
+    import numpy as np;
+    try:
+        return np.array(rows, dtype=np.float64).reshape(-1, num_cols);
+    except ValueError:
+        values = np.full((len(rows), num_cols), np.nan);
+        for r, row in enumerate(rows):
+            for c, value in enumerate(row[:num_cols]):
+                try:
+                    values[r, c] = float(value);
+                except ValueError:
+                    pass;
+        return values;
+    # Rows with a missing or extra value also end up here
+
+#############################################################################
+
+def readBatch(batch_info):
+# Reads all output files of one batch. Returns the batch, its model type, and None if the batch didn't finish. Otherwise
+# also returns a dict with the headers and the lines to write to the combined file for each suffix, the column names
+# and values of each suffix for the results store, the lines for the ID key file, the locus IDs and original IDs, and
+# the columns in LIK_COLS for each locus as an array, and the size and time of each file for the manifest.
+
+    import numpy as np;
+
+    batch, batch_type, batch_dir, bed_file = batch_info;
+
+    if not os.path.isfile(os.path.join(batch_dir, batch + FILE_SUFFIXES[0])):
+        return batch, batch_type, None;
+    # A batch is finished when it has an _elem_lik.txt file
+
+    result = { 'headers' : [], 'lines' : [], 'columns' : [], 'values' : [], 'ids' : [], 'orig-ids' : [], 'liks' : None, 'id-key' : "" };
+
+    id_keys = {};
+    # Most output files only have locus numbers assigned by PhyloAcc. This dict stores the association with the actual
+    # locus ID found in the _elem_lik.txt file
+    # key:value format: <locus number> : <locus id>
+
+    for suffix in FILE_SUFFIXES:
+        first_file = suffix == FILE_SUFFIXES[0];
+        cur_lines, cur_rows, lik_rows = [], [], [];
+
+        with open(os.path.join(batch_dir, batch + suffix)) as infile:
+            cur_headers = infile.readline().strip().split("\t");
+
+            if first_file:
+                cur_headers = cur_headers[1:];
+            cur_headers[0] = "Locus ID";
+            # Get the headers, and if this is the first file (_elem_lik.txt), remove the "No." header. Then replace
+            # the "No." header with the "Locus ID header"
+
+            if first_file:
+                lik_inds = [ cur_headers.index(col) if col in cur_headers else None for col in LIK_COLS ];
+            # The columns to keep in memory, which may not all be in the output of every version of PhyloAcc
+
+            for line in infile:
+                line = line.strip().split("\t");
+                if line == [""]:
+                    continue;
+
+                if first_file:
+                    cur_id_key = batch + "-" + line[1];
+                    id_keys[line[0]] = cur_id_key;
+                    line = line[:1] + line[2:];
+                    result['ids'].append(cur_id_key);
+                    lik_rows.append([ float(line[ind]) if ind is not None else np.nan for ind in lik_inds ]);
+                # If this is the first file (_elem_lik.txt), save the locus number:locus id in the id_keys dict and
+                # remove the "No." entry from the line
+                else:
+                    cur_id_key = id_keys[line[0]];
+                # For all other files, replace the locus number with the locus ID based on the entry in id_keys
+
+                cur_lines.append(cur_id_key + "\t" + "\t".join(line[1:]) + "\n");
+                cur_rows.append(line[1:]);
+        ## Close batch file
+
+        result['headers'].append("\t".join(cur_headers) + "\n");
+        result['lines'].append("".join(cur_lines));
+        result['columns'].append(cur_headers[1:]);
+        result['values'].append(toArray(cur_rows, len(cur_headers) - 1));
+        # The text lines for the combined files and the values for the results store
+
+        if first_file:
+            result['liks'] = np.array(lik_rows, dtype=np.float64).reshape(-1, len(LIK_COLS));
+    ## End file loop
+
+    ####################
+
+    locus_rows = { locus_id : row for row, locus_id in enumerate(result['ids']) };
+    model_liks = result['liks'][:, [ LIK_COLS.index(col) for col in MODEL_COLS ]];
+    best_models = np.argmax(model_liks, axis=1) if len(model_liks) else np.empty(0, dtype=int);
+    # The model with the highest marginal likelihood for every locus
+    id_lines = [];
+    result['orig-ids'] = [""] * len(result['ids']);
+
+    for line in open(bed_file):
+        line = line.strip().split("\t");
+        locus_id = batch + "-" + line[0];
+        if locus_id not in locus_rows:
+            continue;
+
+        result['orig-ids'][locus_rows[locus_id]] = line[3];
+        row = locus_rows[locus_id];
+        max_lik_ind = best_models[row];
+        id_lines.append("\t".join([ locus_id, line[3], MODEL_COLS[max_lik_ind], str(float(model_liks[row, max_lik_ind])) ]) + "\n");
+    # Get the original ID of each locus from the bed file of the batch and the model with the highest marginal likelihood
+
+    result['id-key'] = "".join(id_lines);
+    result['files'] = fileSigs(batch_dir, batch);
+
+    return batch, batch_type, result;
+
+#############################################################################
+
+def fileSigs(batch_dir, batch):
+# Gets the size and modification time of each output file of a batch, to tell if a batch was run again after it was
+# combined. Returns a dict of <suffix> : [<size>, <modification time in ns>], or False if any of the files is missing.
+    sigs = {};
+    for suffix in FILE_SUFFIXES:
+        try:
+            stat = os.stat(os.path.join(batch_dir, batch + suffix));
+        except OSError:
+            return False;
+        sigs[suffix] = [stat.st_size, stat.st_mtime_ns];
+    return sigs;
+
+#############################################################################
+
+def readManifest(globs, outfiles):
+# Reads the manifest of batches already in the combined results for --incremental. Returns False if there is no usable
+# manifest, any of the combined files are missing or shorter than when the manifest was written, or the results store
+# has a different number of loci, in which case all batches must be read.
+
+    if not os.path.isfile(globs['manifest-file']):
+        return False;
+
+    try:
+        with open(globs['manifest-file']) as manifestfile:
+            manifest = json.load(manifestfile);
+    except (OSError, ValueError):
+        return False;
+
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        return False;
+
+    if not all(os.path.isfile(outfile) for outfile in outfiles) or not os.path.isfile(os.path.join(globs['store-dir'], "index.json")):
+        return False;
+
+    sizes = manifest.get('sizes', {});
+    if any(os.path.basename(outfile) not in sizes or os.path.getsize(outfile) < sizes[os.path.basename(outfile)] for outfile in outfiles):
+        return False;
+    # Lines written after the manifest by an interrupted run are removed with truncateOutputs, but missing lines can't
+    # be recovered
+
+    try:
+        with open(os.path.join(globs['store-dir'], "index.json")) as indexfile:
+            store_rows = json.load(indexfile).get('rows');
+    except (OSError, ValueError):
+        return False;
+    if store_rows != manifest.get('store-rows'):
+        return False;
+    # The store is written just before the manifest, so a run interrupted between them leaves loci in the store that
+    # aren't in the manifest
+
+    return manifest;
+
+#############################################################################
+
+def outputSizes(outfiles):
+# Gets the size in bytes of each combined file when the manifest is written: { <file name> : <size> }
+    return { os.path.basename(outfile) : os.path.getsize(outfile) for outfile in outfiles };
+
+#############################################################################
+
+def truncateOutputs(manifest, outfiles):
+# Cuts each combined file back to its size when the manifest was written before adding to it with --incremental,
+# removing any lines of batches written by a run that was interrupted before it could update the manifest
+    for outfile in outfiles:
+        if os.path.getsize(outfile) > manifest['sizes'][os.path.basename(outfile)]:
+            os.truncate(outfile, manifest['sizes'][os.path.basename(outfile)]);
+
+#############################################################################
+
+def changedBatches(globs, manifest, batch_dirs):
+# Gets the batches in the manifest whose output files have changed or are gone since they were combined
+    cur_dirs = { batch : batch_dir for batch, batch_type, batch_dir in batch_dirs };
+    changed = [];
+    for batch, info in manifest['batches'].items():
+        if batch not in cur_dirs or fileSigs(os.path.join(globs['phyloacc-out-dir'], cur_dirs[batch]), batch) != info['files']:
+            changed.append(batch);
+    return sorted(changed, key=int);
+
+#############################################################################
+
+def writeManifest(globs, manifest):
+# Writes the manifest of combined batches, replacing the old one only once the new one is complete
+    tmp_file = globs['manifest-file'] + ".tmp";
+    with open(tmp_file, "w") as manifestfile:
+        json.dump(manifest, manifestfile);
+    os.replace(tmp_file, globs['manifest-file']);
+
+#############################################################################
+
+def summaryColumns(store):
+# Gets the locus keys (<batch>-<locus>) and the columns in LIK_COLS for every locus in a loaded results store, with NaN
+# for any column that isn't in the store
+    import numpy as np;
+    locus_ids = [ str(batch) + "-" + str(locus) for batch, locus in zip(store['batch'].tolist(), store['locus'].tolist()) ];
+    cols = store['tables'].get('elem_lik', []);
+    liks = np.full((store['rows'], len(LIK_COLS)), np.nan);
+    for c, col in enumerate(LIK_COLS):
+        if col in cols:
+            liks[:, c] = store['elem_lik'][:, cols.index(col)];
+    return locus_ids, liks;
+
+#############################################################################
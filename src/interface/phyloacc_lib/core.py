@@ -5,12 +5,12 @@
 
 import sys
 import os
+import json
 import math
 import time
 import timeit
 import datetime
 import subprocess
-from itertools import islice
 
 #############################################################################
 
@@ -90,6 +90,16 @@ def execCheck(globs, a):
 def detectCompression(filename):
 # Detect compression of a file by examining the first lines in the file
 
+    file_start = open(filename, "rb").read(4);
+    # Read the beginning of the file up to the length of the longest magic string
+
+    return compressionType(file_start);
+
+#############################################################################
+
+def compressionType(file_start):
+# Detect compression from the first bytes of a file, e.g. for files that have already been read into memory
+
     compression_type = "none";
 
     magic_dict = {
@@ -103,13 +113,6 @@ def detectCompression(filename):
     # \x is the escape code for hex values
     # b converts strings to bytes
 
-    max_len = max(len(x) for x in magic_dict)
-    # The number of characters to read from the beginning of the file should be the length of
-    # the longest magic string
-
-    file_start = open(filename, "rb").read(max_len);
-    # Read the beginning of the file up to the length of the longest magic string
-
     for magic_string in magic_dict:
         if file_start.startswith(magic_string):
             compression_type = magic_dict[magic_string];
@@ -119,14 +122,6 @@ def detectCompression(filename):
 
 #############################################################################
 
-def dictChunk(d, chunksize):
-# Function to process a dictionary in specified chunks and yield the result
-    iter_d = iter(d)
-    for i in range(0, len(d), chunksize):
-        yield { key:d[key] for key in islice(iter_d, chunksize) }
-
-#############################################################################
-
 def getOutTime():
 # Function to get the date and time in a certain format.
     return datetime.datetime.now().strftime("%m-%d-%Y.%I-%M-%S");
@@ -302,7 +297,8 @@ def coreCol(pal="default", numcol=4, offset=0, info=False):
 #############################################################################
 
 def report_step(globs, step, step_start_time, step_status, start=False, full_update=False):
-# Uses psutil to gather memory and time info between steps and print them to the screen.
+# Uses psutil to gather memory and time info between steps and print them to the screen. Every final entry is also
+# written as a JSON line to the telemetry file with writeTelemetry.
 
     dashes = 150
     if globs['psutil']:
@@ -343,6 +339,10 @@ def report_step(globs, step, step_start_time, step_status, start=False, full_upd
         # If no step start time is given, then this is the first entry for this status
         # update, that will display "In progress..." or similar.
 
+            if globs['telemetry-file']:
+                globs['step-usage'][cur_time] = resourceUsage(globs);
+            # The resources used at the start of the step, to get the resources used by the step at the end
+
             out_line = [ "# " + getDate(), getTime(), step, step_status ];
             # The output for the initial status entry includes the date, time, step label, and progress message
 
@@ -403,6 +403,10 @@ def report_step(globs, step, step_start_time, step_status, start=False, full_upd
             
             printWrite(globs['logfilename'], 3, "".join(file_line));
             # Write the full line to the file.
+
+            if globs['telemetry-file']:
+                writeTelemetry(globs, step, step_status, step_start_time, cur_time);
+            # Write the machine-readable record of the step
         # The final status entry
         #####
 
@@ -410,6 +414,119 @@ def report_step(globs, step, step_start_time, step_status, start=False, full_upd
 
 #############################################################################
 
+def resourceUsage(globs):
+# Gets the CPU time, peak memory, and bytes read from and written to disk so far by this process and its finished child
+# processes, which include the workers of the pools once they exit. This only needs resource.getrusage, but when psutil
+# is installed it is also used to get the disk I/O of this process and the current memory of this process and its
+# running children. Anything that can't be measured on this system is None.
+
+    usage = { 'cpu-user' : None, 'cpu-sys' : None, 'max-rss' : None, 'children-max-rss' : None, 'rss' : None, 'read-bytes' : None, 'write-bytes' : None };
+
+    try:
+        import resource;
+    except ImportError:
+        resource = False;
+    # resource is only available on Unix
+
+    if resource:
+        self_usage, child_usage = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN);
+
+        usage['cpu-user'] = self_usage.ru_utime + child_usage.ru_utime;
+        usage['cpu-sys'] = self_usage.ru_stime + child_usage.ru_stime;
+
+        rss_scale = 1 if sys.platform == "darwin" else 1024;
+        usage['max-rss'] = self_usage.ru_maxrss * rss_scale;
+        usage['children-max-rss'] = child_usage.ru_maxrss * rss_scale;
+        # ru_maxrss is in bytes on macOS and KB on Linux
+
+        usage['read-bytes'] = (self_usage.ru_inblock + child_usage.ru_inblock) * 512;
+        usage['write-bytes'] = (self_usage.ru_oublock + child_usage.ru_oublock) * 512;
+        # The number of blocks read and written, which are counted in 512 byte units
+
+    if globs['psutil'] and globs['pids']:
+        import psutil;
+
+        try:
+            procs = list(globs['pids']) + [ child for proc in globs['pids'] for child in proc.children(recursive=True) ];
+            usage['rss'] = sum(proc.memory_info().rss for proc in procs);
+        except psutil.Error:
+            pass;
+        # Children can exit while their memory is being checked
+
+        try:
+            io_counts = [ proc.io_counters() for proc in globs['pids'] ];
+            children_read = child_usage.ru_inblock * 512 if resource else 0;
+            children_write = child_usage.ru_oublock * 512 if resource else 0;
+            usage['read-bytes'] = sum(cur_io.read_bytes for cur_io in io_counts) + children_read;
+            usage['write-bytes'] = sum(cur_io.write_bytes for cur_io in io_counts) + children_write;
+        except (AttributeError, psutil.Error):
+            pass;
+        # psutil doesn't have io_counters on macOS
+    ## psutil block
+
+    return usage;
+
+#############################################################################
+
+def itemCounts(globs):
+# Gets the number of loci and batches so far, from the keys of the interface or of phyloacc_post.py
+    if 'alns' in globs:
+        return len(globs['alns']), globs['num-batches'];
+    return len(globs['locus-ids']), len(globs['complete-batches']);
+
+#############################################################################
+
+def writeTelemetry(globs, step, step_status, step_start_time, cur_time):
+# Appends one JSON line for a finished step (or part of a step) to the telemetry file, with the time, CPU time, memory,
+# and disk I/O since step_start_time and the number of loci and batches. The file is appended to by every run so runs
+# can be compared, and each record has the start time of its run. Values that couldn't be measured are null.
+
+    usage = resourceUsage(globs);
+    start_usage = globs['step-usage'].get(step_start_time, {});
+    globs['step-usage'][cur_time] = usage;
+    # The usage at the start of the step if it was recorded, or since the start of the program otherwise. The
+    # returned time is sometimes used as the start of the next part of the step, so save the usage for it too
+
+    def since(key):
+        if usage[key] is None:
+            return None;
+        return usage[key] - (start_usage.get(key) or 0);
+    # The amount used during the step
+
+    def megabytes(num_bytes):
+        return None if num_bytes is None else round(num_bytes / float(2 ** 20), 3);
+
+    num_loci, num_batches = itemCounts(globs);
+
+    record = { 'run' : globs['startdatetime'],
+               'program' : os.path.basename(sys.argv[0]),
+               'date' : getDate(),
+               'time' : getTime(),
+               'step' : step,
+               'status' : step_status,
+               'elapsed-s' : round(cur_time - globs['starttime'], 5),
+               'wall-s' : round(cur_time - step_start_time, 5),
+               'cpu-user-s' : None if since('cpu-user') is None else round(since('cpu-user'), 5),
+               'cpu-sys-s' : None if since('cpu-sys') is None else round(since('cpu-sys'), 5),
+               'max-rss-mb' : megabytes(usage['max-rss']),
+               'children-max-rss-mb' : megabytes(usage['children-max-rss']),
+               'rss-mb' : megabytes(usage['rss']),
+               'read-bytes' : since('read-bytes'),
+               'write-bytes' : since('write-bytes'),
+               'loci' : num_loci,
+               'batches' : num_batches };
+    # CPU time and I/O include finished child processes. The peak memory of the children is the most used by any one
+    # of them, and is only known once they have exited. The current memory (rss-mb) needs psutil.
+
+    try:
+        with open(globs['telemetry-file'], "a") as telemetryfile:
+            telemetryfile.write(json.dumps(record) + "\n");
+    except OSError:
+        pass;
+    # Telemetry should never stop a run
+
+#############################################################################
+
 def welcome():
 # Reads the ASCII art "Referee" text to be printed to the command line.
     return open(os.path.join(os.path.dirname(__file__), "pa-welcome.txt"), "r").read();
@@ -462,6 +579,16 @@ def endProg(globs, interface=True):
         printWrite(globs['logfilename'], globs['log-v'], "#\n# ERROR: NON-ZERO EXIT STATUS.");
         printWrite(globs['logfilename'], globs['log-v'], "# ERROR: PHYLOACC FINISHED WITH ERRORS.");
         printWrite(globs['logfilename'], globs['log-v'], "# ERROR: PLEASE CHECK THE LOG FILE FOR MORE INFO: " + globs['logfilename'] + "\n#");
+    elif interface and globs['local']:
+        printWrite(globs['logfilename'], globs['log-v'], "#\n# PhyloAcc batches successfully run locally");
+        printWrite(globs['logfilename'], 1, "# Combine and summarize the results with:\n\n");
+        printWrite(globs['logfilename'], 1, "phyloacc_post.py -i " + globs['outdir'] + "\n\n");
+    elif interface and globs['array']:
+        printWrite(globs['logfilename'], globs['log-v'], "#\n# PhyloAcc job files successfully generated");
+        printWrite(globs['logfilename'], 1, "# Run the following command to see the SLURM job arrays that will be submitted:\n\n");
+        printWrite(globs['logfilename'], 1, globs['smk-cmd'] + "\n\n");
+        printWrite(globs['logfilename'], 1, "# Then, if everything looks right, remove --dryrun to submit them");
+        printWrite(globs['logfilename'], 1, "# Check on the batches with 'status' instead of 'submit', and run submit again to resubmit any that failed");
     elif interface:
         printWrite(globs['logfilename'], globs['log-v'], "#\n# PhyloAcc job files successfully generated");
         printWrite(globs['logfilename'], 1, "# Run the following command from the Phyloacc-interface directory:\n\n");
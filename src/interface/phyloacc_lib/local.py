@@ -0,0 +1,133 @@
+#############################################################################
+# Functions to run the PhyloAcc batches on this machine (--local) instead of
+# submitting them to a cluster with snakemake
+#############################################################################
+
+import os
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import phyloacc_lib.core as PC
+
+#############################################################################
+
+def batchFiles(globs, batch, model_type):
+# The config file, output directory, log file, and finished output file of a batch, named the same as
+# in the snakemake pipeline so the batches can be combined with phyloacc_post.py either way
+    out_dir = os.path.join(globs['job-out'], batch + "-phyloacc-" + model_type + "-out");
+    return { 'cfg' : os.path.join(globs['job-cfgs'], batch + "-" + model_type + ".cfg"),
+             'bed' : os.path.join(globs['job-bed'], batch + "-" + model_type + ".bed"),
+             'out-dir' : out_dir,
+             'log' : os.path.join(out_dir, batch + "-phyloacc.log"),
+             'benchmark' : os.path.join(out_dir, batch + "-benchmark.txt"),
+             'done' : os.path.join(out_dir, batch + "-local-done.txt"),
+             'elem-lik' : os.path.join(out_dir, batch + "_elem_lik.txt") };
+
+#############################################################################
+
+def batchHash(files):
+# A hash of the config and bed files of a batch, to check that a finished batch was run on the same loci
+    h = hashlib.sha1();
+    for key in ['cfg', 'bed']:
+        with open(files[key], "rb") as infile:
+            h.update(infile.read());
+    return h.hexdigest();
+
+#############################################################################
+
+def isFinished(files):
+# A batch is finished if PhyloAcc wrote its _elem_lik.txt file. If it was run with --local, it must also have been
+# run with the same config and bed files, since rerunning the interface may have changed the loci in the batch.
+    if not os.path.isfile(files['elem-lik']):
+        return False;
+    if os.path.isfile(files['done']):
+        with open(files['done']) as donefile:
+            return donefile.read().strip() == batchHash(files);
+    return True;
+
+#############################################################################
+
+def runBatch(batch_info):
+# Runs PhyloAcc on one batch and writes a benchmark file in the same format as snakemake with the runtime and
+# max memory of the batch for the runtime model. Returns the batch, whether it succeeded, and the runtime.
+    batch, cmd, files = batch_info;
+
+    if not os.path.isdir(files['out-dir']):
+        os.makedirs(files['out-dir']);
+
+    start = time.time();
+    with open(files['log'], "w") as logfile:
+        pid = os.posix_spawn("/bin/sh", ["/bin/sh", "-c", cmd + " " + files['cfg']], os.environ,
+                             file_actions=[(os.POSIX_SPAWN_DUP2, logfile.fileno(), 1), (os.POSIX_SPAWN_DUP2, logfile.fileno(), 2)]);
+        pid, status, usage = os.wait4(pid, 0);
+        exit_code = os.waitstatus_to_exitcode(status);
+    runtime = time.time() - start;
+    # Run PhyloAcc through the shell the same way as the snakemake rules and wait for it with wait4 to get its max memory
+    # (in KB on Linux). It is started without subprocess so nothing else tries to wait for it.
+
+    with open(files['benchmark'], "w") as benchfile:
+        benchfile.write("s\th:m:s\tmax_rss\n");
+        benchfile.write(str(round(runtime, 4)) + "\t" + time.strftime("%H:%M:%S", time.gmtime(runtime)) + "\t" + str(round(usage.ru_maxrss / 1024, 2)) + "\n");
+    # The benchmark file read by phyloacc_post.py
+
+    success = exit_code == 0 and os.path.isfile(files['elem-lik']);
+    if success:
+        with open(files['done'], "w") as donefile:
+            donefile.write(batchHash(files) + "\n");
+    # Record the config and bed files the batch was run with so it can be skipped when the interface is run again
+
+    return batch, success, runtime;
+
+#############################################################################
+
+def runLocal(globs):
+# Runs every batch of PhyloAcc on this machine, as many at a time as fit on the given cores (-cores) with
+# -p processes each. The longest batches are started first so a long batch doesn't start last and hold up
+# the end of the run. Batches that already finished in an earlier run are skipped.
+
+    num_parallel = max(1, globs['local-cores'] // globs['procs-per-job']);
+    # The number of batches to run at once
+
+    batches, num_finished = [], 0;
+    for model_type, cmd in [("st", globs['phyloacc']), ("gt", globs['phyloacc-gt'])]:
+        for batch in globs[model_type + '-batches']:
+            files = batchFiles(globs, batch, model_type);
+            if isFinished(files):
+                num_finished += 1;
+                continue;
+            batches.append((batch, cmd, files));
+    # Get the batches that still need to be run
+
+    batches.sort(key=lambda batch_info: globs['batch-costs'].get(batch_info[0], 0), reverse=True);
+    # Longest predicted batches first
+
+    if num_finished:
+        PC.printWrite(globs['logfilename'], globs['log-v'], "# INFO: Skipping " + str(num_finished) + " batches that finished in an earlier run.");
+
+    step = "Running PhyloAcc batches locally";
+    step_start_time = PC.report_step(globs, step, False, "Run 0 / " + str(len(batches)) + " batches...", full_update=True);
+    # Status update
+
+    num_done = 0;
+    with ThreadPoolExecutor(max_workers=num_parallel) as executor:
+        futures = [ executor.submit(runBatch, batch_info) for batch_info in batches ];
+        for future in as_completed(futures):
+            batch, success, runtime = future.result();
+            num_done += 1;
+            if not success:
+                globs['local-failed'].append(batch);
+            PC.report_step(globs, step, step_start_time, "Run " + str(num_done) + " / " + str(len(batches)) + " batches...", full_update=True);
+    # Each batch runs in its own PhyloAcc process, so threads are enough to keep num_parallel of them running
+
+    if globs['local-failed']:
+        globs['local-failed'].sort(key=int);
+        globs['exit-code'] = 1;
+        step_start_time = PC.report_step(globs, step, step_start_time, "Error: " + str(len(globs['local-failed'])) + " batches failed", full_update=True);
+        PC.printWrite(globs['logfilename'], globs['log-v'], "# WARNING: These batches failed: " + ",".join(globs['local-failed']) + ". See the phyloacc.log file in each batch output directory in " + globs['job-out'] + ". Run the interface again with --overwrite to retry only the unfinished batches.");
+    else:
+        step_start_time = PC.report_step(globs, step, step_start_time, "Success: " + str(len(batches)) + " batches run", full_update=True);
+    # Status update
+
+    return globs;
+
+#############################################################################
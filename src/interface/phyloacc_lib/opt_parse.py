@@ -10,6 +10,8 @@ import argparse
 import multiprocessing as mp
 import phyloacc_lib.core as PC
 import phyloacc_lib.tree as TREE
+import phyloacc_lib.runtime as RUNTIME
+import phyloacc_lib.profiling as PROFILE
 
 #############################################################################
 
@@ -59,32 +61,47 @@ def optParse(globs):
     parser.add_argument("-r", dest="run_mode", help="Determines which version of PhyloAcc will be used. gt: use the gene tree model for all loci, st: use the species tree model for all loci, adaptive: use the gene tree model on loci with many branches with low sCF and species tree model on all other loci. Default: st", default=False);
     parser.add_argument("-n", dest="num_procs", help="The number of processes that this script should use. Default: 1.", type=int, default=1);
     parser.add_argument("-p", dest="procs_per_batch", help="The number of processes to use for each batch of PhyloAcc. Default: 1.", type=int, default=1);
+    parser.add_argument("-readers", dest="num_readers", help="The number of alignment files to read at once when the input is a directory of alignments (-d). Default: 8.", type=int, default=8);
     parser.add_argument("-j", dest="num_jobs", help="The number of jobs (batches) to run in parallel. Must be less than or equal to the total processes for PhyloAcc (-p). Default: 1.", type=int, default=1);
     # User params
 
-    parser.add_argument("-batch", dest="batch_size", help="The number of loci to run per batch. Default: 50", default=False);
+    parser.add_argument("-batch", dest="batch_size", help="The number of loci to run per batch. Loci are split among ceil(loci / batch) batches so that each batch has about the same predicted runtime. Default: 50", default=False);
+    parser.add_argument("-batch-time", dest="batch_time", help="The target predicted runtime of each batch in minutes. When set, the number of batches is chosen so each batch takes about this long and -batch is ignored. Default: not set.", default=False);
     # Batch options
 
     parser.add_argument("-part", dest="cluster_part", help="The partition or list of partitions (separated by commas) on which to run PhyloAcc jobs.", default=False);
     parser.add_argument("-nodes", dest="cluster_nodes", help="The number of nodes on the specified partition to submit jobs to. Default: 1.", default=False);
     parser.add_argument("-mem", dest="cluster_mem", help="The max memory for each job in GB. Default: 4.", default=False);
     parser.add_argument("-time", dest="cluster_time", help="The time in hours to give each job. Default: 1.", default=False);
+    parser.add_argument("--local", dest="local", help="Set this to run the PhyloAcc batches on this machine after the job files are written instead of submitting them to a cluster with snakemake. -part is not required. Batches that finished in an earlier run to the same output directory are skipped.", action="store_true", default=False);
+    parser.add_argument("-cores", dest="local_cores", help="With --local, the number of cores to run PhyloAcc batches on. Batches are run at the same time with -p processes each. Default: all cores on this machine.", default=False);
+    parser.add_argument("--array", dest="array", help="Set this to submit the batches as SLURM job arrays, one array per model type with one task per batch, instead of one job per batch with snakemake. At most -j tasks run at once. Failed tasks are resubmitted by submitting again. Can't be used with --local or --theta.", action="store_true", default=False);
+    parser.add_argument("-runtime-model", dest="runtime_model", help="A runtime model fit by phyloacc_post.py from a previous run (runtime-model.json in its output directory). The model is used to predict the runtime of each batch, and to set -time, -mem, and the batch sizes when they aren't given. Default: not set.", default=False);
     # Cluster options
     
+    parser.add_argument("-cache", dest="cache_dir", help="A directory in which to cache the alignment stats and sCF of each locus between runs. Reruns on the same alignment and tree will load unchanged loci from the cache instead of recalculating them. Default: no cache.", default=False);
+    parser.add_argument("-cache-size", dest="cache_size", help="The max size of the cache (-cache) in GB. The least recently used results are removed when the cache grows past this. Default: 5.", default=False);
+    parser.add_argument("--clearcache", dest="clear_cache", help="Set this to remove all results from the cache (-cache) before running.", action="store_true", default=False);
+    # Cache options
+
     parser.add_argument("--theta", dest="theta", help="Set this to add gene tree estimation with IQ-tree and species estimation with ASTRAL for estimation of the theta prior. Note that a species tree with branch lengths in units of substitutions per site is still required with -m. Also note that this may add substantial runtime to the pipeline.", action="store_true", default=False);
     parser.add_argument("--labeltree", dest="labeltree", help="Simply reads the tree from the input mod file (-m), labels the internal nodes, and exits.", action="store_true", default=False);
     parser.add_argument("--overwrite", dest="ow_flag", help="Set this to overwrite existing files.", action="store_true", default=False);
     # User options
     
     parser.add_argument("--plot", dest="plot_flag", help="Plot some summary statistics from the input data.", action="store_true", default=False);
+    parser.add_argument("-plot-bin", dest="plot_bin_loci", help="With --plot, the number of loci above which histograms are counted in fixed bins as the stats are read and scatter plots are drawn as 2D histograms instead of one point per locus. Default: 50000.", default=False);
     parser.add_argument("--options", dest="options_flag", help="Print the full list of PhyloAcc options that can be specified with -phyloacc and exit.", action="store_true", default=False);
     parser.add_argument("--info", dest="info_flag", help="Print some meta information about the program and exit. No other options required.", action="store_true", default=False);
     parser.add_argument("--depcheck", dest="depcheck", help="Run this to check that all dependencies are installed at the provided path. No other options necessary.", action="store_true", default=False);
     parser.add_argument("--version", dest="version_flag", help="Simply print the version and exit. Can also be called as '-version', '-v', or '--v'", action="store_true", default=False);
+    parser.add_argument("--profile", dest="profile", help="Profile each step of the interface with cProfile, including the per-locus functions run in the process pools. Profiles are written to a profile directory in the output directory and the functions with the most time in each are reported in the log file.", action="store_true", default=False);
     parser.add_argument("--quiet", dest="quiet_flag", help="Set this flag to prevent PhyloAcc from reporting detailed information about each step.", action="store_true", default=False);
     # Run options
     
     parser.add_argument("--qstats", dest="qstats", help=argparse.SUPPRESS, action="store_true", default=False);
+    parser.add_argument("--pystats", dest="pystats", help=argparse.SUPPRESS, action="store_true", default=False);
+    parser.add_argument("--nofuse", dest="nofuse", help=argparse.SUPPRESS, action="store_true", default=False);
     parser.add_argument("--norun", dest="norun", help=argparse.SUPPRESS, action="store_true", default=False);
     parser.add_argument("--debug", dest="debug_opt", help=argparse.SUPPRESS, action="store_true", default=False);
     parser.add_argument("--nolog", dest="nolog_opt", help=argparse.SUPPRESS, action="store_true", default=False);
@@ -161,10 +178,11 @@ def optParse(globs):
 
     try:
         globs['tree-dict'], globs['labeled-tree'], globs['root-node'] = TREE.treeParse(globs['tree-string']);
-        globs['tree-tips'] = [ n for n in globs['tree-dict'] if globs['tree-dict'][n][2] == "tip" ];
+        globs['tree-index'] = TREE.treeIndex(globs['tree-dict'], globs['root-node']);
+        globs['tree-tips'] = globs['tree-index']['tips'];
     except:
         PC.errorOut("OP5", "Error reading tree from mod file!", globs);
-    # Read the tree as a dictionary for sCF calculations
+    # Read the tree as a dictionary for sCF calculations and index its structure
 
     if args.labeltree:
         print("# --labeltree SET. LABELING INPUT TREE AND EXITING:\n")
@@ -236,17 +254,17 @@ def optParse(globs):
     if args.conserved:
         globs['conserved'] = args.conserved.replace("; ", ";").split(";");
     else:
-        globs['conserved'] = [ node for node in globs['tree-dict'] 
-                                if globs['tree-dict'][node][2] =='tip' 
-                                and node not in globs['targets'] 
-                                and node not in globs['outgroup'] ];
+        group_bits = 0;
+        for species in globs['targets'] + globs['outgroup']:
+            group_bits |= globs['tree-index']['tip-bits'].get(species, 0);
+        globs['conserved'] = [ tip for tip in globs['tree-index']['tips'] if not globs['tree-index']['tip-bits'][tip] & group_bits ];
     # Read the conserved group if provided, and if not infer it from the other groups
 
     for group in ['targets', 'outgroup', 'conserved']:
         for species in globs[group]:
-            if species not in globs['tree-dict']:
-                PC.errorOut("OP7", "The following species label was provided in a group but is not present in the tree: " + species, globs);
-    # A preliminary check here to make sure all provided labels are actually in the input tree
+            if species not in globs['tree-index']['tip-bits']:
+                PC.errorOut("OP7", "The following species label was provided in a group but is not a tip in the tree: " + species, globs);
+    # A preliminary check here to make sure all provided labels are actually tips in the input tree
 
     ## Species grouping options
     ####################
@@ -339,6 +357,12 @@ def optParse(globs):
         #     os.makedirs(globs['html-dir']);
         globs['html-file'] = os.path.join(globs['outdir'], "phyloacc-pre-run-summary.html");
         # HTML directory
+
+        if args.plot_bin_loci:
+            if not PC.isPosInt(args.plot_bin_loci):
+                PC.errorOut("OP21", "The number of loci above which plots are binned (-plot-bin) must be a positive integer.", globs);
+            globs['plot-bin-loci'] = int(args.plot_bin_loci);
+        # Binned plots for large data sets
     # Parse the --plot option
 
     globs['job-dir'] = os.path.join(globs['outdir'], "phyloacc-job-files");
@@ -363,9 +387,41 @@ def optParse(globs):
     logfile.close();
     # Log file
 
+    globs['telemetry-file'] = os.path.join(globs['outdir'], "telemetry.jsonl");
+    # A JSON line with the time, CPU, memory, and I/O used by each step is added to this file by every run
+
+    if args.profile:
+        globs['profile'] = True;
+        globs['prof-dir'] = os.path.join(globs['outdir'], "profile");
+        globs['prof-worker-dir'] = os.path.join(globs['prof-dir'], "workers");
+        if not os.path.isdir(globs['prof-worker-dir']):
+            os.makedirs(globs['prof-worker-dir']);
+        for filename in os.listdir(globs['prof-worker-dir']):
+            if filename.endswith(".prof"):
+                os.remove(os.path.join(globs['prof-worker-dir'], filename));
+        # Worker profiles from a previous run with --overwrite would be merged with the new ones
+    # Profile directories for --profile
+
     ## Output files and directories
     ####################
 
+    if args.cache_dir:
+        globs['cache-dir'] = os.path.abspath(args.cache_dir);
+        if os.path.exists(globs['cache-dir']) and not os.path.isdir(globs['cache-dir']):
+            PC.errorOut("OP16", "The cache (-cache) must be a directory: " + globs['cache-dir'], globs);
+    if args.cache_size:
+        if not PC.isPosFloat(args.cache_size, minval=0.001):
+            PC.errorOut("OP16", "The max cache size (-cache-size) must be a positive number.", globs);
+        globs['cache-size'] = float(args.cache_size);
+    if args.clear_cache:
+        if not args.cache_dir:
+            PC.errorOut("OP16", "--clearcache can only be set with a cache directory (-cache).", globs);
+        globs['clear-cache'] = True;
+    # Cache options
+
+    ## Cache
+    ####################
+
     if args.batch_size:
         print(args.batch_size);
         if not PC.isPosInt(args.batch_size):
@@ -374,25 +430,53 @@ def optParse(globs):
             globs['batch-size'] = int(args.batch_size);
     # Batch size
 
+    if args.batch_time:
+        if not PC.isPosFloat(args.batch_time, minval=0.001):
+            PC.errorOut("OP17", "The target runtime per batch (-batch-time) must be a positive number of minutes.", globs);
+        globs['batch-time'] = float(args.batch_time);
+    # Target batch runtime
+
     globs['procs-per-job'] = PC.isPosInt(args.procs_per_batch, default=1);
     globs['num-jobs'] = PC.isPosInt(args.num_jobs, default=1);
     globs['total-procs'] = globs['procs-per-job'] * globs['num-jobs'];
     # Determine resource allocation for PhyloAcc
 
     globs['num-procs'] = PC.isPosInt(args.num_procs, default=1);
-    globs['aln-pool'] = mp.Pool(processes=globs['num-procs']);
-    globs['scf-pool'] = mp.Pool(processes=globs['num-procs']);
+    globs['num-readers'] = PC.isPosInt(args.num_readers, default=8);
+    globs['aln-pool'] = mp.Pool(processes=globs['num-procs'], **PROFILE.poolArgs(globs));
+    globs['scf-pool'] = mp.Pool(processes=globs['num-procs'], **PROFILE.poolArgs(globs));
     # Create the pool of processes for sCF calculation here so we copy the memory profile of the parent process
-    # before we've read any large data in
+    # before we've read any large data in. With --profile the workers profile the functions they run.
 
     # Batch size and resource allocation
     ####################
 
-    if not args.cluster_part:
-        PC.errorOut("OP12", "At least one cluster partition must be specified with -part.", globs);
-    else:
+    if args.local:
+        if args.theta:
+            PC.errorOut("OP19", "--local can't be used with --theta, since the gene tree batches need the species tree estimated by the snakemake pipeline.", globs);
+        globs['local'] = True;
+        globs['local-cores'] = os.cpu_count() or 1;
+        if args.local_cores:
+            if not PC.isPosInt(args.local_cores):
+                PC.errorOut("OP19", "The number of cores (-cores) must be a positive integer.", globs);
+            globs['local-cores'] = int(args.local_cores);
+    elif args.local_cores:
+        PC.errorOut("OP19", "-cores can only be set with --local.", globs);
+    # Local run option
+
+    if args.array:
+        if globs['local']:
+            PC.errorOut("OP20", "Only one of --array or --local can be set.", globs);
+        if args.theta:
+            PC.errorOut("OP20", "--array can't be used with --theta, since the gene tree batches need the species tree estimated by the snakemake pipeline.", globs);
+        globs['array'] = True;
+    # SLURM array job option
+
+    if args.cluster_part:
         globs['partition'] = args.cluster_part;
-    # Cluster partition option (required)
+    elif not globs['local']:
+        PC.errorOut("OP12", "At least one cluster partition must be specified with -part.", globs);
+    # Cluster partition option (required unless running locally)
 
     if args.cluster_nodes:
         if not PC.isPosInt(args.cluster_nodes):
@@ -406,6 +490,7 @@ def optParse(globs):
             PC.errorOut("OP14", "The specified cluster memory (-mem) must be a positive integer in GB.", globs);
         else:
             globs['mem'] = args.cluster_mem;
+            globs['mem-set'] = True;
     # Cluster memory option
 
     if args.cluster_time:
@@ -413,7 +498,18 @@ def optParse(globs):
             PC.errorOut("OP15", "The specified cluster time (-time) must be a positive integer in hours.", globs);
         else:
             globs['time'] = args.cluster_time + ":00:00";
-    # Cluster memory option
+            globs['time-set'] = True;
+    # Cluster time option
+
+    if args.runtime_model:
+        if not os.path.isfile(args.runtime_model):
+            PC.errorOut("OP18", "The runtime model (-runtime-model) could not be found: " + args.runtime_model, globs);
+        globs['runtime-model-file'] = os.path.abspath(args.runtime_model);
+        globs = RUNTIME.readRuntimeModel(globs, globs['runtime-model-file']);
+
+        if not args.batch_size and not globs['batch-time']:
+            globs['batch-time'] = RUNTIME.timeSecs(globs['time']) / 60 / RUNTIME.RESOURCE_MARGIN;
+    # Runtime model from a previous run. Without -batch or -batch-time, batches are made to fit in the time per job (-time)
 
     ## Cluster options
     ####################
@@ -427,6 +523,14 @@ def optParse(globs):
         globs['qstats'] = True;
     # Check for the internal quartet stats option to write to a file.
 
+    if args.pystats:
+        globs['stats-engine'] = "python";
+    # Check for the internal option to calculate alignment stats and sCF with the pure Python site loops instead of numpy
+
+    if args.nofuse:
+        globs['fuse-stats'] = False;
+    # Check for the internal option to calculate alignment stats and sCF in separate passes
+
     if globs['psutil']:
         globs['pids'] = [psutil.Process(os.getpid())];
     # Get the starting process ids to calculate memory usage throughout.
@@ -471,6 +575,7 @@ def startProg(globs):
         PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# Bed file:", pad) + globs['bed-file']);
     elif globs['aln-dir']:
         PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# Alignment directory:", pad) + globs['aln-dir']);
+        PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# Files read at once (-readers):", pad) + str(globs['num-readers']));
 
     PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# Tree/rate file (mod file from PHAST):", pad) + globs['mod-file']);
     PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# Tree read from mod file:", pad) + globs['tree-string']);
@@ -505,10 +610,17 @@ def startProg(globs):
     PC.printWrite(globs['logfilename'], globs['log-v'], "# CLUSTER OPTIONS:");    
     PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# Option", pad) + PC.spacedOut("Setting", opt_pad));
 
-    PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# Partition(s)", pad) + globs['partition']);
+    if globs['local']:
+        PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# Run locally (--local)", pad) + str(globs['local-cores']) + " cores, " + str(max(1, globs['local-cores'] // globs['procs-per-job'])) + " batches at a time");
+    if globs['array']:
+        PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# SLURM job arrays (--array)", pad) + "Up to " + str(globs['num-jobs']) + " tasks at a time");
+    if globs['partition']:
+        PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# Partition(s)", pad) + globs['partition']);
     PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# Number of nodes", pad) + globs['num-nodes']);
     PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# Max mem per job (gb)", pad) + globs['mem']);
     PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# Time per job", pad) + globs['time']); 
+    if globs['runtime-model-file']:
+        PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# Runtime model", pad) + globs['runtime-model-file']);
     # Cluster options
     #######################
 
@@ -569,9 +681,15 @@ def startProg(globs):
 
     PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# Loci per batch (-batch)", pad) + 
                 PC.spacedOut(str(globs['batch-size']), opt_pad) + 
-                "PhyloAcc will run this many loci in a single command.");
+                "PhyloAcc will run about this many loci in a single command, balanced by predicted runtime.");
     # Batch size
 
+    if globs['batch-time']:
+        PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# Batch runtime (-batch-time)", pad) + 
+                    PC.spacedOut(str(globs['batch-time']), opt_pad) + 
+                    "Loci will be split into batches with about this many minutes of predicted runtime each.");
+    # Target batch runtime
+
     PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# Current processes (-n)", pad) + 
                 PC.spacedOut(str(globs['num-procs']), opt_pad) + 
                 "This interface will use this many processes.");
@@ -589,7 +707,7 @@ def startProg(globs):
 
     if globs['plot']:
         plot_status = "True";
-        plot_status_str = "An HTML file summarizing the input data will be written to " + globs['html-file'];
+        plot_status_str = "An HTML file summarizing the input data will be written to " + globs['html-file'] + ". Plots are binned above " + str(globs['plot-bin-loci']) + " loci (-plot-bin).";
     else:
         plot_status = "False";
         plot_status_str = "No HTML summary file will be generated.";
@@ -617,6 +735,16 @@ def startProg(globs):
                     "The species tree but with branch lengths in coalescent units.");
     # Report the -l option
 
+    if globs['cache-dir']:
+        PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# -cache", pad) +
+                    PC.spacedOut(globs['cache-dir'], opt_pad) + 
+                    "Alignment stats and sCF of unchanged loci will be loaded from this cache (max " + str(globs['cache-size']) + " GB).");
+        if globs['clear-cache']:
+            PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# --clearcache", pad) +
+                        PC.spacedOut("True", opt_pad) + 
+                        "All results in the cache will be removed before running.");
+    # Report the cache options
+
     ####################
 
     if globs['overwrite']:
@@ -652,6 +780,21 @@ def startProg(globs):
             PC.spacedOut("True", opt_pad) + 
             "Writing out a file with quartet site counts.");
 
+    if globs['profile']:
+        PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# --profile", pad) + 
+            PC.spacedOut("True", opt_pad) + 
+            "Profiling each step and writing the profiles to " + globs['prof-dir'] + ".");
+
+    if globs['stats-engine'] == "python":
+        PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# --pystats", pad) + 
+            PC.spacedOut("True", opt_pad) + 
+            "Calculating alignment stats and sCF with the pure Python site loops instead of numpy.");
+
+    if not globs['fuse-stats']:
+        PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# --nofuse", pad) + 
+            PC.spacedOut("True", opt_pad) + 
+            "Calculating alignment stats and sCF in separate passes over the loci.");
+
     if globs['norun']:
         PC.printWrite(globs['logfilename'], globs['log-v'], PC.spacedOut("# --norun", pad) + 
                     PC.spacedOut("True", opt_pad) + 
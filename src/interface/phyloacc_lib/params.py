@@ -72,7 +72,8 @@ def init():
         # Run mode option
 
         'plot' : False,
-        # Option to output plots/html
+        'plot-bin-loci' : 50000,
+        # Option to output plots/html, and the number of loci above which plots are binned
 
         'theta' : False,
         'coal-tree-file' : False,
@@ -82,16 +83,19 @@ def init():
         'tree-string' : False,
         'tree-dict' : False,
         'labeled-tree' : False,
+        'tree-index' : False,
         'scf-labeled-tree' : False,
         'root-node' : False,
         'tree-tips' : False,
         # Tree variables
 
         'in-seqs' : {},
+        'in-seqs-file' : False,
         'in-bed' : {},
         'locus-ids' : [],
         'alns' : {},
         'aln-stats' : {},
+        'aln-store' : False,
         'num-loci' : False,
         # Sequence variables
 
@@ -142,10 +146,25 @@ def init():
         'gt-loci' : 0,
         'st-batches' : [],
         'gt-batches' : [],
+        'batch-costs' : {},
         # Batch variables
 
+        'batch-time' : False,
+        'cost-model' : { 'st' : { 'locus' : 1e-3, 'site' : 5e-6, 'informative-site' : 2e-5 },
+                         'gt' : { 'locus' : 1e-2, 'site' : 5e-5, 'informative-site' : 2e-4 } },
+        'batch-costs-file' : "",
+        'batch-mems' : {},
+        'runtime-model-file' : False,
+        'mem-model' : {},
+        # Batch planning: the target predicted runtime per batch in minutes (-batch-time) and the coefficients used to
+        # predict the runtime of each locus, in seconds per MCMC step for each model (see batch.predictCost). The
+        # coefficients and a model of memory per batch can be replaced by a model fit by phyloacc_post.py (-runtime-model)
+
         'num-procs' : 1,
         # Number of procs for this script to use
+
+        'num-readers' : 8,
+        # Number of files to read at once from an alignment directory (-d)
         
         'num-jobs' : 1000,
         'procs-per-job' : 1,
@@ -156,7 +175,30 @@ def init():
         'num-nodes' : "1",
         'mem' : "4",
         'time' : "1:00:00",
-        # Cluster options
+        'mem-set' : False,
+        'time-set' : False,
+        'local' : False,
+        'local-cores' : 1,
+        'local-failed' : [],
+        # Run the batches on this machine with this many cores (--local, -cores) and the batches that failed
+        'job-retries' : 2,
+        'retry-scale' : 1.5,
+        # Cluster options. The -set keys are True when the user set -mem or -time, so they aren't replaced from the runtime model.
+        # Failed batches are run again up to job-retries times with their time and memory multiplied by retry-scale each time.
+
+        'stats-engine' : "numpy",
+        # The engine used to calculate alignment stats and sCF: numpy or python (--pystats)
+
+        'fuse-stats' : True,
+        # Whether to calculate alignment stats and sCF in a single pass in adaptive mode (off with --nofuse)
+
+        'cache-dir' : False,
+        'cache-size' : 5,
+        'clear-cache' : False,
+        'cache-db' : False,
+        'cache-hits' : 0,
+        # Result cache options: the cache directory (-cache), the max size in GB (-cache-size), --clearcache,
+        # the open cache database, and the number of loci loaded from the cache in the last pool pass
 
         'aln-pool' : False,
         'scf-pool' : False,
@@ -196,8 +238,18 @@ def init():
         # Plot and HTML summary files
 
         'status-script' : 'slurm_status.py',
+        'status-interval' : 30,
+        # The script snakemake uses to check the status of jobs, copied to the snakemake directory, and the least
+        # number of seconds between the sacct queries it runs for all jobs
+
+        'array' : False,
+        'array-script' : 'slurm_array.py',
+        'max-array-size' : 1000,
+        # Submit the batches as SLURM job arrays with this script instead of with snakemake (--array), with at most
+        # this many tasks per array to stay under SLURM's default MaxArraySize
+
         'smk-cmd' : '',
-        # The final snakemake command to report
+        # The final snakemake command to report, or the command to submit the job arrays with --array
 
         'label-tree' : False,
         'info' : False,
@@ -220,6 +272,16 @@ def init():
         'stepstarttime' : 0,
         'pids' : "",
         'psutil' : False,
+        'telemetry-file' : False,
+        'step-usage' : {},
+        # The file to write a JSON line for each step to, and the resources used at the start of each step
+        'profile' : False,
+        'prof-dir' : False,
+        'prof-worker-dir' : False,
+        'prof-stages' : [],
+        'prof-top' : 15,
+        # With --profile, the directory for the profiles of each step and of the pool workers, the steps profiled so far,
+        # and the number of functions to report from each profile
         'qstats' : False,
         'norun' : False,
         'debug' : False,
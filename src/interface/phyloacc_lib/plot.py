@@ -7,26 +7,34 @@
 import os
 import shutil
 import re
+import multiprocessing as mp
 import phyloacc_lib.core as PC
 import phyloacc_lib.tree as TREE
+import phyloacc_lib.combine as COMBINE
 import phyloacc_lib.templates_2 as TEMPLATES
 import phyloacc_lib.templates_post as TEMPLATES_POST
 import numpy as np
 import matplotlib as mpl
+mpl.use("Agg");
+# Draw the figures off-screen, which doesn't need a display and is faster
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D as lines
 import matplotlib.patches as mpatches
 
-from Bio import Phylo
 from io import StringIO
 
 #############################################################################
 
-def genPlots(globs):
+GRID_BINS = 100;
+# The number of bins along each axis of the 2D histograms drawn instead of scatter plots for large data sets
 
-    step = "Generating summary plots";
-    step_start_time = PC.report_step(globs, step, False, "In progress...");
-    # Status updated
+CHUNK_LOCI = 10000;
+# The number of loci to bin at once for large data sets
+
+#############################################################################
+
+def setTheme():
+# Global theme settings for all matplotlib figures, set in each process that draws figures
 
     mpl.rcParams["axes.spines.right"] = False;
     mpl.rcParams["axes.spines.top"] = False;
@@ -48,38 +56,164 @@ def genPlots(globs):
     mpl.rcParams['ytick.color'] = "#595959";
     mpl.rcParams['ytick.major.size'] = 6;
     mpl.rcParams['ytick.major.width'] = 1.5;
-    # Global theme settings for all matplotlib figures following
-    
-    ####################
 
-    st_file = os.path.join(globs['plot-dir'], globs['input-tree-plot-file']);
-    # The file to save the species tree figure
+#############################################################################
 
-    branch_cols = PC.coreCol(pal="wilke", numcol=3);
-    # The colors for the target, conserved, and outgroup branches
+def drawHist(plot_file, values, color, xlabel, xlim=False, bins="sturges", weights=None):
+# Draws a histogram of the number of loci for one value per locus. For binned data, values are the left edges of the
+# bins, bins are all the edges, and weights are the counts from binValues.
+    fig = plt.figure(figsize=(8,6));
+    plt.hist(values, color=color, bins=bins, weights=weights, edgecolor="#999999");
+    if xlim:
+        plt.xlim(xlim);
+    plt.xlabel(xlabel);
+    plt.ylabel("# loci");
 
-    num_spec = len(globs['tree-tips']);
-    # The number of species in the input free, to adjust height of figure
+    fig.savefig(plot_file, dpi=100);
+    plt.close(fig);
 
-    tree_str = TREE.addBranchLength(globs['labeled-tree'], globs['tree-dict'], no_label=True);
-    #print(tree_str);
-    # Re-add branch lengths and remove labels to the input tree for plotting
+#############################################################################
+
+def chunkRange(chunks):
+# Gets the number of finite values and their min and max from an iterator over chunks of values
+    num_values, lo, hi = 0, np.inf, -np.inf;
+    for chunk in chunks:
+        chunk = chunk[np.isfinite(chunk)];
+        if len(chunk):
+            num_values += len(chunk);
+            lo, hi = min(lo, chunk.min()), max(hi, chunk.max());
+    if num_values == 0:
+        lo, hi = 0.0, 1.0;
+    elif lo == hi:
+        lo, hi = lo - 0.5, hi + 0.5;
+    # The same range numpy uses for empty or constant values
+    return num_values, lo, hi;
+
+#############################################################################
+
+def binValues(chunks):
+# Counts values into fixed bins without keeping all of them at once. chunks is a function that returns an iterator over
+# chunks of values, since the values are read twice: once for their range and once to count them. The bins are the same
+# as bins="sturges" in matplotlib. Non-finite values are skipped. Returns the bin edges and the count in each bin.
+
+    num_values, lo, hi = chunkRange(chunks());
+    num_bins = int(np.ceil(np.log2(num_values) + 1)) if num_values else 1;
+    edges = np.linspace(lo, hi, num_bins + 1);
+
+    counts = np.zeros(num_bins, dtype=np.int64);
+    for chunk in chunks():
+        counts += np.histogram(chunk[np.isfinite(chunk)], bins=edges)[0];
+
+    return edges, counts;
+
+#############################################################################
+
+def binPairs(chunks, fit=False):
+# Counts (x, y) pairs into a GRID_BINS x GRID_BINS grid without keeping all of them at once. chunks is a function that
+# returns an iterator over (<x values>, <y values>) chunks. Pairs with a non-finite value are skipped. With fit, the
+# regression line is fit from running sums. Returns the x and y bin edges, the count in each bin, and the line as
+# (<slope>, <intercept>) or False.
+
+    def finitePairs():
+        for xs, ys in chunks():
+            finite = np.isfinite(xs) & np.isfinite(ys);
+            yield xs[finite], ys[finite];
+    # Only pairs with both values finite are counted
+
+    num_pairs, x_lo, x_hi = chunkRange(xs for xs, ys in finitePairs());
+    num_pairs, y_lo, y_hi = chunkRange(ys for xs, ys in finitePairs());
+    xedges, yedges = np.linspace(x_lo, x_hi, GRID_BINS + 1), np.linspace(y_lo, y_hi, GRID_BINS + 1);
+
+    counts = np.zeros((GRID_BINS, GRID_BINS), dtype=np.int64);
+    sums = np.zeros(4);
+    for xs, ys in finitePairs():
+        counts += np.histogram2d(xs, ys, bins=[xedges, yedges])[0].astype(np.int64);
+        sums += [xs.sum(), ys.sum(), (xs * xs).sum(), (xs * ys).sum()];
+    # sums -- x, y, x^2, xy
+
+    line = False;
+    if fit and num_pairs > 1:
+        sum_x, sum_y, sum_xx, sum_xy = sums;
+        denom = num_pairs * sum_xx - sum_x * sum_x;
+        if denom != 0:
+            slope = (num_pairs * sum_xy - sum_x * sum_y) / denom;
+            line = (slope, (sum_y - slope * sum_x) / num_pairs);
+    # Least squares fit of y = slope * x + intercept
+
+    return xedges, yedges, counts, line;
+
+#############################################################################
+
+#############################################################################
+
+def drawGuides(x_ends, line=False, cutoffs=False):
+# Adds a dashed regression line, given as (<slope>, <intercept>), between the x values in x_ends, and dashed lines at
+# the (x, y) cutoffs
+    if line:
+        x_ends = np.asarray(x_ends, dtype=np.float64);
+        plt.plot(x_ends, np.polyval(line, x_ends), color="#333333", linestyle='dashed', dashes=(5, 20));
+    # The regression line is straight, so only its ends are needed instead of a point for every locus
+
+    if cutoffs:
+        plt.axvline(x=cutoffs[0], color='#d3d3d3', linestyle='--');
+        plt.axhline(y=cutoffs[1], color='#d3d3d3', linestyle='--');
+
+#############################################################################
 
-    handle = StringIO(tree_str);
-    tree = Phylo.read(handle, "newick");
+def drawScatter(plot_file, xs, ys, color, alpha, xlabel, ylabel, fit=False, cutoffs=False):
+# Draws a scatter plot, with a dashed regression line with fit and dashed lines at the (x, y) cutoffs with cutoffs
+    fig = plt.figure(figsize=(8,6));
+
+    if fit:
+        drawGuides([np.min(xs), np.max(xs)], line=tuple(np.polyfit(xs, ys, 1)));
+
+    plt.scatter(xs, ys, color=color, alpha=alpha);
+    drawGuides(False, cutoffs=cutoffs);
+
+    plt.xlabel(xlabel);
+    plt.ylabel(ylabel);
+
+    fig.savefig(plot_file, dpi=100);
+    plt.close(fig);
+
+#############################################################################
+
+def drawGrid(plot_file, xedges, yedges, counts, color, xlabel, ylabel, line=False, cutoffs=False):
+# Draws the number of loci in each bin of a 2D histogram from binPairs in place of a scatter plot for large data sets,
+# with a dashed regression line, given as (<slope>, <intercept>), and dashed lines at the (x, y) cutoffs
+    fig = plt.figure(figsize=(8,6));
+
+    cmap = mpl.colors.LinearSegmentedColormap.from_list("loci", [mpl.colors.to_rgba(color, 0.15), color]);
+    counts = np.ma.masked_equal(counts.T, 0);
+    # Shade bins from light to the full color with the number of loci on a log scale, and leave empty bins blank
+
+    mesh = plt.pcolormesh(xedges, yedges, counts, cmap=cmap, norm=mpl.colors.LogNorm(vmin=1, vmax=max(2, counts.max() if counts.count() else 2)));
+    plt.colorbar(mesh, label="# loci");
+
+    drawGuides([xedges[0], xedges[-1]], line=line, cutoffs=cutoffs);
+
+    plt.xlabel(xlabel);
+    plt.ylabel(ylabel);
+
+    fig.savefig(plot_file, dpi=100);
+    plt.close(fig);
+
+#############################################################################
+
+def drawTree(plot_file, tree_str, num_spec, tip_colors=False, legend=False, show_confidence=True):
+# Draws a tree with Bio.Phylo. tip_colors is a dict of <tip> : <color> and legend a list of (<label>, <color>)
+
+    from Bio import Phylo;
+    # Only the tree figures of the interface need Bio
+
+    tree = Phylo.read(StringIO(tree_str), "newick");
     # Parse the tree string with Bio
-    
-    for clade in tree.get_terminals():
-        if clade.name in globs['targets']:
-            clade.color = branch_cols[0];
-            target_lg = lines([0], [0], label="Targets", color = branch_cols[0]);
-        elif clade.name in globs['conserved']:
-            clade.color = branch_cols[1];
-            conserve_lg = lines([0], [0], label="Conserved", color = branch_cols[1]);
-        elif clade.name in globs['outgroup']:
-            clade.color = branch_cols[2];
-            outgroup_lg = lines([0], [0], label="Outgroup", color = branch_cols[2]);
-    # Color the tip branches based on their input category and specify their legend entries
+
+    if tip_colors:
+        for clade in tree.get_terminals():
+            if clade.name in tip_colors:
+                clade.color = tip_colors[clade.name];
+    # Color the tip branches
 
     fig = plt.figure(figsize=(num_spec/2.54, 25.4/2.54));
     # Specify the plot size depending on the number of species
@@ -89,135 +223,133 @@ def genPlots(globs):
     axes.spines['left'].set_visible(False);
     # Set the axes of the tree figure
 
-    Phylo.draw(tree, axes=axes, show_confidence=False, do_show=False);
+    Phylo.draw(tree, axes=axes, show_confidence=show_confidence, do_show=False);
     # Draw the tree
 
-    plt.legend(loc='upper left', handles=[target_lg, conserve_lg, outgroup_lg]);
+    if legend:
+        plt.legend(loc='upper left', handles=[ lines([0], [0], label=label, color=color) for label, color in legend ]);
     # Add the legend
 
-    plt.savefig(st_file, dpi=100, bbox_inches='tight');
-    # Save the figure
+    fig.savefig(plot_file, dpi=100, bbox_inches='tight');
+    plt.close(fig);
+    # Save the figure and free it
 
-    # Species tree
-    ####################
-
-    aln_list = [ aln for aln in globs['aln-stats'] ];
-    # A single list of alignment IDs for consistency between dictionary lookups
-
-    aln_len_hist_file = os.path.join(globs['plot-dir'], globs['aln-len-plot-file']);
-    aln_lens = [ globs['aln-stats'][aln]['length'] for aln in aln_list ];
-    
-    plt.figure(figsize=(8,6));
-    plt.hist(aln_lens, color=PC.coreCol(pal="wilke", numcol=1, offset=1)[0], bins="sturges", edgecolor="#999999");
-    #plt.boxplot(locus_len)
-    plt.xlabel("Alignment length");
-    plt.ylabel("# loci");
-
-    plt.savefig(aln_len_hist_file, dpi=100);
-    # Locus length (hist)
-    ####################
+#############################################################################
 
-    seq_len_hist_file = os.path.join(globs['plot-dir'], globs['seq-len-plot-file']);
-    seq_lens = [ globs['aln-stats'][aln]['avg-nogap-seq-len'] for aln in aln_list ];
-    
-    plt.figure(figsize=(8,6));
-    plt.hist(seq_lens, color=PC.coreCol(pal="wilke", numcol=1, offset=2)[0], bins="sturges", edgecolor="#999999");
-    #plt.boxplot(locus_len)
-    plt.xlabel("Avg. sequence length without gaps (bp)");
-    plt.ylabel("# loci");
+def statChunks(globs, aln_list, keys):
+# Gets the given alignment stats of the loci in aln_list CHUNK_LOCI loci at a time, with NaN for stats that are "NA".
+# Yields an array for one stat, or a tuple of arrays in the same order as keys for more.
+    for i in range(0, len(aln_list), CHUNK_LOCI):
+        cur_stats = [ globs['aln-stats'][aln] for aln in aln_list[i:i+CHUNK_LOCI] ];
+        chunk = tuple( np.array([ np.nan if stats[key] == "NA" else stats[key] for stats in cur_stats ], dtype=np.float64) for key in keys );
+        yield chunk[0] if len(keys) == 1 else chunk;
 
-    plt.savefig(seq_len_hist_file, dpi=100);
-    # Avg. sequence length without gaps (hist)
-    ####################
+#############################################################################
 
-    # var_sites_hist_file = os.path.join(globs['plot-dir'], "variable-sites-hist.png");
-    var_sites = [ globs['aln-stats'][aln]['variable-sites'] for aln in aln_list ];
-    
-    # plt.figure(figsize=(8,6));
-    # plt.hist(var_sites, color=PC.coreCol(pal="wilke", numcol=1)[0], bins="sturges", edgecolor="#999999");
-    # #plt.boxplot(locus_len)
-    # plt.xlabel("# of variable sites");
-    # plt.ylabel("# loci");
+def arrayChunks(*arrays):
+# Splits arrays with one value per locus into chunks of CHUNK_LOCI loci. Yields an array for one array, or a tuple of
+# arrays for more.
+    num_loci = len(arrays[0]);
+    for i in range(0, num_loci, CHUNK_LOCI):
+        chunk = tuple( array[i:i+CHUNK_LOCI] for array in arrays );
+        yield chunk[0] if len(arrays) == 1 else chunk;
 
-    # plt.savefig(var_sites_hist_file);
-    # Variable sites (hist)
-    ####################
+#############################################################################
 
-    inf_sites_hist_file = os.path.join(globs['plot-dir'], globs['inf-sites-plot-file']);
-    inf_sites = [ globs['aln-stats'][aln]['informative-sites'] for aln in aln_list ];
-    
-    plt.figure(figsize=(8,6));
-    plt.hist(inf_sites, color=PC.coreCol(pal="wilke", numcol=1, offset=3)[0], bins="sturges", edgecolor="#999999");
-    #plt.boxplot(locus_len)
-    plt.xlabel("# of informative sites");
-    plt.ylabel("# loci");
+def histTask(plot_file, chunks, color, xlabel, xlim=False, binned=False):
+# Gets the task to draw a histogram of the values from chunks, a function that returns an iterator over chunks of values.
+# With binned, only the count in each bin is sent to be drawn instead of every value.
+    if binned:
+        edges, counts = binValues(chunks);
+        return (drawHist, (plot_file, edges[:-1], color, xlabel, xlim, edges, counts));
+    values = np.concatenate([np.empty(0)] + list(chunks()));
+    return (drawHist, (plot_file, values[np.isfinite(values)], color, xlabel, xlim));
 
-    plt.savefig(inf_sites_hist_file, dpi=100);
-    # Informative sites (hist)
-    ####################
+#############################################################################
 
-    inf_sites_frac_hist_file = os.path.join(globs['plot-dir'], globs['inf-sites-frac-plot-file']);
-    #inf_sites_frac = [ globs['aln-stats'][aln]['informative-sites'] / globs['aln-stats'][aln]['length'] for aln in aln_list ];
-    inf_sites_frac = [ inf_sites[i] / aln_lens[i] for i in range(len(aln_lens)) ];
+def pairTask(plot_file, chunks, color, alpha, xlabel, ylabel, fit=False, cutoffs=False, binned=False):
+# Gets the task to draw the (x, y) pairs from chunks, a function that returns an iterator over (<x values>, <y values>)
+# chunks, as a scatter plot, or with binned as a 2D histogram so only the count in each bin is sent to be drawn
+    if binned:
+        xedges, yedges, counts, line = binPairs(chunks, fit=fit);
+        return (drawGrid, (plot_file, xedges, yedges, counts, color, xlabel, ylabel, line, cutoffs));
+    pairs = list(chunks());
+    xs, ys = np.concatenate([np.empty(0)] + [ cur_xs for cur_xs, cur_ys in pairs ]), np.concatenate([np.empty(0)] + [ cur_ys for cur_xs, cur_ys in pairs ]);
+    finite = np.isfinite(xs) & np.isfinite(ys);
+    return (drawScatter, (plot_file, xs[finite], ys[finite], color, alpha, xlabel, ylabel, fit, cutoffs));
 
-    plt.figure(figsize=(8,6));
-    plt.hist(inf_sites_frac, color=PC.coreCol(pal="wilke", numcol=1, offset=4)[0], bins="sturges", edgecolor="#999999");
-    #plt.boxplot(locus_len)
-    plt.xlim([0, 1]);
-    plt.xlabel("Fraction of sites that are informative");
-    plt.ylabel("# loci");
+#############################################################################
 
-    plt.savefig(inf_sites_frac_hist_file, dpi=100);
-    # Fraction of sites that are informative (hist)
-    ####################
+def drawPlot(task):
+# Draws one figure in a worker process. A task is (<draw function>, <arguments>), with only the values needed for that
+# figure so little is sent to each process
+    setTheme();
+    draw_func, args = task;
+    draw_func(*args);
+    return args[0];
 
-    var_inf_sites_file = os.path.join(globs['plot-dir'], globs['var-inf-sites-plot-file']);
+#############################################################################
 
-    slope, intercept = np.polyfit(var_sites, inf_sites, 1);
-    inf_sites_pred = np.polyval([slope, intercept], var_sites);
+def renderPlots(globs, tasks):
+# Draws the figures in parallel with -n processes. Each figure is independent, so the slowest ones (the trees) are
+# given first and the rest are spread over the other processes.
 
-    plt.figure(figsize=(8,6));
-    plt.plot(var_sites, inf_sites_pred, color="#333333", linestyle='dashed', dashes=(5, 20));
-    plt.scatter(var_sites, inf_sites, color=PC.coreCol(pal="wilke", numcol=1, offset=5)[0], alpha=0.25);
-    plt.xlabel("# of variable sites");
-    plt.ylabel("# of informative sites");
+    num_procs = min(globs['num-procs'], len(tasks));
+    if num_procs > 1:
+        with mp.Pool(processes=num_procs) as pool:
+            pool.map(drawPlot, tasks, chunksize=1);
+    else:
+        for task in tasks:
+            drawPlot(task);
 
-    plt.savefig(var_inf_sites_file, dpi=100);
-    
-    # Variable sites vs. informative sites (scatter w regression)
-    ####################
+#############################################################################
 
-    if globs['run-mode'] == 'adaptive':
-        avg_scf_hist_file = os.path.join(globs['plot-dir'], globs['avg-scf-hist-file']);
+def genPlots(globs):
 
-        avg_scf = [ globs['aln-stats'][aln]['node-scf-avg'] for aln in aln_list if globs['aln-stats'][aln]['node-scf-avg'] != "NA" ];
+    step = "Generating summary plots";
+    step_start_time = PC.report_step(globs, step, False, "In progress...");
+    # Status updated
 
-        plt.figure(figsize=(8,6));
-        plt.hist(avg_scf, color=PC.coreCol(pal="wilke", numcol=1, offset=6)[0], bins="sturges", edgecolor="#999999");
-        plt.xlim([0, 1]);
-        plt.xlabel("Avg. sCF across all branches per locus");
-        plt.ylabel("# loci");
+    tasks = [];
+    # The figures to draw as (<draw function>, <arguments>)
 
-        plt.savefig(avg_scf_hist_file, dpi=100);        
+    ####################
 
-        # Avg. scf per locus (hist)
-        ####################
+    st_file = os.path.join(globs['plot-dir'], globs['input-tree-plot-file']);
+    # The file to save the species tree figure
 
-        low_scf_hist_file = os.path.join(globs['plot-dir'], globs['low-scf-hist-file']);
+    branch_cols = PC.coreCol(pal="wilke", numcol=3);
+    # The colors for the target, conserved, and outgroup branches
 
-        perc_low_scf = [ globs['aln-stats'][aln]['perc-low-scf-nodes'] for aln in aln_list if globs['aln-stats'][aln]['perc-low-scf-nodes'] != "NA" ];
+    num_spec = len(globs['tree-tips']);
+    # The number of species in the input free, to adjust height of figure
 
-        plt.figure(figsize=(8,6));
-        plt.hist(perc_low_scf, color=PC.coreCol(pal="wilke", numcol=1, offset=7)[0], bins="sturges", edgecolor="#999999");
-        plt.xlim([0, 1]);
-        plt.xlabel("% of branches with sCF below " + str(globs['min-scf']) + " per locus");
-        plt.ylabel("# loci");
+    tree_str = TREE.addBranchLength(globs['labeled-tree'], globs['tree-dict'], no_label=True);
+    # Re-add branch lengths and remove labels to the input tree for plotting
 
-        plt.savefig(low_scf_hist_file, dpi=100);   
+    tip_bits = globs['tree-index']['tip-bits'];
+    groups = [('targets', "Targets", branch_cols[0]), ('conserved', "Conserved", branch_cols[1]), ('outgroup', "Outgroup", branch_cols[2])];
+    group_bits = { group : sum(tip_bits[tip] for tip in set(globs[group])) for group, label, color in groups };
+    # The tips in each group as a bitset from the tree index, like the group checks in opt_parse
+
+    tip_colors, legend = {}, [];
+    for tip in globs['tree-index']['tips']:
+        for group, label, color in groups:
+            if tip_bits[tip] & group_bits[group]:
+                tip_colors[tip] = color;
+                break;
+    for group, label, color in groups:
+        if group_bits[group]:
+            legend.append((label, color));
+    # Color the tip branches based on their input category, with targets first if a tip is in more than one,
+    # and specify their legend entries
+
+    tasks.append((drawTree, (st_file, tree_str, num_spec, tip_colors, legend, False)));
 
-        # % of branches with low sCF per locus (hist)
-        ####################
+    # Species tree
+    ####################
 
+    if globs['run-mode'] == 'adaptive':
         scf_tree_file = os.path.join(globs['plot-dir'], globs['scf-tree-plot-file']);
         # The file to save the species tree figure
 
@@ -228,46 +360,66 @@ def genPlots(globs):
         # For every node in the tree, add the averaged scf value over all loci to the label
 
         tree_str = re.sub("<[\d]+>[_]?", "", tree_str);
-        #tree_str = re.sub("<[\d]+>", "", tree_str);
+        # Remove the node labels, leaving only the sCF values
 
-        #print(tree_str);
-        # Re-add branch lengths and remove labels to the input tree for plotting
+        tasks.append((drawTree, (scf_tree_file, tree_str, num_spec)));
 
-        handle = StringIO(tree_str);
-        tree = Phylo.read(handle, "newick");
-        # Parse the tree string with Bio
-        
-        # for clade in tree.get_terminals():
-        #     if clade.name in globs['targets']:
-        #         clade.color = branch_cols[0];
-        #         target_lg = lines([0], [0], label="Targets", color = branch_cols[0]);
-        #     elif clade.name in globs['conserved']:
-        #         clade.color = branch_cols[1];
-        #         conserve_lg = lines([0], [0], label="Conserved", color = branch_cols[1]);
-        #     elif clade.name in globs['outgroup']:
-        #         clade.color = branch_cols[2];
-        #         outgroup_lg = lines([0], [0], label="Outgroup", color = branch_cols[2]);
-        # # Color the tip branches based on their input category and specify their legend entries
+        # scf tree (phylo)
+        ####################
 
-        fig = plt.figure(figsize=(num_spec/2.54, 25.4/2.54));
-        # Specify the plot size depending on the number of species
+    aln_list = [ aln for aln in globs['aln-stats'] ];
+    # A single list of alignment IDs for consistency between dictionary lookups
 
-        axes = fig.add_subplot(1, 1, 1);
-        axes.axes.get_yaxis().set_visible(False);
-        axes.spines['left'].set_visible(False);
-        # Set the axes of the tree figure
+    binned = len(aln_list) > globs['plot-bin-loci'];
+    # Above this many loci, the values are counted in bins as they are read and only the counts are drawn
 
-        Phylo.draw(tree, axes=axes, do_show=False);
-        # Draw the tree
+    aln_len_hist_file = os.path.join(globs['plot-dir'], globs['aln-len-plot-file']);
+    aln_lens = lambda: statChunks(globs, aln_list, ['length']);
+    tasks.append(histTask(aln_len_hist_file, aln_lens, PC.coreCol(pal="wilke", numcol=1, offset=1)[0], "Alignment length", binned=binned));
+    # Locus length (hist)
+    ####################
 
-        # plt.legend(loc='upper left', handles=[target_lg, conserve_lg, outgroup_lg]);
-        # Add the legend
+    seq_len_hist_file = os.path.join(globs['plot-dir'], globs['seq-len-plot-file']);
+    seq_lens = lambda: statChunks(globs, aln_list, ['avg-nogap-seq-len']);
+    tasks.append(histTask(seq_len_hist_file, seq_lens, PC.coreCol(pal="wilke", numcol=1, offset=2)[0], "Avg. sequence length without gaps (bp)", binned=binned));
+    # Avg. sequence length without gaps (hist)
+    ####################
 
-        plt.savefig(scf_tree_file, dpi=100, bbox_inches='tight');
-        # Save the figure        
+    # var_sites_hist_file = os.path.join(globs['plot-dir'], "variable-sites-hist.png");
+    # var_sites = lambda: statChunks(globs, aln_list, ['variable-sites']);
+    # tasks.append(histTask(var_sites_hist_file, var_sites, PC.coreCol(pal="wilke", numcol=1)[0], "# of variable sites", binned=binned));
+    # Variable sites (hist)
+    ####################
 
-        #globs['scf-labeled-tree']
-        # scf tree (phylo)
+    inf_sites_hist_file = os.path.join(globs['plot-dir'], globs['inf-sites-plot-file']);
+    inf_sites = lambda: statChunks(globs, aln_list, ['informative-sites']);
+    tasks.append(histTask(inf_sites_hist_file, inf_sites, PC.coreCol(pal="wilke", numcol=1, offset=3)[0], "# of informative sites", binned=binned));
+    # Informative sites (hist)
+    ####################
+
+    inf_sites_frac_hist_file = os.path.join(globs['plot-dir'], globs['inf-sites-frac-plot-file']);
+    inf_sites_frac = lambda: ( cur_inf / cur_lens for cur_lens, cur_inf in statChunks(globs, aln_list, ['length', 'informative-sites']) );
+    tasks.append(histTask(inf_sites_frac_hist_file, inf_sites_frac, PC.coreCol(pal="wilke", numcol=1, offset=4)[0], "Fraction of sites that are informative", xlim=[0, 1], binned=binned));
+    # Fraction of sites that are informative (hist)
+    ####################
+
+    var_inf_sites_file = os.path.join(globs['plot-dir'], globs['var-inf-sites-plot-file']);
+    var_inf_sites = lambda: statChunks(globs, aln_list, ['variable-sites', 'informative-sites']);
+    tasks.append(pairTask(var_inf_sites_file, var_inf_sites, PC.coreCol(pal="wilke", numcol=1, offset=5)[0], 0.25, "# of variable sites", "# of informative sites", fit=True, binned=binned));
+    # Variable sites vs. informative sites (scatter w regression)
+    ####################
+
+    if globs['run-mode'] == 'adaptive':
+        avg_scf_hist_file = os.path.join(globs['plot-dir'], globs['avg-scf-hist-file']);
+        avg_scf = lambda: statChunks(globs, aln_list, ['node-scf-avg']);
+        tasks.append(histTask(avg_scf_hist_file, avg_scf, PC.coreCol(pal="wilke", numcol=1, offset=6)[0], "Avg. sCF across all branches per locus", xlim=[0, 1], binned=binned));
+        # Avg. scf per locus (hist)
+        ####################
+
+        low_scf_hist_file = os.path.join(globs['plot-dir'], globs['low-scf-hist-file']);
+        perc_low_scf = lambda: statChunks(globs, aln_list, ['perc-low-scf-nodes']);
+        tasks.append(histTask(low_scf_hist_file, perc_low_scf, PC.coreCol(pal="wilke", numcol=1, offset=7)[0], "% of branches with sCF below " + str(globs['min-scf']) + " per locus", xlim=[0, 1], binned=binned));
+        # % of branches with low sCF per locus (hist)
         ####################
 
         bl_scf_file = os.path.join(globs['plot-dir'], globs['bl-scf-plot-file']);
@@ -284,20 +436,13 @@ def genPlots(globs):
             scfs.append(globs['scf'][node]['avg-quartet-scf']);
         # Gets the values out of their tables
 
-        slope, intercept = np.polyfit(bls, scfs, 1);
-        scfs_pred = np.polyval([slope, intercept], bls);
-
-        plt.figure(figsize=(8,6));
-        plt.plot(bls, scfs_pred, color="#333333", linestyle='dashed', dashes=(5, 20));
-        plt.scatter(bls, scfs, color=PC.coreCol(numcol=1)[0], alpha=0.5);
-        plt.xlabel("Branch length");
-        plt.ylabel("sCF");
-
-        plt.savefig(bl_scf_file, dpi=100);
-        
-        # Variable sites vs. informative sites (scatter w regression)
+        tasks.append((drawScatter, (bl_scf_file, np.array(bls), np.array(scfs), PC.coreCol(numcol=1)[0], 0.5, "Branch length", "sCF", True)));
+        # Branch length vs. sCF (scatter w regression)
         ####################
 
+    renderPlots(globs, tasks);
+    # Draw all the figures
+
     step_start_time = PC.report_step(globs, step, step_start_time, "Success");
 
 #############################################################################
@@ -331,7 +476,24 @@ def writeHTML(globs):
         coal_tree_comment_end = "";
     else:
         coal_tree_comment_start = "<!-- This block is only displayed when -l is specified";
-        coal_tree_comment_end = "-->";            
+        coal_tree_comment_end = "-->";
+
+    dryrun_note = """Note that this includes the <code>--dryrun</code> option to check for possible errors before submitting jobs. If everything looks good
+                        after running that, feel free to remove the <code>--dryrun</code> option to submit the jobs to your cluster. You may also want to run
+                        this in the background using <a href="https://linuxize.com/post/how-to-use-linux-screen/" target="_blank">screen</a>,
+                        <a href="https://linuxize.com/post/getting-started-with-tmux/" target="_blank">tmux</a> or some other terminal multiplexer
+                        to avoid disruptions due to server disconnects.""";
+
+    if globs['array']:
+        run_with, run_note = "as SLURM job arrays", dryrun_note;
+    elif globs['local']:
+        run_with = "on this machine (--local)";
+        run_note = """This is the command this summary was generated with, which runs the batches after writing it. Batches that already
+                        finished are skipped when it is run again with <code>--overwrite</code>, so that reruns any that failed. Once every batch has finished,
+                        combine the results with <code>phyloacc_post.py -i """ + globs['outdir'] + """</code>.""";
+    else:
+        run_with, run_note = "with Snakemake", dryrun_note;
+    # How the batches are run and the note after the command, depending on --array and --local
 
     with open(globs['html-file'], "w") as htmlfile:
         htmlfile.write(TEMPLATES.htmlSummary().format(
@@ -356,6 +518,8 @@ def writeHTML(globs):
             num_outgroups=str(len(globs['outgroup'])),
             log_file=globs['logfilename'],
             aln_stats_file=globs['alnstatsfile'],
+            run_with=run_with,
+            run_note=run_note,
             snakemake_cmd=globs['smk-cmd'],
             theta_comment_start=theta_comment_start,
             theta_comment_end=theta_comment_end,
@@ -396,146 +560,44 @@ def genPlotsPost(globs):
     step_start_time = PC.report_step(globs, step, False, "In progress...");
     # Status updated
 
-    mpl.rcParams["axes.spines.right"] = False;
-    mpl.rcParams["axes.spines.top"] = False;
-
-    mpl.rcParams["axes.labelsize"] = 16;
-    mpl.rcParams["axes.edgecolor"] = "#595959";
-    mpl.rcParams["axes.linewidth"] = 1.5;
-
-    mpl.rcParams["xtick.labelcolor"] = "#595959";
-    mpl.rcParams["xtick.labelsize"] = 14;
-
-    mpl.rcParams['xtick.color'] = "#595959";
-    mpl.rcParams['xtick.major.size'] = 6;
-    mpl.rcParams['xtick.major.width'] = 1.5;
-
-    mpl.rcParams["ytick.labelcolor"] = "#595959";
-    mpl.rcParams["ytick.labelsize"] = 14;
-
-    mpl.rcParams['ytick.color'] = "#595959";
-    mpl.rcParams['ytick.major.size'] = 6;
-    mpl.rcParams['ytick.major.width'] = 1.5;
-    # Global theme settings for all matplotlib figures following
-    
-    ####################
-
-    # st_file = os.path.join(globs['plot-dir'], globs['input-tree-plot-file']);
-    # # The file to save the species tree figure
-
-    # branch_cols = PC.coreCol(pal="wilke", numcol=3);
-    # # The colors for the target, conserved, and outgroup branches
-
-    # num_spec = len(globs['tree-tips']);
-    # # The number of species in the input free, to adjust height of figure
+    tasks = [];
+    # The figures to draw as (<draw function>, <arguments>)
 
-    # tree_str = TREE.addBranchLength(globs['labeled-tree'], globs['tree-dict'], no_label=True);
-    # #print(tree_str);
-    # # Re-add branch lengths and remove labels to the input tree for plotting
-
-    # handle = StringIO(tree_str);
-    # tree = Phylo.read(handle, "newick");
-    # # Parse the tree string with Bio
-    
-    # for clade in tree.get_terminals():
-    #     if clade.name in globs['targets']:
-    #         clade.color = branch_cols[0];
-    #         target_lg = lines([0], [0], label="Targets", color = branch_cols[0]);
-    #     elif clade.name in globs['conserved']:
-    #         clade.color = branch_cols[1];
-    #         conserve_lg = lines([0], [0], label="Conserved", color = branch_cols[1]);
-    #     elif clade.name in globs['outgroup']:
-    #         clade.color = branch_cols[2];
-    #         outgroup_lg = lines([0], [0], label="Outgroup", color = branch_cols[2]);
-    # # Color the tip branches based on their input category and specify their legend entries
-
-    # fig = plt.figure(figsize=(num_spec/2.54, 25.4/2.54));
-    # # Specify the plot size depending on the number of species
-
-    # axes = fig.add_subplot(1, 1, 1);
-    # axes.axes.get_yaxis().set_visible(False);
-    # axes.spines['left'].set_visible(False);
-    # # Set the axes of the tree figure
-
-    # Phylo.draw(tree, axes=axes, show_confidence=False, do_show=False);
-    # # Draw the tree
-
-    # plt.legend(loc='upper left', handles=[target_lg, conserve_lg, outgroup_lg]);
-    # # Add the legend
-
-    # plt.savefig(st_file, dpi=100, bbox_inches='tight');
-    # # Save the figure
-
-    # Species tree
     ####################
 
-    locus_list = [ locus for locus in globs['locus-stats']['elem_lik'] ];
-    # A single list of alignment IDs for consistency between dictionary lookups
+    locus_list = globs['locus-ids'];
+    # A single list of alignment IDs in the same order as the rows of the likelihood array
 
-    bf1s = [ float(globs['locus-stats']['elem_lik'][locus]['logBF1']) for locus in locus_list ];
-    bf2s = [ float(globs['locus-stats']['elem_lik'][locus]['logBF2']) for locus in locus_list ];
+    bf1s = np.ascontiguousarray(globs['locus-liks'][:, COMBINE.LIK_COLS.index('logBF1')]);
+    bf2s = np.ascontiguousarray(globs['locus-liks'][:, COMBINE.LIK_COLS.index('logBF2')]);
     # The Bayes factors
 
-    globs['accelerated-loci'] = [ locus_list[i] for i in range(len(locus_list)) if bf1s[i] > globs['bf1-cutoff'] and bf2s[i] > globs['bf2-cutoff'] ];
+    globs['accelerated-loci'] = [ locus_list[i] for i in np.nonzero((bf1s > globs['bf1-cutoff']) & (bf2s > globs['bf2-cutoff']))[0] ];
     # Get a list of the accelerated loci
 
     ####################
 
-    bf1_dist_file = os.path.join(globs['plot-dir'], globs['bf1-dist-file']);
-    
-    #bf1s = [ 0.0 if bf1 > 500 or bf1 < -500 else bf1 for bf1 in bf1s ];
-    
-    plt.figure(figsize=(8,6));
-    plt.hist(bf1s, color=PC.coreCol(pal="wilke", numcol=1, offset=1)[0], bins="sturges", edgecolor="#999999");
-    #plt.boxplot(locus_len)
-    plt.xlabel("log BF1");
-    plt.ylabel("# loci");
-
-    plt.savefig(bf1_dist_file, dpi=100);
+    binned = len(locus_list) > globs['plot-bin-loci'];
+    # Above this many loci, the values are counted in bins and only the counts are drawn
 
+    bf1_dist_file = os.path.join(globs['plot-dir'], globs['bf1-dist-file']);
+    tasks.append(histTask(bf1_dist_file, lambda: arrayChunks(bf1s), PC.coreCol(pal="wilke", numcol=1, offset=1)[0], "log BF1", binned=binned));
     # BF1 (hist)
     ####################
 
     bf2_dist_file = os.path.join(globs['plot-dir'], globs['bf2-dist-file']);
-    
-    #bf2s = [ 0.0 if bf2 > 500 or bf2 < -500 else bf2 for bf2 in bf2s ];
-    
-    plt.figure(figsize=(8,6));
-    plt.hist(bf2s, color=PC.coreCol(pal="wilke", numcol=1, offset=2)[0], bins="sturges", edgecolor="#999999");
-    #plt.boxplot(locus_len)
-    plt.xlabel("log BF2");
-    plt.ylabel("# loci");
-
-    plt.savefig(bf2_dist_file, dpi=100);
-    
+    tasks.append(histTask(bf2_dist_file, lambda: arrayChunks(bf2s), PC.coreCol(pal="wilke", numcol=1, offset=2)[0], "log BF2", binned=binned));
     # BF2 (hist)
     ####################
 
     bf1_bf2_file = os.path.join(globs['plot-dir'], globs['bf1-bf2-plot-file']);
-
-    slope, intercept = np.polyfit(bf1s, bf2s, 1);
-    bf2s_pred = np.polyval([slope, intercept], bf1s);
-
-    bf1s_filtered = [ bf1s[i] for i in range(len(locus_list)) if bf1s[i] < 20 and bf1s[i] > -5 and bf2s[i] > -2 and bf2s[i] < 50 ]
-    bf2s_filtered = [ bf2s[i] for i in range(len(locus_list)) if bf1s[i] < 20 and bf1s[i] > -5 and bf2s[i] > -2 and bf2s[i] < 50 ]
-
-    plt.figure(figsize=(8,6));
-    #plt.plot(bf1s, bf2s_pred, color="#333333", linestyle='dashed', dashes=(5, 20));
-    plt.scatter(bf1s, bf2s, color=PC.coreCol(pal="wilke", numcol=1, offset=5)[0], alpha=0.25);
-    plt.axvline(x=globs['bf1-cutoff'], color='#d3d3d3', linestyle='--')
-    plt.axhline(y=globs['bf2-cutoff'], color='#d3d3d3', linestyle='--')
-    plt.xlabel("log BF1");
-    plt.ylabel("log BF2");
-
-    plt.savefig(bf1_bf2_file, dpi=100);
-
-    # for i in range(len(locus_list)):
-    #     if bf1s[i] > 10 and bf2s[i] > 1:
-    #         print(locus_list[i]);
-
-    # BF1 vs. BF2 (scatter w regression)
+    tasks.append(pairTask(bf1_bf2_file, lambda: arrayChunks(bf1s, bf2s), PC.coreCol(pal="wilke", numcol=1, offset=5)[0], 0.25, "log BF1", "log BF2", cutoffs=(globs['bf1-cutoff'], globs['bf2-cutoff']), binned=binned));
+    # BF1 vs. BF2 (scatter w cutoffs)
     ####################
 
+    renderPlots(globs, tasks);
+    # Draw all the figures
+
     step_start_time = PC.report_step(globs, step, step_start_time, "Success");
     return globs;
 
@@ -778,7 +840,7 @@ def writeHTMLPost(globs):
             num_batches_complete_gt=str(len(globs['complete-batches-gt'])),
             num_batches_incomplete_st=str(len(globs['incomplete-batches-st'])),
             num_batches_incomplete_gt=str(len(globs['incomplete-batches-gt'])),
-            total_loci=str(len(globs['locus-stats']['elem_lik'])),
+            total_loci=str(len(globs['locus-ids'])),
             accelerated_loci=str(len(globs['accelerated-loci'])),
             batch_size=str(globs['batch-size']),
             procs_per_batch=str(globs['procs-per-batch']),
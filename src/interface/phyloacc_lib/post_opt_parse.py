@@ -63,9 +63,11 @@ def optParse(globs):
 
     #parser.add_argument("--labeltree", dest="labeltree", help="Simply reads the tree from the input mod file (-m), labels the internal nodes, and exits.", action="store_true", default=False);
     parser.add_argument("--overwrite", dest="ow_flag", help="Set this to overwrite existing files.", action="store_true", default=False);
+    parser.add_argument("--incremental", dest="incremental", help="Set this to add only the batches that finished since the last run of this script to the combined results in the output directory, instead of reading every batch again. Useful for checking on a run in progress. All batches are read again if any that were already added have changed.", action="store_true", default=False);
     # User options
     
     parser.add_argument("--plot", dest="plot_flag", help="Plot some summaries of the results.", action="store_true", default=False);
+    parser.add_argument("-plot-bin", dest="plot_bin_loci", help="With --plot, the number of loci above which histograms are counted in fixed bins and the BF1 vs. BF2 scatter plot is drawn as a 2D histogram instead of one point per locus. Default: 50000.", default=False);
     parser.add_argument("--info", dest="info_flag", help="Print some meta information about the program and exit. No other options required.", action="store_true", default=False);
     #parser.add_argument("--dryrun", dest="dryrun", help="With all options provided, set this to run through the whole pseudo-it pipeline without executing external commands.", action="store_true", default=False);
     parser.add_argument("--version", dest="version_flag", help="Simply print the version and exit. Can also be called as '-version', '-v', or '--v'", action="store_true", default=False);
@@ -138,6 +140,11 @@ def optParse(globs):
             globs['procs-per-batch'] = line.strip().replace("# Processes per job (-p)", "");
             globs['procs-per-batch'] = list(filter(None, globs['procs-per-batch'].split(" ")))[0];
 
+        for opt in ['mcmc', 'chain']:
+            if line.startswith("# -" + opt + ":"):
+                globs[opt] = list(filter(None, line.strip().replace("# -" + opt + ":", "").split(" ")))[0];
+        # The MCMC options for the runtime model
+
     try:
         globs['tree-dict'], globs['labeled-tree'], globs['root-node'] = TREE.treeParse(globs['tree-string']);
         globs['tree-tips'] = [ n for n in globs['tree-dict'] if globs['tree-dict'][n][2] == "tip" ];
@@ -149,8 +156,9 @@ def optParse(globs):
     ####################
 
     globs['phyloacc-out-dir'] = os.path.join(globs['interface-run-dir'], "phyloacc-job-files", "phyloacc-output");
+    globs['batch-costs-file'] = os.path.join(globs['interface-run-dir'], "phyloacc-job-files", "cfgs", "predicted-batch-costs.tsv");
     
-    # The directory with all the PhyloAcc output files
+    # The directory with all the PhyloAcc output files and the predicted costs of each batch from the interface
     ####################
 
     if not args.out_dest:
@@ -158,13 +166,25 @@ def optParse(globs):
     else:
         globs['outdir'] = args.out_dest;
 
-    if not globs['overwrite'] and os.path.exists(globs['outdir']):
+    if args.incremental:
+        globs['incremental'] = True;
+    # Only add new batches to the results in an existing output directory
+
+    if not globs['overwrite'] and not globs['incremental'] and os.path.exists(globs['outdir']):
         CORE.errorOut("OP9", "Output directory already exists: " + globs['outdir'] + ". Specify new directory name OR set --overwrite to overwrite all files in that directory.", globs);
 
     if not os.path.isdir(globs['outdir']) and not globs['norun']:
         os.makedirs(globs['outdir']);
     # Main output dir
 
+    globs['runtime-model-file'] = os.path.join(globs['outdir'], globs['runtime-model-file']);
+    globs['store-dir'] = os.path.join(globs['outdir'], globs['store-dir']);
+    globs['manifest-file'] = os.path.join(globs['outdir'], globs['manifest-file']);
+    globs['telemetry-file'] = os.path.join(globs['outdir'], "telemetry.jsonl");
+    # The runtime model fit from the batch runtimes for the next run of the interface, the directory for the
+    # results as NumPy arrays, the list of batches already in the results, and the JSON lines of the resources used
+    # by each step
+
     ####################
 
     if args.plot_flag:
@@ -176,6 +196,12 @@ def optParse(globs):
 
         globs['html-file'] = os.path.join(globs['interface-run-dir'], globs['html-file']);
         # HTML directory
+
+        if args.plot_bin_loci:
+            if not CORE.isPosInt(args.plot_bin_loci):
+                CORE.errorOut("OP21", "The number of loci above which plots are binned (-plot-bin) must be a positive integer.", globs);
+            globs['plot-bin-loci'] = int(args.plot_bin_loci);
+        # Binned plots for large data sets
     # Parse the --plot option
 
     ####################
@@ -236,7 +262,7 @@ def startProg(globs):
 
     if globs['plot']:
         plot_status = "True";
-        plot_status_str = "An HTML file summarizing the results will be written to " + globs['html-file'];
+        plot_status_str = "An HTML file summarizing the results will be written to " + globs['html-file'] + ". Plots are binned above " + str(globs['plot-bin-loci']) + " loci (-plot-bin).";
     else:
         plot_status = "False";
         plot_status_str = "No HTML summary file will be generated.";
@@ -258,6 +284,12 @@ def startProg(globs):
                     "PhyloAcc_post will OVERWRITE the existing files in the specified output directory.");
     # Reporting the overwrite option.
 
+    if globs['incremental']:
+        CORE.printWrite(globs['logfilename'], globs['log-v'], CORE.spacedOut("# --incremental", pad) +
+                    CORE.spacedOut("True", opt_pad) + 
+                    "Only batches that finished since the last run will be added to the results in the output directory.");
+    # Reporting the incremental option.
+
     ####################
 
     if not globs['quiet']:
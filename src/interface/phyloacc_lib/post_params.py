@@ -49,8 +49,10 @@ def init():
         'bf1-cutoff' : 5,
         'bf2-cutoff' : 5,
 
-        'locus-stats' : {},
+        'locus-ids' : [],
+        'locus-liks' : False,
         'accelerated-loci' : [],
+        # The ID of every finished locus and its likelihoods and Bayes factors (combine.LIK_COLS) as an array with one row per locus
 
         'complete-batches' : [],
         'complete-batches-st' : [],
@@ -63,6 +65,19 @@ def init():
         'batch-size' : 0,
         'procs-per-batch' : 0,
         'batch-runtimes' : [],
+        'batch-resources' : {},
+        'batch-costs-file' : False,
+        'runtime-model-file' : 'runtime-model.json',
+        'store-dir' : 'combined-results',
+        'manifest-file' : 'combined-batches.json',
+        'incremental' : False,
+        'mcmc' : 1000,
+        'chain' : 1,
+        # Batch runtimes in minutes from the PhyloAcc logs, and the runtime in seconds and max memory in MB of each batch
+        # for the runtime model: <batch> : (<seconds>, <max memory>). The model is fit with the batch sites in the batch
+        # costs file and the MCMC options read from the interface log. The combined results are also written as NumPy arrays
+        # to store-dir in the output directory, and the batches in them are listed in the manifest file so that only new
+        # batches are read with --incremental
 
         'outdir' : '',
         'run-name' : 'phyloacc-post',
@@ -72,7 +87,8 @@ def init():
         # I/O options
         
         'plot' : False,
-        # Option to output plots/html
+        'plot-bin-loci' : 50000,
+        # Option to output plots/html, and the number of loci above which plots are binned
 
         'tree-string' : False,
         'tree-dict' : False,
@@ -116,6 +132,9 @@ def init():
         'stepstarttime' : 0,
         'pids' : "",
         'psutil' : False,
+        'telemetry-file' : False,
+        'step-usage' : {},
+        # The file to write a JSON line for each step to, and the resources used at the start of each step
         'qstats' : False,
         'norun' : False,
         'debug' : False,
@@ -0,0 +1,157 @@
+#############################################################################
+# Functions to profile the interface with cProfile when --profile is set.
+# Each stage of the pipeline is profiled in the main process and written to
+# <stage>.prof in the profile directory. The per-locus functions run by the
+# pools are profiled in each worker, written to workers/<function>-<pid>.prof
+# when the worker exits, and merged to <function>-workers.prof at the end.
+# Since workers can't write their profiles if the pool is terminated, pools
+# are closed and joined instead with --profile.
+# All profiles can be read with pstats or a viewer like snakeviz.
+#############################################################################
+
+import os
+import pstats
+import cProfile
+import contextlib
+import multiprocessing.util
+import phyloacc_lib.core as PC
+
+#############################################################################
+
+_worker = { 'dir' : False, 'profiles' : {} };
+# The worker directory and the profile of each function run by this process when it is a pool worker:
+# <function name> : <cProfile.Profile>
+
+#############################################################################
+
+def initWorker(worker_dir):
+# The initializer of the pools with --profile: turns on profiling in the worker and writes its profiles when it exits
+    _worker['dir'] = worker_dir;
+    multiprocessing.util.Finalize(None, dumpWorker, exitpriority=10);
+
+#############################################################################
+
+def dumpWorker():
+# Writes the profile of each function run by this worker
+    for func_name, profiler in _worker['profiles'].items():
+        profiler.dump_stats(os.path.join(_worker['dir'], func_name + "-" + str(os.getpid()) + ".prof"));
+    _worker['profiles'] = {};
+
+#############################################################################
+
+def workerCall(func, item):
+# Calls a per-locus function in a pool worker, profiling it if the pool was started with --profile. Without
+# --profile this only adds the check.
+    if not _worker['dir']:
+        return func(item);
+
+    if func.__name__ not in _worker['profiles']:
+        _worker['profiles'][func.__name__] = cProfile.Profile();
+    profiler = _worker['profiles'][func.__name__];
+
+    profiler.enable();
+    try:
+        return func(item);
+    finally:
+        profiler.disable();
+
+#############################################################################
+
+def poolArgs(globs):
+# The extra arguments for mp.Pool to profile the workers with --profile
+    if not globs['profile']:
+        return {};
+    return { 'initializer' : initWorker, 'initargs' : (globs['prof-worker-dir'],) };
+
+#############################################################################
+
+def closePool(globs, pool):
+# With --profile, lets the workers of a pool that is done exit on their own so they write their profiles. Otherwise
+# the pool is left to be terminated at the end of its with block as usual.
+    if globs['profile']:
+        pool.close();
+        pool.join();
+
+#############################################################################
+
+@contextlib.contextmanager
+def profileStage(globs, stage):
+# Profiles the code in the with block in the main process with --profile and writes it to <stage>.prof. Only
+# the main thread is profiled, so time spent in reader or writer threads shows up as waiting on them.
+    if not globs['profile']:
+        yield;
+        return;
+
+    profiler = cProfile.Profile();
+    profiler.enable();
+    try:
+        yield;
+    finally:
+        profiler.disable();
+        profiler.dump_stats(os.path.join(globs['prof-dir'], stage + ".prof"));
+        globs['prof-stages'].append(stage);
+
+#############################################################################
+
+def mergeWorkers(globs):
+# Merges the profiles of all workers for each per-locus function to <function>-workers.prof. Returns a list
+# of the merged profile names.
+
+    for pool in ['aln-pool', 'scf-pool']:
+        closePool(globs, globs[pool]);
+    # Make sure every worker has exited and written its profiles, including those of a pool that wasn't used
+
+    worker_files = {};
+    for filename in sorted(os.listdir(globs['prof-worker-dir'])):
+        if filename.endswith(".prof"):
+            worker_files.setdefault(filename.rsplit("-", 1)[0], []).append(os.path.join(globs['prof-worker-dir'], filename));
+    # Worker profiles are named <function>-<pid>.prof
+
+    merged = [];
+    for func_name, files in sorted(worker_files.items()):
+        stats = pstats.Stats(*files);
+        stats.dump_stats(os.path.join(globs['prof-dir'], func_name + "-workers.prof"));
+        merged.append(func_name + "-workers");
+
+    return merged;
+
+#############################################################################
+
+def funcName(func):
+# A short name for a function in a profile: <file>:<line>(<function>), or the name alone for built-ins
+    filename, line, name = func;
+    if filename == "~":
+        return name;
+    return os.path.basename(filename) + ":" + str(line) + "(" + name + ")";
+
+#############################################################################
+
+def reportProfiles(globs):
+# Merges the worker profiles and writes the functions with the most time in each profile to the log
+
+    step = "Merging worker profiles";
+    step_start_time = PC.report_step(globs, step, False, "In progress...");
+    merged = mergeWorkers(globs);
+    step_start_time = PC.report_step(globs, step, step_start_time, "Success: " + str(len(merged)) + " merged");
+
+    PC.printWrite(globs['logfilename'], globs['log-v'], "# " + "-" * 125);
+    PC.printWrite(globs['logfilename'], globs['log-v'], "# Profiles written to: " + globs['prof-dir']);
+    PC.printWrite(globs['logfilename'], globs['log-v'], "# The " + str(globs['prof-top']) + " functions with the most time spent in the function itself (tottime) in each profile:");
+
+    headers = [("calls", 12), ("tottime (s)", 14), ("cumtime (s)", 14), ("function", 0)];
+
+    for name in globs['prof-stages'] + merged:
+        stats = pstats.Stats(os.path.join(globs['prof-dir'], name + ".prof"));
+        PC.printWrite(globs['logfilename'], globs['log-v'], "#");
+        PC.printWrite(globs['logfilename'], globs['log-v'], "# " + name + ": " + str(round(stats.total_tt, 3)) + " seconds, " + str(stats.total_calls) + " calls");
+        PC.printWrite(globs['logfilename'], globs['log-v'], "#   " + "".join(PC.spacedOut(header, width) for header, width in headers));
+
+        hot = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:globs['prof-top']];
+        for func, (prim_calls, num_calls, tottime, cumtime, callers) in hot:
+            calls = str(num_calls) if num_calls == prim_calls else str(num_calls) + "/" + str(prim_calls);
+            row = [calls, str(round(tottime, 3)), str(round(cumtime, 3)), funcName(func)];
+            PC.printWrite(globs['logfilename'], globs['log-v'], "#   " + "".join(PC.spacedOut(value, width) for value, (header, width) in zip(row, headers)));
+        # Recursive calls are shown as <total calls>/<primitive calls> like pstats does
+    ## End profile loop
+
+#############################################################################
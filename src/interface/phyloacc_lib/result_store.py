@@ -0,0 +1,226 @@
+#############################################################################
+# Functions to write the combined PhyloAcc results from phyloacc_post.py as a
+# directory of NumPy .npy files that can be memory-mapped, and to read them
+# back, as an alternative to parsing the combined text files
+#
+# Layout of the store directory:
+#   index.json            the number of loci, the columns of each table, and the file of every array
+#   <table>.npy           the numeric columns of one output type (e.g. elem_lik, rate_postZ_M0) for every locus,
+#                         one row per locus, stored column by column (Fortran order) so a single column is contiguous
+#   locus-id.npy          the original ID of each locus from the bed file of its batch
+#   batch.npy             the batch of each locus
+#   locus.npy             the number of each locus within its batch, so the key used in the text files is <batch>-<locus>
+#   locus-order.npy       the rows sorted by original locus ID, to find loci by ID with a binary search
+#   batch-index.npy       the first and last + 1 row of each batch: <batch>, <start>, <end>
+#############################################################################
+
+import os
+import json
+import shutil
+
+#############################################################################
+
+STORE_VERSION = 1;
+# Change this whenever the layout of the store changes
+
+#############################################################################
+
+def openStore(store_dir, tables, append=False):
+# Starts a new store in store_dir for the given tables (output types), or adds to the store already there with append.
+# The values of each table are written to a raw file one batch at a time, since the number of loci isn't known until
+# the end. Returns the store as a dict.
+
+    previous = loadStore(store_dir) if append else False;
+    # The loci already in the store, which are kept in front of the new ones
+
+    if not append and os.path.isdir(store_dir):
+        shutil.rmtree(store_dir);
+    tmp_dir = os.path.join(store_dir, "tmp");
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir);
+    os.makedirs(tmp_dir);
+
+    store = { 'dir' : store_dir,
+              'tmp-dir' : tmp_dir,
+              'previous' : previous,
+              'rows' : previous['rows'] if previous else 0,
+              'tables' : { table : list(previous['tables'].get(table, [])) if previous else [] for table in tables },
+              'table-files' : { table : open(os.path.join(tmp_dir, table + ".bin"), "wb") for table in tables },
+              'segments' : { table : [] for table in tables },
+              'id-file' : open(os.path.join(tmp_dir, "locus-id.txt"), "w"),
+              'batch-file' : open(os.path.join(tmp_dir, "batch.bin"), "wb"),
+              'locus-file' : open(os.path.join(tmp_dir, "locus.bin"), "wb"),
+              'batch-index' : [] };
+    # segments -- <table> : [ (<first row>, <number of rows>, <column of each value in the table>) ] for each batch
+
+    return store;
+
+#############################################################################
+
+def addBatch(store, batch, result):
+# Adds the loci of one finished batch from combine.readBatch to the store
+
+    import numpy as np;
+
+    num_rows = len(result['ids']);
+
+    for t, table in enumerate(store['tables']):
+        cur_cols, cur_values = result['columns'][t], result['values'][t];
+
+        for col in cur_cols:
+            if col not in store['tables'][table]:
+                store['tables'][table].append(col);
+        # The columns of each table are all the columns found in any batch
+
+        store['table-files'][table].write(np.ascontiguousarray(cur_values, dtype=np.float64).tobytes());
+        store['segments'][table].append((store['rows'], num_rows, [ store['tables'][table].index(col) for col in cur_cols ]));
+        # Write the values as they are and record which columns they go in
+    ## End table loop
+
+    store['id-file'].write("".join(locus_id + "\n" for locus_id in result['orig-ids']));
+    store['batch-file'].write(np.full(num_rows, int(batch), dtype=np.int32).tobytes());
+    store['locus-file'].write(np.array([ locus_id.split("-")[1] for locus_id in result['ids'] ], dtype=np.int32).tobytes());
+    # The original ID, batch, and locus number of each row
+
+    store['batch-index'].append((int(batch), store['rows'], store['rows'] + num_rows));
+    store['rows'] += num_rows;
+
+#############################################################################
+
+def closeStore(store):
+# Converts the raw table files to .npy files and writes the index of the store
+
+    import numpy as np;
+
+    files = {};
+    num_rows = store['rows'];
+    previous = store['previous'];
+    prev_rows = previous['rows'] if previous else 0;
+
+    if previous and not store['batch-index']:
+        for key in ['id-file', 'batch-file', 'locus-file']:
+            store[key].close();
+        for table_file in store['table-files'].values():
+            table_file.close();
+        shutil.rmtree(store['tmp-dir']);
+        return;
+    # Nothing to do if no batches were added
+
+    for table, cols in store['tables'].items():
+        store['table-files'][table].close();
+        raw_file = store['table-files'][table].name;
+
+        if not cols:
+            continue;
+
+        files[table] = table + ".npy";
+        if num_rows == 0:
+            np.save(os.path.join(store['dir'], files[table]), np.empty((0, len(cols)), order="F"));
+            continue;
+        # A memory-mapped file can't be empty
+
+        table_array = np.lib.format.open_memmap(os.path.join(store['tmp-dir'], files[table]), mode="w+", dtype=np.float64, shape=(num_rows, len(cols)), fortran_order=True);
+        table_array[:] = np.nan;
+        # Columns that aren't in every batch are NaN for the loci of the other batches. The table is written in the
+        # temporary directory first so the previous table can still be read when appending.
+
+        if prev_rows and table in previous:
+            for c, col in enumerate(previous['tables'][table]):
+                table_array[:prev_rows, cols.index(col)] = previous[table][:, c];
+        # Copy the loci already in the store one column at a time
+
+        raw = np.memmap(raw_file, dtype=np.float64, mode="r") if os.path.getsize(raw_file) else np.empty(0);
+        offset = 0;
+        for first_row, seg_rows, col_inds in store['segments'][table]:
+            seg_size = seg_rows * len(col_inds);
+            table_array[first_row:first_row+seg_rows, col_inds] = raw[offset:offset+seg_size].reshape(seg_rows, len(col_inds));
+            offset += seg_size;
+        # Copy each batch into its rows and columns
+
+        table_array.flush();
+        del table_array, raw;
+        os.replace(os.path.join(store['tmp-dir'], files[table]), os.path.join(store['dir'], files[table]));
+    ## End table loop
+
+    for key in ['id-file', 'batch-file', 'locus-file']:
+        store[key].close();
+
+    with open(store['id-file'].name) as idfile:
+        locus_ids = np.array(idfile.read().splitlines(), dtype=str);
+    if len(locus_ids) == 0:
+        locus_ids = np.array([], dtype="U1");
+
+    arrays = { 'locus-id' : locus_ids,
+               'batch' : np.fromfile(store['batch-file'].name, dtype=np.int32),
+               'locus' : np.fromfile(store['locus-file'].name, dtype=np.int32),
+               'batch-index' : np.array(store['batch-index'], dtype=np.int64).reshape(-1, 3) };
+
+    if previous:
+        for name in arrays:
+            arrays[name] = np.concatenate([ np.asarray(previous[name]), arrays[name] ]);
+    # Add the new loci after the ones already in the store
+
+    arrays['locus-order'] = np.argsort(arrays['locus-id'], kind="stable").astype(np.int64);
+
+    for name, array in arrays.items():
+        files[name] = name + ".npy";
+        np.save(os.path.join(store['tmp-dir'], files[name]), array);
+        os.replace(os.path.join(store['tmp-dir'], files[name]), os.path.join(store['dir'], files[name]));
+    # The locus IDs and indices
+
+    shutil.rmtree(store['tmp-dir']);
+
+    with open(os.path.join(store['dir'], "index.json"), "w") as indexfile:
+        json.dump({ 'version' : STORE_VERSION, 'rows' : num_rows, 'tables' : store['tables'], 'files' : files }, indexfile, indent=4);
+
+#############################################################################
+
+def loadStore(store_dir, mmap_mode="r"):
+# Opens a store written by phyloacc_post.py. Every array is memory-mapped by default, so only the parts that are used
+# are read from disk. Returns a dict with the index info and <array name> : <array> for every table and index array.
+
+    import numpy as np;
+
+    with open(os.path.join(store_dir, "index.json")) as indexfile:
+        index = json.load(indexfile);
+
+    if index.get('version') != STORE_VERSION:
+        raise ValueError("The results store is from a different version of phyloacc_post.py: " + store_dir);
+
+    store = { 'rows' : index['rows'], 'tables' : index['tables'] };
+    for name, filename in index['files'].items():
+        store[name] = np.load(os.path.join(store_dir, filename), mmap_mode=mmap_mode);
+
+    return store;
+
+#############################################################################
+
+def column(store, table, col):
+# Gets one column of a table from a loaded store, e.g. column(store, "elem_lik", "logBF1")
+    return store[table][:, store['tables'][table].index(col)];
+
+#############################################################################
+
+def locusRows(store, locus_ids):
+# Gets the rows of the given original locus IDs in a loaded store with a binary search, or -1 for IDs not in the store
+    import numpy as np;
+    locus_ids = np.asarray(locus_ids, dtype=str);
+    sorted_ids = store['locus-id'][store['locus-order']];
+    pos = np.searchsorted(sorted_ids, locus_ids);
+    pos[pos == len(sorted_ids)] = 0;
+    rows = store['locus-order'][pos] if len(sorted_ids) else np.zeros(len(locus_ids), dtype=np.int64);
+    found = sorted_ids[pos] == locus_ids if len(sorted_ids) else np.zeros(len(locus_ids), dtype=bool);
+    return np.where(found, rows, -1);
+
+#############################################################################
+
+def batchRows(store, batch):
+# Gets the slice of rows of one batch in a loaded store
+    import numpy as np;
+    batch_index = store['batch-index'];
+    match = np.nonzero(batch_index[:, 0] == int(batch))[0];
+    if len(match) == 0:
+        return slice(0, 0);
+    return slice(int(batch_index[match[0], 1]), int(batch_index[match[0], 2]));
+
+#############################################################################
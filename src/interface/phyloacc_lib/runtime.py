@@ -0,0 +1,268 @@
+#############################################################################
+# Functions to learn how long PhyloAcc takes on each batch from a finished
+# run (phyloacc_post.py) and to use that model to set batch sizes and cluster
+# resources for the next run of the interface (-runtime-model)
+#############################################################################
+
+import os
+import json
+import math
+import phyloacc_lib.core as PC
+
+#############################################################################
+
+MODEL_VERSION = 1;
+# Change this whenever the format of the model file changes
+
+MIN_BATCHES = 5;
+# The fewest batches of one model type needed to fit every coefficient. With fewer, the coefficients are only scaled.
+
+RESOURCE_MARGIN = 1.5;
+# Time and memory requested for each job are the largest predicted batch times this, since the predictions aren't exact
+
+MIN_JOB_MINUTES = 10;
+MIN_JOB_MEM = 1024;
+# The least time (minutes) and memory (MB) requested for a batch when they are set from the runtime model
+
+COST_FEATURES = ['loci', 'seq-sites', 'seq-informative-sites'];
+COST_COEFS = ['locus', 'site', 'informative-site'];
+# The columns of the batch cost file used to fit the runtime model and the matching coefficients of the cost model
+# used by batch.predictCost, in the same order
+
+#############################################################################
+
+def fitNonNeg(features, values):
+# Least squares fit of values on the columns of features with no negative coefficients: columns with negative
+# coefficients are dropped one at a time, starting with the most negative, and the rest are fit again
+
+    import numpy as np;
+
+    coefs = np.zeros(features.shape[1]);
+    active = list(range(features.shape[1]));
+
+    while active:
+        cur_coefs = np.linalg.lstsq(features[:, active], values, rcond=None)[0];
+        if all(cur_coefs >= 0):
+            coefs[active] = cur_coefs;
+            break;
+        active.pop(int(np.argmin(cur_coefs)));
+    # Drop the most negative coefficient until all are positive
+
+    return coefs;
+
+#############################################################################
+
+def readBatchCosts(batch_cost_file):
+# Reads the batch cost file written by the interface (batch.genJobFiles) as a dict: <batch> : { <column> : <value> }
+
+    batch_costs = {};
+    with open(batch_cost_file) as costfile:
+        headers = costfile.readline().strip().split("\t");
+        for line in costfile:
+            line = line.strip().split("\t");
+            if len(line) != len(headers):
+                continue;
+            batch_costs[line[0]] = { headers[col] : line[col] for col in range(1, len(headers)) };
+
+    return batch_costs;
+
+#############################################################################
+
+def readBenchmark(benchmark_file):
+# Reads the runtime in seconds and max memory in MB of a batch from a snakemake benchmark file,
+# with None for either one that isn't in the file, or None, None if the file isn't there
+
+    if not os.path.isfile(benchmark_file):
+        return None, None;
+
+    with open(benchmark_file) as benchfile:
+        headers = benchfile.readline().strip().split("\t");
+        values = benchfile.readline().strip().split("\t");
+
+    bench = dict(zip(headers, values));
+    measures = [];
+    for measure in ['s', 'max_rss']:
+        try:
+            measures.append(float(bench[measure]));
+        except (KeyError, ValueError):
+            measures.append(None);
+    # max_rss is "-" when snakemake can't measure it, and in the benchmark files written by SLURM array jobs
+
+    return measures[0], measures[1];
+
+#############################################################################
+
+def fitRuntimeModel(globs):
+# Fits the coefficients of the cost model (see batch.predictCost) for each model type to the runtimes of the
+# finished batches, or a scale for the coefficients the interface used if there are only a few batches. Also fits
+# a model of the max memory of each batch from the number of sites in it when snakemake benchmarks are available.
+# Returns the model as a dict to be written with writeRuntimeModel, or False if no batches have runtimes and costs.
+
+    import numpy as np;
+    # Only fitting the model needs numpy. The interface reads the model with json alone.
+
+    batch_costs = readBatchCosts(globs['batch-costs-file']);
+    # The number of loci and sites in every batch from the interface
+
+    steps = int(globs['mcmc']) * int(globs['chain']);
+    # The runtime of PhyloAcc scales with the number of steps in the chains
+
+    model = { 'version' : MODEL_VERSION, 'runtime' : {}, 'memory' : {} };
+
+    for model_type in ["st", "gt"]:
+        runtime_rows, predictions, runtimes, memory_rows, memories = [], [], [], [], [];
+        for batch, (seconds, max_rss) in globs['batch-resources'].items():
+            if batch not in batch_costs or batch_costs[batch]['model'] != model_type:
+                continue;
+
+            cur_features = [ float(batch_costs[batch][feature]) for feature in COST_FEATURES ];
+            if seconds is not None:
+                runtime_rows.append([ feature * steps for feature in cur_features ]);
+                predictions.append(float(batch_costs[batch]['predicted-seconds']));
+                runtimes.append(seconds);
+            if max_rss is not None:
+                memory_rows.append([1.0, cur_features[COST_FEATURES.index('seq-sites')]]);
+                memories.append(max_rss);
+        # Get the features and measurements for every batch of the current model type
+
+        if runtimes:
+            runtimes = np.array(runtimes);
+
+            if len(runtimes) >= MIN_BATCHES:
+                runtime_rows = np.array(runtime_rows);
+                coefs = fitNonNeg(runtime_rows, runtimes);
+                predicted = runtime_rows @ coefs;
+                model['runtime'][model_type] = { coef : float(value) for coef, value in zip(COST_COEFS, coefs) };
+            # With enough batches, fit every coefficient
+
+            else:
+                predictions = np.array(predictions);
+                scale = (predictions @ runtimes) / max(predictions @ predictions, 1e-12);
+                predicted = predictions * scale;
+                model['runtime'][model_type] = { 'scale' : float(scale) };
+            # Otherwise, just scale the coefficients the interface used to the observed runtimes
+
+            model['runtime'][model_type]['batches'] = len(runtimes);
+            model['runtime'][model_type]['mean-abs-error'] = float(np.mean(np.abs(predicted - runtimes)));
+        # Runtime in seconds per MCMC step
+
+        if len(memories) >= 2:
+            coefs = fitNonNeg(np.array(memory_rows), np.array(memories));
+            model['memory'][model_type] = { 'batch' : float(coefs[0]), 'site' : float(coefs[1]), 'batches' : len(memories) };
+        elif memories:
+            model['memory'][model_type] = { 'batch' : float(max(memories)), 'site' : 0.0, 'batches' : len(memories) };
+        # Max memory in MB
+    ## End model type loop
+
+    if not model['runtime']:
+        return False;
+    return model;
+
+#############################################################################
+
+def writeRuntimeModel(model, filename):
+# Writes a fitted runtime model to a JSON file
+    with open(filename, "w") as modelfile:
+        json.dump(model, modelfile, indent=4);
+
+#############################################################################
+
+def readRuntimeModel(globs, filename):
+# Reads a runtime model written by phyloacc_post.py and replaces the default coefficients of the cost model for
+# each model type in it. Also reads the memory model if there is one.
+
+    try:
+        with open(filename) as modelfile:
+            model = json.load(modelfile);
+    except (OSError, ValueError):
+        PC.errorOut("OP18", "Could not read the runtime model (-runtime-model): " + filename, globs);
+
+    if not isinstance(model, dict) or model.get('version') != MODEL_VERSION:
+        PC.errorOut("OP18", "The runtime model (-runtime-model) is not from a compatible version of phyloacc_post.py: " + filename, globs);
+
+    for model_type, coefs in model['runtime'].items():
+        if model_type not in globs['cost-model']:
+            continue;
+        if 'scale' in coefs:
+            globs['cost-model'][model_type] = { coef : globs['cost-model'][model_type][coef] * coefs['scale'] for coef in COST_COEFS };
+        else:
+            globs['cost-model'][model_type] = { coef : coefs[coef] for coef in COST_COEFS };
+    # Replace the default runtime coefficients, or scale them if there weren't enough batches to fit them
+
+    globs['mem-model'] = { model_type : coefs for model_type, coefs in model['memory'].items() if model_type in globs['cost-model'] };
+    # The memory model, if snakemake benchmarks were available for the fit
+
+    return globs;
+
+#############################################################################
+
+def predictMem(globs, model_type, seq_sites):
+# Predicts the max memory in MB of a batch from the number of sites in it (sum of length times number of
+# sequences of every locus), or returns None without a memory model for the model type
+    if model_type not in globs['mem-model']:
+        return None;
+    coefs = globs['mem-model'][model_type];
+    return coefs['batch'] + coefs['site'] * seq_sites;
+
+#############################################################################
+
+def timeStr(seconds):
+# Formats a number of seconds as a SLURM time limit: H:MM:SS
+    seconds = int(math.ceil(seconds));
+    return str(seconds // 3600) + ":" + str(seconds % 3600 // 60).zfill(2) + ":" + str(seconds % 60).zfill(2);
+
+#############################################################################
+
+def timeSecs(time_str):
+# Converts a time limit in H:MM:SS (or MM:SS) format to seconds
+    return sum(int(t) * 60**i for i, t in enumerate(reversed(time_str.split(":"))));
+
+#############################################################################
+
+def setResources(globs):
+# Sets the time (-time) and memory (-mem) for each job from the largest predicted batch when a runtime model is
+# loaded and the user didn't set them. Called after the batches are planned.
+
+    if not globs['runtime-model-file'] or not globs['batch-costs']:
+        return globs;
+
+    if not globs['time-set']:
+        globs['time'] = timeStr(max(max(globs['batch-costs'].values()) * RESOURCE_MARGIN, 60));
+        PC.printWrite(globs['logfilename'], globs['log-v'], "# INFO: Time per job set to " + globs['time'] + " from the runtime model.");
+    # Time limit from the longest predicted batch
+
+    if not globs['mem-set'] and globs['batch-mems']:
+        globs['mem'] = str(max(1, math.ceil(max(globs['batch-mems'].values()) * RESOURCE_MARGIN / 1024)));
+        PC.printWrite(globs['logfilename'], globs['log-v'], "# INFO: Memory per job set to " + globs['mem'] + "gb from the runtime model.");
+    # Memory from the batch with the highest predicted memory, in GB
+
+    return globs;
+
+#############################################################################
+
+def batchResources(globs):
+# The memory in MB and time in minutes to request for each batch: { <batch> : { 'mem' : <MB>, 'time' : <minutes> } }
+# Each batch gets its predicted runtime and memory times the margin, but never less than -time and -mem. When a
+# runtime model is given and -time or -mem weren't set, the minimums are MIN_JOB_MINUTES and MIN_JOB_MEM instead.
+
+    if globs['runtime-model-file'] and not globs['time-set']:
+        min_time = MIN_JOB_MINUTES;
+    else:
+        min_time = timeSecs(globs['time']) / 60;
+
+    if globs['batch-mems'] and not globs['mem-set']:
+        min_mem = MIN_JOB_MEM;
+    else:
+        min_mem = int(globs['mem']) * 1024;
+    # The least time and memory for any batch
+
+    resources = {};
+    for batch, cost in globs['batch-costs'].items():
+        cur_time = max(min_time, cost * RESOURCE_MARGIN / 60);
+        cur_mem = max(min_mem, globs['batch-mems'].get(batch, 0) * RESOURCE_MARGIN);
+        resources[batch] = { 'mem' : int(math.ceil(cur_mem)), 'time' : int(math.ceil(cur_time)) };
+    # Predicted runtime and memory for each batch, without memory predictions if there is no memory model
+
+    return resources;
+
+#############################################################################
@@ -5,56 +5,224 @@
 
 import sys
 import os
+import io
 import gzip
+import mmap
 import phyloacc_lib.core as PC
+import phyloacc_lib.store as STORE
+import phyloacc_lib.cache as CACHE
+import phyloacc_lib.profiling as PROFILE
 import multiprocessing as mp
-from itertools import groupby
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 
 ############################################################################# 
 
-def readFasta(filename, globs):
-# Read a FASTA formatted sequence file
-# Great iterator and groupby code from: https://www.biostars.org/p/710/ 
+def iterFasta(filename, globs, block_size=2**24):
+# Read a FASTA formatted sequence file as a stream of (<sequence id>, <sequence bytes>) pieces
 
     if globs['seq-compression'] == "gz":
-        file_stream = gzip.open(filename);
-        fa_iter = (x[1] for x in groupby(file_stream, lambda line: line.decode()[0] == ">"));
-        readstr = lambda s : s.decode().strip();
+        file_stream = gzip.open(filename, "rb");
     elif globs['seq-compression'] == "none":
-        file_stream = open(filename); 
-        fa_iter = (x[1] for x in groupby(file_stream, lambda line: line[0] == ">"));
-        readstr = lambda s : s.strip();
-    # Read the lines of the file depending on the compression level
-    # file_stream opens the file as an iterable
-    # groupby takes an iterable (file_stream) and a function that indicates the key of the group. It iterates over
-    # the iterable and when it encounters a key, it groups all following items to it (perfect for FASTA files).
-    # fa_iter is a generator object holding all the grouped iterators.
-    # readstr is a function that changes depending on compression level -- for compressed files we also need to decode
-    # each string in the iterators below.
+        file_stream = open(filename, "rb");
+    # Open the file depending on the compression level. gzip (and bgzip, which is multi-member gzip) files
+    # are decompressed through gzip's buffered reader as the blocks are read
+
+    with file_stream:
+        yield from iterFastaStream(file_stream, set(globs['tree-tips']), block_size);
+
+#############################################################################
+
+def iterFastaStream(file_stream, tips, block_size=2**24):
+# Read FASTA formatted sequences from an open binary stream as (<sequence id>, <sequence bytes>) pieces
+# The stream is read as bytes in large blocks: headers are found with bytes.find and the sequence lines
+# of each kept record are joined without decoding every line. Each kept record yields its header with
+# None first, then one non-empty piece of sequence per block that has any. Records for sequences that are not in tips
+# (the tips of the input tree) are skipped without ever being joined or decoded.
+
+    curkey, keep = None, False;
+    # The header of the current record and whether it is being kept or skipped
+
+    carry = b"\n";
+    # Bytes carried over to the next block: the start of an incomplete header line, or the
+    # newline that ends the block so that a header at the start of the next block can still be
+    # found by searching for "\n>". Starts as a newline so the first header is found.
+
+    for block in iter(lambda: file_stream.read(block_size), b""):
+        data = carry + block;
+        carry = b"";
+        pos = 0;
+
+        while True:
+            header_start = data.find(b"\n>", pos);
+            # Find the next header in the block
+
+            seq_end = len(data) if header_start == -1 else header_start;
+            if keep and seq_end > pos:
+                piece = b"".join(data[pos:seq_end].split());
+                if piece:
+                    yield curkey, piece;
+            # Yield the sequence up to the next header (or the end of the block) for the current record.
+            # Splitting on and joining over whitespace removes the newlines in one step. Empty pieces
+            # (e.g. a block that ends right before a header) are never yielded.
+
+            if header_start == -1:
+                if data.endswith(b"\n"):
+                    carry = b"\n";
+                break;
+            # No more headers in this block
+
+            header_end = data.find(b"\n", header_start + 1);
+            if header_end == -1:
+                carry = data[header_start:];
+                break;
+            # The header line continues in the next block
+
+            curkey = data[header_start+2:header_end].decode().strip();
+            keep = curkey in tips;
+            if keep:
+                yield curkey, None;
+            # Start the next record if it belongs to a tip branch in the input tree
+
+            pos = header_end;
+            # Keep the newline at the end of the header so that an immediately following header is found
+        ## End header loop
+    ## End block loop
+
+    if carry.startswith(b"\n>"):
+        curkey = carry[2:].decode().strip();
+        if curkey in tips:
+            yield curkey, None;
+    # A header on the last line of the file without a newline
+
+#############################################################################
+
+def joinFasta(records):
+# Join the (<sequence id>, <sequence bytes>) pieces from iterFasta or iterFastaStream into a dict of sequences
 
     seqdict = {};
     # A dictionary of sequences:
     # <sequence id/header> : <sequence>
 
-    for header_obj in fa_iter:
-        #print(header_obj)
-        header = readstr(header_obj.__next__());
-        # The header object is an iterator. This gets the string.
+    pieces = {};
+    # The pieces of sequence read for each record
+
+    for curkey, piece in records:
+        if piece is None:
+            pieces[curkey] = [];
+        # A new record, which replaces any earlier record with the same header
+        else:
+            pieces[curkey].append(piece);
 
-        curkey = header[1:];
-        # This removes the ">" character from the header string to act as the key in seqdict
+    for curkey in pieces:
+        seqdict[curkey] = b"".join(pieces[curkey]).decode();
+    # Join the pieces of each record into the full sequence
 
-        seq = "".join(readstr(s) for s in fa_iter.__next__());
-        # The current header should correspond to the current iterator in fa_iter. This gets all those
-        # lines and combines them as a string.
+    return seqdict;
 
-        #print(header, len(seq));
+#############################################################################
 
-        if curkey in globs['tree-tips']:
-            seqdict[curkey] = seq;
-        # Save the sequence in seqdict if it belongs to a tip branch in the input tree  
+def indexFasta(filename, globs, block_size=2**24):
+# Read a FASTA formatted sequence file straight into an unwrapped data file without holding the sequences
+# in memory. Returns the data file and an index of the byte offset and length of each sequence in it:
+# <sequence id/header> : (<offset>, <length>)
 
-    return seqdict;
+    data_file = STORE.tempFile(globs, ".fa.bin");
+    seq_index = {};
+
+    offset = 0;
+    with open(data_file, "wb") as datafile:
+        for curkey, piece in iterFasta(filename, globs, block_size):
+            if piece is None:
+                seq_index[curkey] = (offset, 0);
+            # A new record, which replaces any earlier record with the same header
+            else:
+                datafile.write(piece);
+                seq_index[curkey] = (seq_index[curkey][0], seq_index[curkey][1] + len(piece));
+                offset += len(piece);
+
+    return data_file, seq_index;
+
+#############################################################################
+
+class LazyAlns(Mapping):
+# A read-only dict of the locus alignments in a concatenated alignment that has been indexed with indexFasta:
+# <locus id> : { <sequence id> : <sequence> }
+# Each alignment is sliced from the memory-mapped data file only when its locus is accessed, so the loci are
+# never all copied out of the concatenated sequences at once.
+
+    def __init__(self, data_file, seq_index, bed_coords):
+        self.data_file = data_file;
+        self.seq_index = seq_index;
+        self.bed_coords = bed_coords;
+        self.data = None;
+        # The data file is mapped on first access
+
+    def __getstate__(self):
+        state = self.__dict__.copy();
+        state['data'] = None;
+        return state;
+    # The mmap can't be pickled, so it is mapped again on first access in other processes
+
+    def getData(self):
+        if self.data is None:
+            with open(self.data_file, "rb") as datafile:
+                if os.fstat(datafile.fileno()).st_size == 0:
+                    self.data = b"";
+                else:
+                    self.data = mmap.mmap(datafile.fileno(), 0, access=mmap.ACCESS_READ);
+        return self.data;
+
+    def coords(self, locus, header):
+    # The start and end of a locus in the data file for one sequence, clipped to the sequence like a string slice
+        offset, seq_len = self.seq_index[header];
+        start = min(self.bed_coords[locus]['start'], seq_len);
+        end = max(start, min(self.bed_coords[locus]['end'], seq_len));
+        return offset + start, offset + end;
+
+    def views(self, locus):
+    # The alignment of a locus as zero-copy memoryviews of the data file
+        data = memoryview(self.getData());
+        return { header : data[slice(*self.coords(locus, header))] for header in self.seq_index };
+
+    def storeIndex(self):
+    # When every sequence has the same length and they were written one after the other, every locus can be read
+    # from the data file by stride, so the pools can read from it directly instead of writing another copy with
+    # STORE.writeStore. Returns the store index, or None when the layout doesn't allow it.
+        seq_lens = set(seq_len for offset, seq_len in self.seq_index.values());
+        if len(seq_lens) != 1:
+            return None;
+        seq_len = seq_lens.pop();
+
+        if any(self.seq_index[header][0] != i * seq_len for i, header in enumerate(self.seq_index)):
+            return None;
+
+        store = { 'data-file' : self.data_file, 'loci' : [], 'specs' : [tuple(self.seq_index)], 'locus-specs' : [],
+                    'offsets' : [], 'lengths' : [], 'strides' : [], 'ragged' : {} };
+        for locus in self.bed_coords:
+            start, end = self.coords(locus, store['specs'][0][0]) if self.seq_index else (0, 0);
+            store['loci'].append(locus);
+            store['locus-specs'].append(0);
+            store['offsets'].append(start);
+            store['lengths'].append(end - start);
+            store['strides'].append(seq_len);
+
+        return store;
+
+    def __getitem__(self, locus):
+        data = self.getData();
+        aln = {};
+        for header in self.seq_index:
+            start, end = self.coords(locus, header);
+            aln[header] = data[start:end].decode();
+        return aln;
+
+    def __iter__(self):
+        return iter(self.bed_coords);
+
+    def __len__(self):
+        return len(self.bed_coords);
 
 #############################################################################
 
@@ -116,32 +284,53 @@ def readBed(filename, globs):
 
 #############################################################################
 
-def partitionSeqs(concat_seqs, bed_coords):
-# A function that takes a concatenated input sequence and coordinates from a bed file
-# stored in a dictionary and separates the alignments by those coordinates
+def alnFileLocus(filename):
+# Get the locus ID from the name of an alignment file, without the .gz extension of compressed files
+    locus_file = os.path.basename(filename);
+    if locus_file.endswith(".gz"):
+        locus_file = locus_file[:-3];
+    return os.path.splitext(locus_file)[0];
 
-    alns = {};
-    # The dictionary of individual alignments to return:
-    # <locus id> : { <sequence id> : <sequence> }
+#############################################################################
 
-    for locus in bed_coords:
-    # Get every locus in the input coordinates
-        cur_aln = {};
-        # The dictionary to store the current locus alignment:
-        # <sequence id> : <sequence>
+def readAlnFile(filename):
+# Read the raw bytes of one alignment file. Run in threads since most of the time is spent
+# waiting on the filesystem to open the file
+    with open(filename, "rb") as alnfile:
+        return alnfile.read();
 
-        cur_start = bed_coords[locus]['start'];
-        cur_end = bed_coords[locus]['end'];
-        # Get the coordinates for the current locus
+#############################################################################
+
+def iterAlnFiles(filenames, num_readers):
+# Read files in threads with at most num_readers files being read at once and yield their bytes
+# in the same order as filenames. Reads are only submitted a few files ahead of the consumer so
+# that memory stays bounded however many files there are
+
+    with ThreadPoolExecutor(max_workers=num_readers) as executor:
+        pending = deque();
+        for filename in filenames:
+            pending.append(executor.submit(readAlnFile, filename));
+            if len(pending) >= num_readers * 2:
+                yield pending.popleft().result();
+
+        while pending:
+            yield pending.popleft().result();
+
+#############################################################################
 
-        for header in concat_seqs:
-            cur_aln[header] = concat_seqs[header][cur_start:cur_end];
-        # Get every sequence at the coordinates for the curent locus
+def parseAlnFile(aln_item):
+# Parse the bytes of one alignment file read by iterAlnFiles. Run in the process pool since
+# decompressing and parsing is CPU bound. The compression is detected for every file.
+    locus_id, raw, tips = aln_item;
 
-        alns[locus] = cur_aln;
-        # Save the current alignment to the alns dict
+    compression = PC.compressionType(raw);
+    if compression == "gz":
+        raw = gzip.decompress(raw);
+    elif compression != "none":
+        return locus_id, None, compression;
+    # Only gzip compressed and uncompressed files can be read
 
-    return alns;
+    return locus_id, joinFasta(iterFastaStream(io.BytesIO(raw), tips)), compression;
 
 #############################################################################
 
@@ -159,7 +348,7 @@ def readSeq(globs):
 
         step = "Reading input FASTA";
         step_start_time = PC.report_step(globs, step, False, "In progress...");
-        globs['in-seqs'] = readFasta(globs['aln-file'], globs);
+        globs['in-seqs-file'], globs['in-seqs'] = indexFasta(globs['aln-file'], globs);
         step_start_time = PC.report_step(globs, step, step_start_time, "Success: " + str(len(globs['in-seqs'])) + " seqs read");
         # Read the input sequence file
 
@@ -189,10 +378,11 @@ def readSeq(globs):
 
         step = "Partitioning alignments by locus";
         step_start_time = PC.report_step(globs, step, False, "In progress...");
-        globs['alns'] = partitionSeqs(globs['in-seqs'], globs['in-bed']);
+        globs['alns'] = LazyAlns(globs['in-seqs-file'], globs['in-seqs'], globs['in-bed']);
         globs['num-loci'] = len(globs['alns']);
         step_start_time = PC.report_step(globs, step, step_start_time, "Success: " + str(globs['num-loci']) + " alignments partitioned");
         # Separate the concatenated alignment to individual locus alignments based on the partitions in the bed file
+        # The alignments are read from the indexed input file only when each locus is accessed
 
         ##
         # step = "Writing partitioned sequences";
@@ -222,34 +412,53 @@ def readSeq(globs):
         aln_files = [ os.path.join(globs['aln-dir'], f) for f in os.listdir(globs['aln-dir']) if f.endswith((".fa", ".fa.gz", ".fasta", ".fasta.gz")) ];
         step_start_time = PC.report_step(globs, step, step_start_time, "Success: " + str(len(aln_files)) + " FASTA files found");
         
-        step = "Detecting compression of seq files";
-        step_start_time = PC.report_step(globs, step, False, "In progress...");
-        globs['seq-compression'] = PC.detectCompression(aln_files[0]);
-        if globs['seq-compression'] == "none":
-            step_start_time = PC.report_step(globs, step, step_start_time, "Success: No compression detected");
-        else:
-            step_start_time = PC.report_step(globs, step, step_start_time, "Success: " + globs['seq-compression'] + " detected");
-        # Detect the compression of the input sequence files
+        aln_files = sorted(aln_files, key=alnFileLocus);
+        if not aln_files:
+            PC.errorOut("SEQ1", "No FASTA files (.fa, .fa.gz, .fasta, .fasta.gz) found in the input directory (-d).", globs);
+        # Sort the files by locus ID so loci are always read in the same order
 
         step = "Reading input FASTA files";
-        step_start_time = PC.report_step(globs, step, False, "In progress...");
+        step_start_time = PC.report_step(globs, step, False, "Read 0 / " + str(len(aln_files)) + " files...", full_update=True);
 
         globs['alns'] = {};
         # The dictionary of individual alignments to return:
         # <locus id> : { <sequence id> : <sequence> }
 
-        for f in aln_files:
-            locus_id = os.path.splitext(os.path.basename(f))[0];
+        tips = frozenset(globs['tree-tips']);
+        window = max(globs['num-readers'], globs['num-procs']) * 4;
+        pending = deque();
+        # Files are read in threads and parsed in the aln pool, with at most window files read but not yet added
+
+        compressions = {};
+        # The number of files of each compression type
+
+        for raw_index, raw in enumerate(iterAlnFiles(aln_files, globs['num-readers'])):
+            locus_id = alnFileLocus(aln_files[raw_index]);
             # Get the locus ID from the file name
 
-            cur_aln = readFasta(f, globs);
-            # Read the current file as a FASTA file
-            
-            globs['alns'][locus_id] = cur_aln;
-            # Add the current alignment to the main aln dict
+            pending.append(globs['aln-pool'].apply_async(PROFILE.workerCall, (parseAlnFile, (locus_id, raw, tips))));
+            # Parse the current file in the pool
+
+            while pending and (len(pending) >= window or raw_index == len(aln_files) - 1):
+                locus_id, cur_aln, compression = pending.popleft().get();
+                if cur_aln is None:
+                    PC.errorOut("SEQ2", "Unsupported compression (" + compression + ") for alignment file of locus " + locus_id + ". Only uncompressed or gzipped files can be read.", globs);
+                compressions[compression] = compressions.get(compression, 0) + 1;
+
+                globs['alns'][locus_id] = cur_aln;
+                # Add the current alignment to the main aln dict
+
+                if len(globs['alns']) % 1000 == 0:
+                    PC.report_step(globs, step, step_start_time, "Read " + str(len(globs['alns'])) + " / " + str(len(aln_files)) + " files...", full_update=True);
+                # A status update every 1000 files
+            ## End result loop
+        ## End file loop
 
         globs['num-loci'] = len(globs['alns']);
-        step_start_time = PC.report_step(globs, step, step_start_time, "Success: " + str(globs['num-loci']) + " files read");
+        step_start_time = PC.report_step(globs, step, step_start_time, "Success: " + str(globs['num-loci']) + " files read", full_update=True);
+        if compressions.get("gz", 0):
+            PC.printWrite(globs['logfilename'], globs['log-v'], "# INFO: " + str(compressions["gz"]) + " of the input alignment files are gzip compressed.");
+        # Status update
 
     # Read sequences if input is a directory of alignment files
     #######################
@@ -325,31 +534,162 @@ def locusAlnStats(locus_item):
 
 #############################################################################
 
+def encodeAln(aln):
+# Encodes an alignment as a matrix of uint8 character codes with one row per sequence, in the order of aln,
+# and one column per site. Returns None if the sequences are not all the same length with single byte
+# characters, since those can't be encoded as a matrix
+
+    import numpy as np;
+    # numpy is only imported when alignments are encoded, so options that exit early don't pay for it
+
+    seqs = list(aln.values());
+    aln_len = len(seqs[0]);
+
+    aln_bytes = "".join(seqs).encode();
+    if len(aln_bytes) != len(seqs) * aln_len:
+        return None;
+
+    return np.frombuffer(aln_bytes, dtype=np.uint8).reshape(len(seqs), aln_len);
+
+#############################################################################
+
+def locusAlnStatsNumpy(locus_item, aln_mat=None):
+# An array based version of locusAlnStats that returns the same stats dict. Each alignment is encoded once
+# as a species x site matrix of uint8 character codes and all site counts are done column-wise instead of
+# building each site as a string. An alignment that has already been encoded with encodeAln can be passed
+# as aln_mat.
+    import numpy as np;
+
+    locus, aln, skip_chars = locus_item;
+    # Unpack the data for the current locus
+
+    seqs = list(aln.values());
+    num_seqs = len(seqs);
+    aln_len = len(seqs[0]);
+
+    if aln_mat is None:
+        aln_mat = encodeAln(aln);
+    if aln_mat is None:
+        return locusAlnStats(locus_item);
+    # The matrix encoding requires all sequences to be the same length with single byte characters, so
+    # fall back to the site loop in locusAlnStats for anything else
+
+    cur_stats = { 'num-seqs' : num_seqs, 'length' : aln_len, 'avg-nogap-seq-len' : 0, 'variable-sites' : 0, 'unique-seqs' : 0,
+                                        'informative-sites' : 0, 'num-sites-w-gap' : 0, 'num-sites-half-gap' : 0,
+                                        'num-seqs-half-gap' : 0, 'low-qual' : False, 'batch-type' : "NA" };
+    # Initialize the stats dict for this locus with the same keys and order as locusAlnStats
+
+    half_aln_len = aln_len / 2;
+    half_site_len = num_seqs / 2;
+    # Compute half the alignment length and half the site length for the current locus.
+
+    gap_mat = aln_mat == ord("-");
+    site_gaps = gap_mat.sum(axis=0);
+    seq_gaps = gap_mat.sum(axis=1);
+    # Count the gaps in every site (columns) and every sequence (rows)
+
+    cur_stats['avg-nogap-seq-len'] = PC.mean((aln_len - seq_gaps).tolist());
+    # Calculate the average sequence length without gaps for each sequence in the alignment
+
+    if half_aln_len <= 1:
+        cur_stats['num-seqs-half-gap'] = int(seq_gaps.sum());
+    # locusAlnStats compares the gap count of each single allele (0 or 1) to half the alignment length, so
+    # gaps are only counted towards this for alignments of 2 sites or fewer
+
+    skip_codes = [ ord(char) for char in skip_chars ];
+    allele_codes = [ code for code in np.unique(aln_mat).tolist() if code not in skip_codes ];
+    # The character codes of all alleles present in this alignment
+
+    if allele_codes:
+        allele_counts = np.stack([ (aln_mat == code).sum(axis=0) for code in allele_codes ]);
+        # Count the occurrence of each allele at every site: one row per allele, one column per site
+
+        variable_sites = (allele_counts > 0).sum(axis=0) > 1;
+        cur_stats['variable-sites'] = int(np.count_nonzero(variable_sites));
+        # If there is more than one allele in the site, it is variable
+
+        informative_sites = variable_sites & ((allele_counts >= 2).sum(axis=0) >= 2);
+        cur_stats['informative-sites'] = int(np.count_nonzero(informative_sites));
+        # If 2 or more alleles are present in 2 or more species, this site is informative
+
+    cur_stats['num-sites-w-gap'] = int(np.count_nonzero(site_gaps > 0));
+    cur_stats['num-sites-half-gap'] = int(np.count_nonzero(site_gaps >= half_site_len));
+    # Count whether each site contains a gap and, if so, whether more than half the sequences are a gap
+
+    cur_stats['num-unique-seqs'] = len(set(seqs));
+    # Count the number of unique sequences
+
+    if cur_stats['num-sites-half-gap'] > half_site_len or cur_stats['num-seqs-half-gap'] > half_site_len:
+        cur_stats['low-qual'] = True;
+    # Setting a flag for low quality sequence to be considered when estimating theta
+
+    return locus, cur_stats;
+
+#############################################################################
+
 def alnStats(globs):
     step = "Calculating alignment stats";
     step_start_time = PC.report_step(globs, step, False, "In progress...");
     # Status update
 
+    if globs['stats-engine'] == "numpy":
+        stats_func = locusAlnStatsNumpy;
+    else:
+        stats_func = locusAlnStats;
+    # Select the array based stats (default) or the pure Python site loop (--pystats)
+
+    context_args = (globs['skip-chars'],);
+    context_file = STORE.writeContext(globs, context_args);
+    # Store the alignments once so the workers only get locus indices
+
     with globs['aln-pool'] as pool:
-        for result in pool.imap(locusAlnStats, ((locus, globs['alns'][locus], globs['skip-chars']) for locus in globs['alns'])):
-        # Loop over every locus in parallel to calculate stats
+        for result in CACHE.imapCached(globs, pool, stats_func, context_file, context_args):
+        # Loop over every locus in parallel to calculate stats, or load them from the cache (-cache)
         # Have to do it this way so it doesn't terminate the pool for sCF calculations
 
             aln, stats = result;
-            globs['aln-stats'][aln] = stats;
-            # Unpack the current result
+            globs = addLocusStats(globs, aln, stats);
+            # Unpack and save the current result
+
+        PROFILE.closePool(globs, pool);
+        # With --profile, let the workers write their profiles before the pool is terminated
+
+    globs = summarizeAlnStats(globs);
+    # Summary stats across loci
+
+    step_start_time = PC.report_step(globs, step, step_start_time, "Success: " + str(len(globs['aln-stats'])) + " alignments processed");
+    if globs['no-inf-sites-loci']:
+        PC.printWrite(globs['logfilename'], globs['log-v'], "# INFO: " + str(len(globs['no-inf-sites-loci'])) + " loci have 0 informative sites and will be removed from the analysis.");
+    CACHE.reportHits(globs);
+    # Status update
+
+    return globs;
+
+#############################################################################
 
-            if globs['run-mode'] == 'st':
-                globs['aln-stats'][aln]['batch-type'] = "st";
-            # With run mode st, all loci are run through the species tree model
+def addLocusStats(globs, aln, stats):
+# Saves the stats for one locus as returned by the pool
 
-            elif globs['run-mode'] == 'gt':
-                globs['aln-stats'][aln]['batch-type'] = "gt";
-            # With run mode gt, all loci are run through the gene tree model
-            
-            if globs['aln-stats'][aln]['informative-sites'] == 0:
-                globs['no-inf-sites-loci'].append(aln);
-            # If the locus has no informative sites, add to the list here
+    globs['aln-stats'][aln] = stats;
+
+    if globs['run-mode'] == 'st':
+        globs['aln-stats'][aln]['batch-type'] = "st";
+    # With run mode st, all loci are run through the species tree model
+
+    elif globs['run-mode'] == 'gt':
+        globs['aln-stats'][aln]['batch-type'] = "gt";
+    # With run mode gt, all loci are run through the gene tree model
+    
+    if globs['aln-stats'][aln]['informative-sites'] == 0:
+        globs['no-inf-sites-loci'].append(aln);
+    # If the locus has no informative sites, add to the list here
+
+    return globs;
+
+#############################################################################
+
+def summarizeAlnStats(globs):
+# Averages the alignment stats across all loci
 
     sorted_aln_lens = sorted([ globs['aln-stats'][aln]['length'] for aln in globs['aln-stats'] ]);
     globs['avg-aln-len'] = PC.mean(sorted_aln_lens);
@@ -361,11 +701,6 @@ def alnStats(globs):
     globs['med-nogap-seq-len'] = PC.median(sorted_avg_seq_lens);
     # Sort average sequence lengths without gaps and calculate summary statistics
 
-    step_start_time = PC.report_step(globs, step, step_start_time, "Success: " + str(len(globs['aln-stats'])) + " alignments processed");
-    if globs['no-inf-sites-loci']:
-        PC.printWrite(globs['logfilename'], globs['log-v'], "# INFO: " + str(len(globs['no-inf-sites-loci'])) + " loci have 0 informative sites and will be removed from the analysis.");
-    # Status update
-
     return globs;
 
 #############################################################################
\ No newline at end of file
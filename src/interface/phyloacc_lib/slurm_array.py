@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+#############################################################################
+# Script to submit the PhyloAcc batches of a run as SLURM job arrays instead
+# of one job per batch with snakemake (--array in the interface)
+#
+# submit: submits every batch that hasn't finished and isn't pending or running as job arrays, one per model type
+#         unless there are more batches than the max array size. Each array gets a list of its batches and task i
+#         runs the batch on line i+1, so array indices stay below SLURM's MaxArraySize however many batches there
+#         are. At most -j tasks run at once across the arrays, counting the tasks of arrays from earlier submits that
+#         are still pending or running, except that every array can run at least one task, so many small arrays or a
+#         resubmit while -j tasks are still running can go over -j by up to the number of new arrays. Run it again
+#         after batches fail to resubmit only the failed tasks, with their time and memory multiplied by the retry scale.
+# status: checks all submitted arrays with one sacct query and reports the batches that are finished, active,
+#         or failed.
+#
+# The interface copies this script to the snakemake directory of each run along with the array job scripts and
+# the config file (array-config.json) it reads. It only uses the standard library.
+#############################################################################
+
+import os
+import sys
+import json
+import math
+import time
+import fcntl
+import argparse
+import subprocess
+
+#############################################################################
+
+RUNNING_STATUS = ["PENDING", "CONFIGURING", "COMPLETING", "RUNNING", "SUSPENDED", "REQUEUED", "RESIZING"];
+# Statuses that indicate the task is running. All others besides "COMPLETED" indicate the task has failed.
+
+IDS_PER_QUERY = 500;
+# The most job IDs to give to one sacct command, to keep the command line short
+
+MAX_ARRAY_SIZE = 1000;
+# The most tasks in one array when the config doesn't set it. SLURM's default MaxArraySize is 1001, so the highest
+# index allowed is 1000.
+
+MISSING_AFTER = 300;
+# The seconds after submission that a task sacct doesn't list is still taken to be pending. After that it is
+# taken to have failed so it can be resubmitted.
+
+#############################################################################
+
+def indexRanges(batches):
+# Compresses a list of batch numbers to SLURM array indices, e.g. 1-4,7,9-10
+    batches = sorted(int(batch) for batch in batches);
+    ranges, start = [], batches[0];
+    for i in range(1, len(batches) + 1):
+        if i == len(batches) or batches[i] != batches[i-1] + 1:
+            ranges.append(str(start) if start == batches[i-1] else str(start) + "-" + str(batches[i-1]));
+            if i < len(batches):
+                start = batches[i];
+    return ",".join(ranges);
+
+#############################################################################
+
+def expandRanges(ranges):
+# Expands SLURM array indices to a list of task indices as strings, ignoring any throttle, e.g. 1-3,7%2 -> 1,2,3,7
+    tasks = [];
+    for index_range in ranges.split("%")[0].split(","):
+        if "-" in index_range:
+            start, end = index_range.split("-");
+            tasks += [ str(task) for task in range(int(start), int(end) + 1) ];
+        elif index_range:
+            tasks.append(index_range);
+    return tasks;
+
+#############################################################################
+
+def querySacct(jobids):
+# Gets the state of every task of the given array jobs with one sacct call per IDS_PER_QUERY jobs.
+# Returns a dict of (<job ID>, <task index>) : <state>. Pending tasks that haven't started are listed by
+# sacct as a range, e.g. 123_[5-10%2], and are expanded here.
+
+    states = {};
+    jobids = sorted(set(jobids));
+
+    for i in range(0, len(jobids), IDS_PER_QUERY):
+        cmd = ["sacct", "-X", "--parsable2", "--noheader", "--format", "JobID,State", "-j", ",".join(jobids[i:i+IDS_PER_QUERY])];
+        try:
+            output = subprocess.check_output(cmd, universal_newlines=True, stderr=subprocess.DEVNULL);
+        except (OSError, subprocess.CalledProcessError):
+            sys.exit("# ERROR: Could not get the status of the array jobs with sacct.");
+
+        for line in output.splitlines():
+            line = line.strip().split("|");
+            if len(line) < 2 or "_" not in line[0] or not line[1]:
+                continue;
+            jobid, index = line[0].split("_", 1);
+            state = line[1].split()[0];
+            # States like "CANCELLED by 1234" have extra words
+
+            for task in expandRanges(index.strip("[]")):
+                states[(jobid, task)] = state;
+    ## End query loop
+
+    return states;
+
+#############################################################################
+
+def batchStatus(config, submissions):
+# Gets the status of every batch from its output file and the state of its latest submitted task:
+# finished, active (pending or running), failed, or unsubmitted. Returns a dict of <model type> : { <batch> : <status> }
+
+    states = querySacct([ sub['jobid'] for sub in submissions ]) if submissions else {};
+    missing_after = config.get('missing-after', MISSING_AFTER);
+
+    latest = {};
+    for sub in submissions:
+        for task, batch in enumerate(sub['batches']):
+            latest[batch] = (sub, str(task));
+    # The last submission of each batch and its task in that array
+
+    status = {};
+    for model_type, array in config['arrays'].items():
+        status[model_type] = {};
+        for batch in array['batches']:
+            if os.path.isfile(os.path.join(config['output-dir'], batch + "-phyloacc-" + model_type + "-out", batch + "_elem_lik.txt")):
+                status[model_type][batch] = "finished";
+            elif batch not in latest:
+                status[model_type][batch] = "unsubmitted";
+            else:
+                sub, task = latest[batch];
+                state = states.get((sub['jobid'], task));
+                if state is None:
+                    status[model_type][batch] = "active" if time.time() - sub['submitted'] < missing_after else "failed";
+                elif state in RUNNING_STATUS:
+                    status[model_type][batch] = "active";
+                else:
+                    status[model_type][batch] = "failed";
+            # Tasks that sacct doesn't list yet were just submitted, but one that it still doesn't list after a while
+            # was lost. A task that completed without writing its output file has failed.
+    ## End model type loop
+
+    return status;
+
+#############################################################################
+
+def readSubmissions(submission_file):
+# Reads the list of arrays submitted so far
+    if not os.path.isfile(submission_file):
+        return [];
+    with open(submission_file) as subfile:
+        return json.load(subfile);
+
+#############################################################################
+
+def submit(config, submissions, submission_file, dryrun):
+# Submits every batch that isn't finished or active as an array per model type and attempt, split into arrays of
+# at most the max array size. Returns the number of batches submitted.
+
+    status = batchStatus(config, submissions);
+
+    attempts = {};
+    for sub in submissions:
+        for batch in sub['batches']:
+            attempts[batch] = attempts.get(batch, 0) + 1;
+    # The number of times each batch has been submitted already
+
+    arrays = {};
+    for model_type in status:
+        for batch, cur_status in status[model_type].items():
+            if cur_status in ["failed", "unsubmitted"]:
+                arrays.setdefault((model_type, attempts.get(batch, 0)), []).append(batch);
+    # Group the batches to submit by model type and the number of times they've been tried, since the
+    # time and memory are set for the whole array
+
+    if not arrays:
+        return 0;
+
+    total_tasks = sum(len(batches) for batches in arrays.values());
+    max_size = config.get('max-array-size', MAX_ARRAY_SIZE);
+
+    latest = {};
+    for sub_index, sub in enumerate(submissions):
+        for batch in sub['batches']:
+            latest[batch] = sub_index;
+    active = {};
+    for model_type in status:
+        for batch, cur_status in status[model_type].items():
+            if cur_status == "active":
+                active[latest[batch]] = active.get(latest[batch], 0) + 1;
+    num_active = sum(min(num_tasks, submissions[sub_index].get('throttle', num_tasks)) for sub_index, num_tasks in active.items());
+    # The number of tasks from earlier submissions that are pending or running. An array can't run more tasks at once
+    # than its own throttle, so only that many of its active tasks count.
+
+    budget = max(0, config['throttle'] - num_active);
+    if num_active:
+        print("# " + str(num_active) + " tasks from earlier submissions are still pending or running, leaving " + str(budget) + " of the " + str(config['throttle']) + " tasks to run at once (-j) for the new arrays");
+
+    list_dir = os.path.join(os.path.dirname(os.path.abspath(submission_file)), "array-batches");
+    if not dryrun and not os.path.isdir(list_dir):
+        os.makedirs(list_dir);
+    list_index = len(submissions);
+    # The list of batches of each submitted array, read by its tasks, numbered by the order of submission
+
+    for (model_type, attempt), batches in sorted(arrays.items()):
+        array = config['arrays'][model_type];
+        scale = config['retry-scale'] ** attempt;
+        mem, mins = int(math.ceil(array['mem'] * scale)), int(math.ceil(array['time'] * scale));
+        # Each resubmission gets more time and memory in case the batches failed from hitting their limits
+
+        batches = sorted(batches, key=int);
+        for i in range(0, len(batches), max_size):
+            cur_batches = batches[i:i+max_size];
+
+            throttle = max(1, budget * len(cur_batches) // total_tasks);
+            # Split the number of tasks left to run at once (-j) between the new arrays by their size. Each array runs at
+            # least one task at a time, so this can go over -j by up to the number of new arrays.
+
+            list_file = os.path.join(list_dir, model_type + "-" + str(list_index) + ".txt");
+            list_index += 1;
+            cmd = ["sbatch", "--parsable", "--array=0-" + str(len(cur_batches) - 1) + "%" + str(throttle), "--mem=" + str(mem) + "M", "--time=" + str(mins), array['script'], list_file];
+            print(" ".join(cmd) + "  # batches " + indexRanges(cur_batches));
+            if dryrun:
+                continue;
+
+            with open(list_file, "w") as listfile:
+                listfile.write("".join(batch + "\n" for batch in cur_batches));
+            # Task i of the array runs the batch on line i+1
+
+            log_dir = os.path.join(config['log-dir'], "run_phyloacc_" + model_type);
+            if not os.path.isdir(log_dir):
+                os.makedirs(log_dir);
+            # SLURM won't create the directory for the log files
+
+            try:
+                jobid = subprocess.check_output(cmd, universal_newlines=True).strip().split(";")[0];
+            except (OSError, subprocess.CalledProcessError):
+                sys.exit("# ERROR: Could not submit the array job with sbatch.");
+            # sbatch --parsable prints <job ID> or <job ID>;<cluster>
+
+            submissions.append({ 'model' : model_type, 'jobid' : jobid, 'batches' : cur_batches, 'list' : list_file, 'attempt' : attempt, 'mem' : mem, 'time' : mins, 'throttle' : throttle, 'submitted' : time.time() });
+            with open(submission_file, "w") as subfile:
+                json.dump(submissions, subfile, indent=4);
+            print("# Submitted " + str(len(cur_batches)) + " " + model_type + " batches as array job " + jobid);
+            # Record each array as soon as it is submitted
+        ## End split loop
+    ## End array loop
+
+    return total_tasks;
+
+#############################################################################
+
+def report(config, submissions):
+# Prints the number of batches of each model type with each status and the failed batches. Returns the
+# number of batches that still need to be run.
+
+    status = batchStatus(config, submissions);
+
+    remaining = 0;
+    for model_type in sorted(status):
+        counts = { cur_status : 0 for cur_status in ["finished", "active", "failed", "unsubmitted"] };
+        for cur_status in status[model_type].values():
+            counts[cur_status] += 1;
+        remaining += len(status[model_type]) - counts['finished'];
+
+        print("# " + model_type + " batches: " + ", ".join(str(count) + " " + cur_status for cur_status, count in counts.items()));
+        failed = [ batch for batch, cur_status in status[model_type].items() if cur_status == "failed" ];
+        if failed:
+            print("#   failed: " + indexRanges(failed));
+    ## End model type loop
+
+    if any(cur_status in ["failed", "unsubmitted"] for model_type in status for cur_status in status[model_type].values()):
+        print("# Run this script with submit to resubmit the failed and unsubmitted batches.");
+
+    return remaining;
+
+#############################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Submit the PhyloAcc batches of a run as SLURM job arrays and check their status.");
+    parser.add_argument("command", choices=["submit", "status"], help="submit: submit all batches that aren't finished or running, including failed ones. status: report the status of all batches.");
+    parser.add_argument("--config", dest="config_file", help="The config file written by the interface. Default: array-config.json in the same directory as this script.", default=False);
+    parser.add_argument("--dryrun", dest="dryrun", help="With submit, print the sbatch commands without running them.", action="store_true", default=False);
+    args = parser.parse_args();
+
+    if not args.config_file:
+        args.config_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "array-config.json");
+    with open(args.config_file) as configfile:
+        config = json.load(configfile);
+
+    submission_file = os.path.join(os.path.dirname(os.path.abspath(args.config_file)), "array-submissions.json");
+    # The arrays submitted so far
+
+    with open(submission_file + ".lock", "w") as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX);
+        # Don't let two submissions run at the same time and submit the same batches twice
+
+        submissions = readSubmissions(submission_file);
+
+        if args.command == "submit":
+            num_submitted = submit(config, submissions, submission_file, args.dryrun);
+            if not num_submitted:
+                print("# No batches to submit: all batches are finished or still running.");
+        else:
+            remaining = report(config, submissions);
+            sys.exit(0 if remaining == 0 else 1);
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+#############################################################################
+# Script to use with snakemake to check slurm status of jobs
+# Modified from: https://github.com/snakemake/snakemake/issues/759
+# with elements from: https://github.com/Snakemake-Profiles/slurm/blob/master/%7B%7Bcookiecutter.profile_name%7D%7D/slurm-status.py
+#
+# Snakemake calls this script once per job on every status check. Instead of running sacct for each call, the
+# states of all jobs of the run are kept in a cache file next to this script and refreshed with a single sacct
+# query for every unfinished job at most once per interval (--interval), whether the query works or not. The
+# cache is locked while it is read and refreshed so simultaneous status checks wait for one query instead of each
+# running their own. A job that sacct still doesn't list once it has answered for --missing seconds after the job
+# was first checked is reported as failed.
+#
+# The interface copies this script to the snakemake directory of each run. It only uses the standard library.
+#
+# Gregg Thomas, August 2021
+#############################################################################
+
+import os
+import json
+import time
+import fcntl
+import argparse
+import subprocess
+
+#############################################################################
+
+RUNNING_STATUS = ["PENDING", "CONFIGURING", "COMPLETING", "RUNNING", "SUSPENDED", "REQUEUED", "RESIZING"];
+# Statuses that indicate the job is running
+# "COMPLETED" indicates the job is finished
+# All other statuses indicate the job has failed
+
+STATUS_ATTEMPTS = 3;
+# Number of times to try sacct on each refresh before answering from the old cache
+
+IDS_PER_QUERY = 500;
+# The most job IDs to give to one sacct command, to keep the command line short
+
+#############################################################################
+
+def jobState(state):
+# Converts a SLURM job state to a snakemake status: running, success, or failed
+    if state == "COMPLETED":
+        return "success";
+    elif state in RUNNING_STATUS:
+        return "running";
+    else:
+        return "failed";
+
+#############################################################################
+
+def querySacct(jobids):
+# Gets the state of every job ID in jobids with as few sacct calls as possible. Returns a dict of
+# <job ID> : <state>, or None if sacct failed. Job IDs that sacct doesn't know yet are left out.
+
+    states = {};
+    jobids = sorted(jobids);
+
+    for i in range(0, len(jobids), IDS_PER_QUERY):
+        cmd = ["sacct", "-X", "--parsable2", "--noheader", "--format", "JobID,State", "-j", ",".join(jobids[i:i+IDS_PER_QUERY])];
+        # -X gets only the job allocations, not each step of the job
+
+        for attempt in range(STATUS_ATTEMPTS):
+            try:
+                output = subprocess.check_output(cmd, universal_newlines=True, stderr=subprocess.DEVNULL);
+                break;
+            except (OSError, subprocess.CalledProcessError):
+                if attempt == STATUS_ATTEMPTS - 1:
+                    return None;
+                time.sleep(2 ** attempt);
+        # Try the query a few times
+
+        for line in output.splitlines():
+            line = line.strip().split("|");
+            if len(line) < 2 or not line[1]:
+                continue;
+            states[line[0]] = line[1].split()[0];
+        # States like "CANCELLED by 1234" have extra words
+    ## End query loop
+
+    return states;
+
+#############################################################################
+
+def readCache(cache_file):
+# Reads the cache of job states: { 'updated' : <time of last query>, 'answered' : <time of last query that worked>,
+# 'jobs' : { <job ID> : <state> }, 'first-seen' : { <job ID> : <time of its first status check> } }
+# Job IDs that haven't been found by sacct yet have a state of None
+    cache = { 'updated' : 0, 'answered' : 0, 'jobs' : {}, 'first-seen' : {} };
+    try:
+        with open(cache_file) as cachefile:
+            prev_cache = json.load(cachefile);
+        if isinstance(prev_cache, dict) and 'jobs' in prev_cache:
+            cache.update(prev_cache);
+    except (OSError, ValueError):
+        pass;
+    return cache;
+
+#############################################################################
+
+def writeCache(cache, cache_file):
+# Writes the cache to a temporary file first so a reader never sees a partial file
+    tmp_file = cache_file + ".tmp";
+    with open(tmp_file, "w") as cachefile:
+        json.dump(cache, cachefile);
+    os.replace(tmp_file, cache_file);
+
+#############################################################################
+
+def getStatus(jobid, cache_file, interval, missing_after):
+# Gets the status of one job from the cache, refreshing the states of all unfinished jobs with one
+# query if the cache is older than the interval in seconds
+
+    with open(cache_file + ".lock", "w") as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX);
+        # Wait for any other status check that is querying sacct
+
+        cache = readCache(cache_file);
+
+        if jobid not in cache['jobs']:
+            cache['jobs'][jobid] = None;
+        if jobid not in cache['first-seen']:
+            cache['first-seen'][jobid] = time.time();
+        # Add new jobs to the list of jobs to check
+
+        if time.time() - cache['updated'] >= interval:
+            unfinished = [ cur_id for cur_id, state in cache['jobs'].items() if state is None or jobState(state) == "running" ];
+            states = querySacct(unfinished);
+            if states is not None:
+                cache['jobs'].update(states);
+                cache['answered'] = time.time();
+            cache['updated'] = time.time();
+            writeCache(cache, cache_file);
+        # Only jobs that haven't finished need to be checked again. The time of the query is saved even if sacct
+        # failed so the other status checks wait for the next interval instead of each trying sacct again
+
+        elif cache['jobs'][jobid] is None:
+            writeCache(cache, cache_file);
+        # Save the new job so it is checked on the next refresh
+
+    state = cache['jobs'][jobid];
+    if state is None:
+        if cache['answered'] - cache['first-seen'][jobid] >= missing_after:
+            return "failed";
+        return "running";
+    # Jobs that were just submitted may not be in sacct until the next refresh. A job that sacct still doesn't list
+    # long after it was first checked was lost, but only while sacct is answering, so an outage doesn't fail every job
+
+    return jobState(state);
+
+#############################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Snakemake cluster status script for SLURM with a shared cache of sacct results.");
+    parser.add_argument("--interval", dest="interval", help="The least number of seconds between sacct queries. Default: 30", type=float, default=30);
+    parser.add_argument("--missing", dest="missing_after", help="The number of seconds after a job is first checked that it is reported as failed if sacct still doesn't list it. Default: 10 times the interval", type=float, default=False);
+    parser.add_argument("--cache", dest="cache_file", help="The file to store job states in. Default: slurm-status-cache.json in the same directory as this script.", default=False);
+    parser.add_argument("jobid", nargs="+", help="The SLURM job ID. If more than one word is given, the last is used.");
+    args = parser.parse_args();
+
+    if not args.cache_file:
+        args.cache_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "slurm-status-cache.json");
+
+    jobid = args.jobid[-1];
+    # SLURM job id as input parameter. Without --parsable, sbatch prints "Submitted batch job <id>", which snakemake
+    # passes on as the job id.
+
+    if args.missing_after is False:
+        args.missing_after = 10 * args.interval;
+
+    print(getStatus(jobid, args.cache_file, args.interval, args.missing_after));
@@ -0,0 +1,209 @@
+#############################################################################
+# Functions to store the parsed alignments once in a memory-mapped file so
+# that the worker pools only need to be sent locus indices instead of
+# pickling every alignment, the quartets, and the tree for every locus
+#############################################################################
+
+import os
+import mmap
+import atexit
+import pickle
+import tempfile
+import phyloacc_lib.profiling as PROFILE
+
+#############################################################################
+
+_opened = {};
+# A cache of the contexts and stores each process has already opened:
+# <context file> : <context dict>
+# <data file> : <mmap of the data file>
+
+#############################################################################
+
+def removeFile(filename):
+# Removes a temporary store file at exit, if it is still there
+    if os.path.isfile(filename):
+        os.remove(filename);
+
+#############################################################################
+
+def tempFile(globs, suffix):
+# Creates a temporary file in the output directory that is removed when the interface exits
+    fd, filename = tempfile.mkstemp(prefix=".phyloacc-store-", suffix=suffix, dir=globs['outdir']);
+    os.close(fd);
+    atexit.register(removeFile, filename);
+    return filename;
+
+#############################################################################
+
+def writeStore(globs):
+# Writes every alignment in globs['alns'] to a single data file and returns a compact index
+# to find each locus in it. Sequences of a locus are written one after the other, so the
+# locus can be read back from its offset, its length, and the stride between sequences.
+
+    if hasattr(globs['alns'], "storeIndex"):
+        store = globs['alns'].storeIndex();
+        if store:
+            return store;
+    # Alignments that are already in an indexed data file (seq.LazyAlns with -a input) can be read from there directly
+
+    store = { 'data-file' : tempFile(globs, ".bin"), 'loci' : [], 'specs' : [], 'locus-specs' : [],
+                'offsets' : [], 'lengths' : [], 'strides' : [], 'ragged' : {} };
+    # The store index:
+    # loci, locus-specs, offsets, lengths, strides: one entry per locus, in the order of globs['alns']
+    # specs: the unique orders of sequence IDs, indexed by locus-specs
+    # ragged: alignments that can't be read back by stride (e.g. unequal lengths) kept as is
+
+    spec_orders = {};
+    # A lookup for the index of each order of sequence IDs in store['specs']
+
+    offset = 0;
+    with open(store['data-file'], "wb") as datafile:
+        for locus in globs['alns']:
+            aln = globs['alns'][locus];
+            specs = tuple(aln.keys());
+            seqs = [ aln[spec].encode() for spec in specs ];
+            aln_len = len(seqs[0]) if seqs else 0;
+
+            if specs not in spec_orders:
+                spec_orders[specs] = len(store['specs']);
+                store['specs'].append(specs);
+            # Add the sequence IDs of the current locus if this order hasn't been seen yet
+
+            store['loci'].append(locus);
+            store['locus-specs'].append(spec_orders[specs]);
+            store['offsets'].append(offset);
+            store['lengths'].append(aln_len);
+            store['strides'].append(aln_len);
+
+            if any(len(seq) != aln_len for seq in seqs) or any(len(seq) != len(aln[spec]) for seq, spec in zip(seqs, specs)):
+                store['ragged'][len(store['loci']) - 1] = aln;
+                continue;
+            # Alignments with sequences of different lengths or multi-byte characters are kept in the index as is
+
+            for seq in seqs:
+                datafile.write(seq);
+            offset += aln_len * len(seqs);
+            # Write the sequences of the current locus
+        ## End locus loop
+
+    return store;
+
+#############################################################################
+
+def writeContext(globs, args):
+# Writes the store index and any other data the workers need for the current pool pass
+# (e.g. the quartets and tree) to a file once. Returns the file name to send with every task.
+
+    if not globs['aln-store']:
+        globs['aln-store'] = writeStore(globs);
+    # Only write the alignments once per run
+
+    context_file = tempFile(globs, ".pickle");
+    with open(context_file, "wb") as contextfile:
+        pickle.dump({ 'store' : globs['aln-store'], 'args' : args }, contextfile, protocol=pickle.HIGHEST_PROTOCOL);
+
+    return context_file;
+
+#############################################################################
+
+def getContext(context_file):
+# Loads a context file once per process
+
+    if context_file not in _opened:
+        with open(context_file, "rb") as contextfile:
+            _opened[context_file] = pickle.load(contextfile);
+
+    return _opened[context_file];
+
+#############################################################################
+
+def getData(data_file):
+# Memory-maps the data file of a store once per process
+
+    if data_file not in _opened:
+        with open(data_file, "rb") as datafile:
+            if os.fstat(datafile.fileno()).st_size == 0:
+                _opened[data_file] = b"";
+            else:
+                _opened[data_file] = mmap.mmap(datafile.fileno(), 0, access=mmap.ACCESS_READ);
+        # The mmap stays valid after the file is closed
+
+    return _opened[data_file];
+
+#############################################################################
+
+def getAln(store, locus_index):
+# Reads one alignment from the store as a dict: <sequence id> : <sequence>
+
+    if locus_index in store['ragged']:
+        return store['loci'][locus_index], store['ragged'][locus_index];
+
+    data = getData(store['data-file']);
+    offset, aln_len, stride = store['offsets'][locus_index], store['lengths'][locus_index], store['strides'][locus_index];
+    specs = store['specs'][store['locus-specs'][locus_index]];
+
+    aln = {};
+    for i, spec in enumerate(specs):
+        start = offset + i * stride;
+        aln[spec] = data[start:start+aln_len].decode();
+    # Get every sequence at the stride for the current locus
+
+    return store['loci'][locus_index], aln;
+
+#############################################################################
+
+def getRawSeqs(store, locus_index):
+# Reads one alignment from the store as a list of (<sequence id>, <encoded sequence>) without decoding the
+# sequences, for when only their bytes are needed (e.g. cache keys). The sequences are the same bytes as
+# getAln(...)[spec].encode()
+
+    if locus_index in store['ragged']:
+        aln = store['ragged'][locus_index];
+        return store['loci'][locus_index], [ (spec, aln[spec].encode()) for spec in aln ];
+
+    data = getData(store['data-file']);
+    offset, aln_len, stride = store['offsets'][locus_index], store['lengths'][locus_index], store['strides'][locus_index];
+    specs = store['specs'][store['locus-specs'][locus_index]];
+
+    view = memoryview(data) if data else b"";
+    return store['loci'][locus_index], [ (spec, view[offset+i*stride:offset+i*stride+aln_len]) for i, spec in enumerate(specs) ];
+    # Slices of a memoryview of the mmap so the sequences aren't copied
+
+#############################################################################
+
+def numLoci(globs):
+# The number of loci in the store
+    return len(globs['aln-store']['loci']);
+
+#############################################################################
+
+def locusTask(task):
+# The function run by the pools: reads the locus from the store and calls the per-locus function
+# with the same item it would get if the alignment was sent directly: (locus, aln, <args>)
+# The call is profiled with --profile
+    func, context_file, locus_index = task;
+
+    context = getContext(context_file);
+    locus, aln = getAln(context['store'], locus_index);
+
+    return PROFILE.workerCall(func, (locus, aln) + context['args']);
+
+#############################################################################
+
+def tasks(globs, func, context_file, locus_indices=False):
+# A generator of the tasks sent to the pools: only the function, the context file, and a locus index
+# All loci are sent unless a list of locus_indices is given
+    if locus_indices is False:
+        locus_indices = range(numLoci(globs));
+    for locus_index in locus_indices:
+        yield (func, context_file, locus_index);
+
+#############################################################################
+
+def chunkSize(globs):
+# Send tasks to the pools in chunks to cut down on round trips, but keep enough chunks
+# per process to balance the load and keep status updates flowing
+    return max(1, min(100, numLoci(globs) // (globs['num-procs'] * 4)));
+
+#############################################################################
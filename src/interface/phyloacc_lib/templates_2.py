@@ -34,6 +34,7 @@ def snakemake():
 #############################################################################
 
 import os 
+import math
 
 #############################################################################
 
@@ -44,11 +45,21 @@ INDIR = config["input_directory"];
 OUTDIR = config["output_directory"];
 ST_BATCHES = config["st_batch_list"];
 GT_BATCHES = config["gt_batch_list"];
+BATCH_RESOURCES = config["batch_resources"];
+RETRY_SCALE = config["retry_scale"];
 # Inputs for the snakemake pipeline are read from the config file generated by
 # the interface
 
 #############################################################################
 
+def batchResource(batch, resource, attempt):
+    return int(math.ceil(BATCH_RESOURCES[str(batch)][resource] * RETRY_SCALE ** (attempt - 1)));
+# The memory (MB) or time (minutes) for a batch from the resource table in the
+# config file. Each time a batch is retried (restart-times in the profile) it is
+# given more resources in case it failed from hitting its limits
+
+#############################################################################
+
 iqtree_loci = [];
 {run_char}iqtree_loci = [ f.replace(".fa", "") for f in os.listdir(os.path.join(IQTREEDIR, "alns")) if f.endswith(".fa") ];
 
@@ -117,6 +128,11 @@ rule run_phyloacc:
         os.path.join(OUTDIR, "{{st_batch}}-phyloacc-st-out", "{{st_batch}}_elem_lik.txt")
     log:
         os.path.join(OUTDIR, "{{st_batch}}-phyloacc-st-out", "{{st_batch}}-phyloacc.log")
+    benchmark:
+        os.path.join(OUTDIR, "{{st_batch}}-phyloacc-st-out", "{{st_batch}}-benchmark.txt")
+    resources:
+        mem=lambda wildcards, attempt: batchResource(wildcards.st_batch, "mem", attempt),
+        time=lambda wildcards, attempt: batchResource(wildcards.st_batch, "time", attempt)
     shell:
         \"\"\"
         {st_path} {{input}} &> {{log}}
@@ -131,13 +147,19 @@ rule run_phyloacc_gt:
         os.path.join(OUTDIR, "{{gt_batch}}-phyloacc-gt-out", "{{gt_batch}}_elem_lik.txt")
     log:
         os.path.join(OUTDIR, "{{gt_batch}}-phyloacc-gt-out", "{{gt_batch}}-phyloacc.log")
+    benchmark:
+        os.path.join(OUTDIR, "{{gt_batch}}-phyloacc-gt-out", "{{gt_batch}}-benchmark.txt")
+    resources:
+        mem=lambda wildcards, attempt: batchResource(wildcards.gt_batch, "mem", attempt),
+        time=lambda wildcards, attempt: batchResource(wildcards.gt_batch, "time", attempt)
     shell:
         \"\"\"
         {gt_path} {{input.config}} &> {{log}}
         \"\"\"
 
 # This rule runs phyloacc on each batch individually. With a cluster profile
-# each batch will be submitted as a job.
+# each batch will be submitted as a job. The benchmark files record the runtime
+# and memory of each batch for the runtime model fit by phyloacc_post.py
 
 #############################################################################
 """
@@ -154,6 +176,9 @@ st_batch_list: {st_batches}
 gt_batch_list: {gt_batches}
 iqtree_directory: {iqtree}
 astral_directory: {astral}
+retry_scale: {retry_scale}
+batch_resources:
+{batch_resources}
 """
 
     return config_template;
@@ -180,6 +205,7 @@ default-resources:
   - mem='{mem}g'
   - time='{time}'
   - cpus={procs_per_job}
+restart-times: {restart_times}
 latency-wait: 30
 verbose: true
 """
@@ -188,6 +214,53 @@ verbose: true
 
 #############################################################################
 
+def arrayJob():
+
+    array_template = """#!/bin/bash
+#############################################################################
+# SLURM array job to run PhyloAcc on the {model_type} batches, one task per batch
+# Generated from: {cmd}
+# On: {dt}
+# Submit with slurm_array.py, which sets the array indices, memory, and time and
+# gives each array the file with its list of batches
+#############################################################################
+
+#SBATCH --job-name=phyloacc-{model_type}
+#SBATCH --partition={part}
+#SBATCH --nodes={num_nodes}
+#SBATCH --cpus-per-task={procs_per_job}
+#SBATCH --output={cluster_logdir}/run_phyloacc_{model_type}/run_phyloacc_{model_type}-%A_%a.out
+
+batch=$(sed -n "$((SLURM_ARRAY_TASK_ID+1))p" $1)
+if [ -z "$batch" ]; then
+    echo "No batch for task $SLURM_ARRAY_TASK_ID in $1"
+    exit 1
+fi
+# Task i runs the batch on line i+1 of the list of batches given by slurm_array.py
+outdir={outdir}/${{batch}}-phyloacc-{model_type}-out
+mkdir -p $outdir
+
+start=$(date +%s.%N)
+{phyloacc_path} {indir}/${{batch}}-{model_type}.cfg &> $outdir/${{batch}}-phyloacc.log
+status=$?
+end=$(date +%s.%N)
+# Run PhyloAcc on the batch with the same config and log files as the snakemake rules
+
+secs=$(awk "BEGIN {{ printf \\"%.4f\\", $end - $start }}")
+printf "s\\th:m:s\\tmax_rss\\n%s\\t%s\\t-\\n" $secs $(date -u -d @${{secs%.*}} +%H:%M:%S) > $outdir/${{batch}}-benchmark.txt
+# A benchmark file in the same format as snakemake for the runtime model fit by phyloacc_post.py
+
+if [ $status -eq 0 ] && [ ! -f $outdir/${{batch}}_elem_lik.txt ]; then
+    status=1
+fi
+exit $status
+# The task fails if PhyloAcc didn't write its output so it can be resubmitted
+"""
+
+    return array_template;
+
+#############################################################################
+
 def htmlSummary():
 
     html_template = """
@@ -313,7 +386,7 @@ def htmlSummary():
                     <div class="sub-header">Run batches</div>
 
                     <p>
-                        The generated batches can be run with Snakemake with the following command:
+                        The generated batches can be run {run_with} with the following command:
                     </p>
 
                     <div class="code-focus">
@@ -323,11 +396,7 @@ def htmlSummary():
                     </div>
 
                     <p>
-                        Note that this includes the <code>--dryrun</code> option to check for possible errors before submitting jobs. If everything looks good
-                        after running that, feel free to remove the <code>--dryrun</code> option to submit the jobs to your cluster. You may also want to run
-                        this in the background using <a href="https://linuxize.com/post/how-to-use-linux-screen/" target="_blank">screen</a>, 
-                        <a href="https://linuxize.com/post/getting-started-with-tmux/" target="_blank">tmux</a> or some other terminal multiplexer 
-                        to avoid disruptions due to server disconnects.
+                        {run_note}
                     </p>
 
                     <div class="line"></div>
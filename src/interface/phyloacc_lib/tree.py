@@ -7,8 +7,11 @@ import os
 import re
 import math
 import random
-import itertools
 import phyloacc_lib.core as PC
+import phyloacc_lib.seq as SEQ
+import phyloacc_lib.store as STORE
+import phyloacc_lib.cache as CACHE
+import phyloacc_lib.profiling as PROFILE
 import multiprocessing as mp
 from collections import Counter
 
@@ -21,192 +24,87 @@ def treeParse(tree, debug=False):
 # If branch length or node label is not present, they will have "NA" as the value
 # node type can be one of: 'tip', 'internal', 'root'
 # treeParse node label is in the format <N>, with N being a positive integer
+#
+# The tree string is read in a single pass: the text between the delimiters ( ) , is either a tip with its branch
+# length or, right after a ), the label and branch length of the internal node that was just closed. Ancestors are
+# tracked with a stack of the nodes that are still open, so labels are never searched for in the tree string.
 
     tree = tree.strip();
     if tree[-1] != ";":
         tree += ";";
     # Some string handling to remove any extra lines in the tree string and add the semi-colon if not present
 
-    nodes, bl, supports, ancs = {}, {}, {}, {};
-    # Initialization of all the tracker dicts
-
-    topology = remBranchLength(tree);
+    tips, internals = {}, {};
+    # The info for the tips in the order they appear and for the internal nodes in the order they are closed:
+    # <node label> : [ branch length, ancestral node, node type, node label ]
 
-    if debug:
-        print("TOPOLOGY:", topology);
+    topo = [];
+    # The pieces of the labeled topology
 
-    nodes = {};
-    for n in topology.replace("(","").replace(")","").replace(";","").split(","):
-        nodes[n] = 'tip';
-    # nodes = { n : 'tip' for n in topology.replace("(","").replace(")","").replace(";","").split(",") };
-    # Retrieval of the tip labels
+    open_nodes = [[]];
+    # A stack with the list of descendants of each node that hasn't been closed yet
 
-    if debug:
-        print("NODES:", nodes);
-
-    new_tree = "";
-    z = 0;
     numnodes = 1;
-    while z < (len(tree)-1):
-        new_tree += tree[z];
-        if tree[z] == ")":
-            node_label = "<" + str(numnodes) + ">";
-            new_tree += node_label;
-            nodes[node_label] = 'internal';
-            numnodes += 1;
-        z += 1;
-    nodes[node_label] = 'root';
-    rootnode = node_label;
-    # This labels the original tree as new_tree and stores the nodes and their types in the nodes dict
+    # The number of the next internal node to label
 
-    if debug:
-        print("NEW TREE:", new_tree);
-        print("TREE:", tree);
-        print("NODES:", nodes);
-        print("ROOTNODE:", rootnode);
-        #sys.exit();
-    topo = "";
-    z = 0;
-    numnodes = 1;
-    while z < (len(topology)-1):
-        topo += topology[z];
-        if topology[z] == ")":
-            node_label = "<" + str(numnodes) + ">";
-            topo += node_label;
-            numnodes += 1;
-        z += 1;
-    # This labels the topology with the same internal labels
+    z, end = 0, len(tree) - 1;
+    while z < end:
+        char = tree[z];
 
-    if debug:
-        print("TOPO:", topo);
-        print("----------");
-        print("TOPOLOGY:", topo);
-
-    for node in nodes:
-        if node + node in new_tree:
-            new_tree = new_tree.replace(node + node, node);
-
-    for node in nodes:
-    # One loop through the nodes to retrieve all other info
-        if debug == 1:
-            print("NODE:", node);
-
-        if nodes[node] == 'tip':
-            supports[node] = "NA";
-            if node + ":" in tree:
-                cur_bl = re.findall(node + ":[\d.Ee-]+", new_tree);
-                cur_bl = cur_bl[0].replace(node + ":", "");
-                if debug == 1:
-                    print("FOUND BL:", cur_bl);
-                bl[node] = cur_bl;                
-            else:
-                bl[node] = "NA";
-
-        elif nodes[node] == 'internal':
-            if node + node in new_tree:
-                new_tree = new_tree.replace(node + node, node);
-
-            if node + "(" in new_tree or node + "," in new_tree or node + ")" in new_tree:
-                if debug == 1:
-                    print("NO BL OR LABEL");
-                supports[node] = "NA";
-                bl[node] = "NA";
-
-            elif node + ":" in new_tree:
-                supports[node] = "NA";
-                cur_bl = re.findall(node + ":[\d.Ee-]+", new_tree);
-                cur_bl = cur_bl[0].replace(node + ":", "");
-                if debug == 1:
-                    print("FOUND BL:", cur_bl);
-                bl[node] = cur_bl;                                
+        if char in "(,":
+            if char == "(":
+                open_nodes.append([]);
+            topo.append(char);
+            z += 1;
+        # Open a new internal node or move to the next descendant of the current node
 
-            else:
-                cur_bsl = re.findall(node + "[\d\w<>_*+.Ee/-]+:[\d.Ee-]+", new_tree);
-                if cur_bsl:
-                # If the pattern above is found then the node has both support and branch length
-                    cur_bs = cur_bsl[0].replace(node, "");
-                    cur_bs = cur_bs[:cur_bs.index(":")];
-                    cur_bl = cur_bsl[0].replace(node, "").replace(cur_bs, "").replace(":", "");
-                    if debug == 1:
-                        print("FOUND BL AND LABEL:", cur_bl, cur_bs);
-                    supports[node] = cur_bs;
-                    bl[node] = cur_bl;
-                    #new_tree = new_tree.replace(cur_bs, "");
-                else:
-                # If it is not found then the branch only has a label
-                    cur_bs = re.findall(node + "[\w*+.<> -]+", new_tree);
-                    cur_bs = cur_bs[0].replace(node, "");
-                    if debug == 1:
-                        print("FOUND LABEL:", cur_bs);
-                    supports[node] = cur_bs;
-                    bl[node] = "NA";
-                    #new_tree = new_tree.replace(cur_bs, "");
-
-        elif nodes[node] == 'root':
-            bl[node] = "NA";
-            supports[node] = new_tree[new_tree.index(node)+len(node):];
-            ancs[node] = "NA";
-            continue;
+        else:
+            token_end = z + 1 if char == ")" else z;
+            while token_end < end and tree[token_end] not in "(),":
+                token_end += 1;
+            # Find the end of the text for the current node
+
+            if char == ")":
+                node_label = "<" + str(numnodes) + ">";
+                numnodes += 1;
+                # The label for the node being closed
+
+                for desc in open_nodes.pop():
+                    if desc in internals:
+                        internals[desc][1] = node_label;
+                    else:
+                        tips[desc][1] = node_label;
+                open_nodes[-1].append(node_label);
+                # Set this node as the ancestor of all its descendants and add it to the descendants of its own ancestor
+
+                internals[node_label] = parseNodeToken(tree[z+1:token_end], 'internal');
+                topo.append(")" + node_label);
+            # Close the current internal node
 
-        # Next we get the ancestral nodes. If the node is the root this is set to NA.
-        anc_match = re.findall('[(),]' + node, new_tree);
+            else:
+                token = tree[z:token_end];
+                tip_label = token.split(":")[0];
+                tips[tip_label] = parseNodeToken(token, 'tip');
+                open_nodes[-1].append(tip_label);
+                topo.append(tip_label);
+            # Read a tip
 
-        #if nodes[node] == 'internal':
-        #    sys.exit();
-        # anc_match = re.findall(node + '[\d:(),]+', new_tree);
-        anc_match = re.findall(node, topo);
-        if debug:
-            print("ANC MATCH:", anc_match);
+            z = token_end;
+    ## End tree loop
 
-        anc_tree = new_tree[new_tree.index(anc_match[0]):][1:];
-        # Ancestral labels are always to the right of the node label in the text of the tree, so we start our scan from the node label
+    rootnode = node_label;
+    internals[rootnode] = ["NA", "NA", 'root', tree[tree.rindex(")")+1:-1]];
+    # The last node closed is the root. Everything after it is kept as its label
 
-        if debug:
-            print("NODE:", node);
-            print("ANC_MATCH:", anc_match);
-            print("ANC_TREE:", anc_tree);
-            
-        cpar_count = 0;
-        cpar_need = 1;
-
-        for i in range(len(anc_tree)):
-        # We find the ancestral label by finding the ) which matches the nesting of the number of ('s found
-            if anc_tree[i] == "(":
-                cpar_need = cpar_need + 1;
-            if anc_tree[i] == ")" and cpar_need != cpar_count:
-                cpar_count = cpar_count + 1;
-            if anc_tree[i] == ")" and cpar_need == cpar_count:
-                anc_tree = anc_tree[i+1:];
-                ancs[node] = anc_tree[:anc_tree.index(">")+1];
-                break;
-
-        if debug:
-            print("FOUND ANC:", ancs[node]);
-            print("---");
-    nofo = {};
-    for node in nodes:
-        nofo[node] = [bl[node], ancs[node], nodes[node], supports[node]];
-    # Now we just restructure everything to the old format for legacy support
+    nofo = tips;
+    nofo.update(internals);
+    topo = "".join(topo);
+    # Tips come before internal nodes as in the old format for legacy support
 
     if debug:
     # Debugging options to print things out
         print(("\ntree:\n" + tree + "\n"));
-        print(("new_tree:\n" + new_tree + "\n"));
         print(("topology:\n" + topo + "\n"));
-        print("nodes:");
-        print(nodes);
-        print()
-        print("bl:");
-        print(bl);
-        print()
-        print("supports:");
-        print(supports);
-        print()
-        print("ancs:");
-        print(ancs);
-        print()
-        print("-----------------------------------");
-        print()
         print("nofo:");
         print(nofo);
         print()
@@ -215,6 +113,26 @@ def treeParse(tree, debug=False):
 
 #############################################################################
 
+def parseNodeToken(token, node_type):
+# Gets the branch length and label from the text following a node in a tree string, e.g. "a:0.1" for a tip, or "95:0.1",
+# ":0.1", or "95" for an internal node. Returns the info for the node with the ancestor to be filled in later:
+# [ branch length, ancestral node, node type, node label ]
+
+    label, colon, bl = token.partition(":");
+
+    bl = re.match("[\d.Ee-]*", bl).group() if colon else "";
+    if not bl:
+        bl = "NA";
+    # The branch length is the number after the first colon, or NA if there isn't one (e.g. "a:")
+
+    if node_type == 'tip' or not label:
+        label = "NA";
+    # Tips are already identified by their label
+
+    return [bl, "NA", node_type, label];
+
+#############################################################################
+
 def remBranchLength(treestring):
 # Removes branch lengths from a tree.
 
@@ -227,15 +145,20 @@ def remBranchLength(treestring):
 
 def addBranchLength(tree, treedict, no_label=False, keep_tp_label=False):
 # Re-writes the branch lengths onto a topology parsed by treeParse.
-	for node in treedict:
-		if treedict[node][2] == 'root':
-			continue;
+# Each node label in the topology is replaced in a single pass, so labels that are prefixes of other labels (e.g. s1 and s10)
+# are not mixed up.
+	def addNodeInfo(match):
+		node = match.group();
+		if node not in treedict or treedict[node][2] == 'root':
+			return node;
+		node_str = node;
+		if treedict[node][3] != "NA" and not no_label:
+			node_str += "_" + treedict[node][3];
 		if treedict[node][0] != "NA":
-			tree = tree.replace(node, node + ":" + treedict[node][0]);
-			if treedict[node][3] != "NA" and not no_label:
-				tree = tree.replace(node + ":" + treedict[node][0], node + "_" + treedict[node][3] + ":" + treedict[node][0]);
-		elif treedict[node][3] != "NA" and not no_label:
-			tree = tree.replace(node, node + "_" + treedict[node][3]);
+			node_str += ":" + treedict[node][0];
+		return node_str;
+
+	tree = re.sub("[^(),;]+", addNodeInfo, tree);
 
 	if no_label and not keep_tp_label:
 		tree = re.sub("<[\d]+>", "", tree);
@@ -284,8 +207,70 @@ def getClade(c_node, c_treedict):
 
 #############################################################################
 
+def treeIndex(tree_dict, root_node):
+# Compiles the dictionary returned by treeParse into an index of the tree structure so that the descendants and
+# clade of any node can be looked up directly instead of scanning the whole tree dictionary with getDesc and getClade.
+# Built once after the tree is read, in a single post-order traversal:
+# 'desc' : { <node label> : [ <direct descendants, in the same order as getDesc> ] }
+# 'anc' : { <node label> : <ancestral node label, "NA" for the root> }
+# 'postorder' : [ <node labels with every node after its descendants> ]
+# 'tips' : [ <tip labels, in the order of the tree dictionary> ]
+# 'tip-bits' : { <tip label> : <int with a single bit set for this tip> }
+# 'clades' : { <node label> : [ <descendant tips, in the same order as getClade> ] }
+# 'clade-bits' : { <node label> : <int with the bits of all descendant tips set> }
+
+    tree_index = { 'desc' : {}, 'anc' : {}, 'postorder' : [], 'tips' : [], 'tip-bits' : {}, 'clades' : {}, 'clade-bits' : {} };
+
+    for node in tree_dict:
+        tree_index['desc'][node] = [];
+        tree_index['anc'][node] = tree_dict[node][1];
+        if tree_dict[node][2] == 'tip':
+            tree_index['tip-bits'][node] = 1 << len(tree_index['tips']);
+            tree_index['tips'].append(node);
+    # Initialize every node and number the tips
+
+    for node in tree_dict:
+        if tree_dict[node][1] in tree_index['desc']:
+            tree_index['desc'][tree_dict[node][1]].append(node);
+    # Add every node to the descendants of its ancestor, in the order of the tree dictionary like getDesc
+
+    for node in tree_dict:
+        if not tree_index['desc'][node]:
+            tree_index['desc'][node] = [node];
+    # getDesc returns the node itself for nodes without descendants
+
+    stack = [(root_node, False)];
+    while stack:
+        node, visited = stack.pop();
+        if visited or tree_dict[node][2] == 'tip':
+            tree_index['postorder'].append(node);
+            continue;
+
+        stack.append((node, True));
+        for d in reversed(tree_index['desc'][node]):
+            stack.append((d, False));
+    # Post-order traversal from the root without recursion
+
+    for node in tree_index['postorder']:
+        if tree_dict[node][2] == 'tip':
+            tree_index['clades'][node] = [node];
+            tree_index['clade-bits'][node] = tree_index['tip-bits'][node];
+        else:
+            tree_index['clades'][node] = [ tip for d in tree_index['desc'][node] for tip in tree_index['clades'][d] ];
+            tree_index['clade-bits'][node] = 0;
+            for d in tree_index['desc'][node]:
+                tree_index['clade-bits'][node] |= tree_index['clade-bits'][d];
+    # The clade of each node is built from the clades of its descendants, which have already been visited
+
+    return tree_index;
+
+#############################################################################
+
 def sampleQuartets(globs, root_desc):
 
+    tree_index = globs['tree-index'];
+    # The clades of every node, from treeIndex
+
     num_quartets = 100;
     # The number of quartets to sample around each branch
     ## ADD AS INPUT OPTION
@@ -295,8 +280,8 @@ def sampleQuartets(globs, root_desc):
             continue;
         # Cannot calculate sCF for tips, the root, or node descendant from the root
 
-        desc = getDesc(node, globs['tree-dict']);
-        anc_desc = getDesc(globs['tree-dict'][node][1], globs['tree-dict']);
+        desc = tree_index['desc'][node];
+        anc_desc = tree_index['desc'][tree_index['anc'][node]];
         sister_node = [ n for n in anc_desc if n != node ][0];
         # For sCF, we treat the species tree as unrooted, so for each node(*)/branch, the possible clades
         # to sample quartets from are the two clades directly descendant from the node, the clade
@@ -322,13 +307,13 @@ def sampleQuartets(globs, root_desc):
         cur_clades = {};
         # Keeps track of the current clades from each of the 4 relevant branches
 
-        cur_clades['left'] = getClade(desc[0], globs['tree-dict']);
-        cur_clades['right'] = getClade(desc[1], globs['tree-dict']);
-        cur_clades['sister'] = getClade(sister_node, globs['tree-dict']);
+        cur_clades['left'] = tree_index['clades'][desc[0]];
+        cur_clades['right'] = tree_index['clades'][desc[1]];
+        cur_clades['sister'] = tree_index['clades'][sister_node];
         # Gets clades for the left, right, and sister descendants
 
-        all_clade_spec = cur_clades['left'] + cur_clades['right'] + cur_clades['sister'];
-        cur_clades['other'] = [ tip for tip in globs['tree-tips'] if tip not in all_clade_spec ];
+        all_clade_bits = tree_index['clade-bits'][desc[0]] | tree_index['clade-bits'][desc[1]] | tree_index['clade-bits'][sister_node];
+        cur_clades['other'] = [ tip for tip in globs['tree-tips'] if not tree_index['tip-bits'][tip] & all_clade_bits ];
         # All other tips make up the 'other' clade
 
         assert all(len(cur_clades[c]) > 0 for c in cur_clades), \
@@ -339,22 +324,25 @@ def sampleQuartets(globs, root_desc):
             "\tother:  " + len(cur_clades['other']) + "\n"
         # Make sure each clade list has species or throw an error.. this shouldn't happen
 
-        split1_pairs = list(itertools.product(cur_clades['left'], cur_clades['right']));
-        split2_pairs = list(itertools.product(cur_clades['sister'], cur_clades['other']));
-        # Get every possible pair of species from each clade side of the split
-        # i.e. all pairs of left-right species (split1) and all pairs of sister-other species (split2)
-
-        quartets = list(itertools.product(split1_pairs, split2_pairs));
-        # Get all pairs from the pairs of species in split1 and split2 for all possible quartets at this node
-
-        cur_num_quartets = len(quartets);
-        # Count the total number of quartets at this node
+        left, right, sister, other = cur_clades['left'], cur_clades['right'], cur_clades['sister'], cur_clades['other'];
+        num_split1, num_split2 = len(left) * len(right), len(sister) * len(other);
+        cur_num_quartets = num_split1 * num_split2;
+        # Count the total number of quartets at this node: every pair of left-right species (split1) with every pair of
+        # sister-other species (split2)
 
         if cur_num_quartets > num_quartets:
-            random.shuffle(quartets);
-            quartets = quartets[:num_quartets];
+            quartet_nums = random.sample(range(cur_num_quartets), num_quartets);
         # If there are more quartets on the current node than the number to sample, sub-sample here
+        else:
+            quartet_nums = range(cur_num_quartets);
         # Otherwise, use all quartets
+
+        quartets = [];
+        for q in quartet_nums:
+            split1, split2 = divmod(q, num_split2);
+            quartets.append(((left[split1 // len(right)], right[split1 % len(right)]), (sister[split2 // len(other)], other[split2 % len(other)])));
+        # Get the species of each quartet from its number, in the same order as all pairs from the pairs of species in split1 and split2.
+        # This way the pairs and quartets never have to all be listed, which gets very large on big trees
         ## SET A SEED FOR REPRODUCIBILITY
 
         globs['quartets'][node] = quartets;
@@ -486,6 +474,105 @@ def locusSCF(locus_item):
 
 #############################################################################
 
+def locusSCFNumpy(locus_item, aln_mat=None):
+# An array based version of locusSCF that returns the same results. Each sequence in the locus is
+# encoded once as a row of uint8 character codes and the sites of all sampled quartets for a node
+# are compared in bulk instead of building each quartet site as a string. An alignment that has already
+# been encoded with SEQ.encodeAln can be passed as aln_mat.
+    import numpy as np;
+    # Imported here rather than with the module since --labeltree only needs the tree functions
+
+    locus, aln, quartets, tree_dict, skip_chars = locus_item
+    # Unpack the data for the current locus
+
+    specs = list(aln.keys());
+
+    if aln_mat is None:
+        aln_mat = SEQ.encodeAln(aln);
+    if aln_mat is None:
+        return locusSCF(locus_item);
+    # The matrix encoding requires all sequences to be the same length with single byte characters, so
+    # fall back to the site loop in locusSCF for anything else
+
+    skip_mat = np.isin(aln_mat, [ ord(char) for char in skip_chars ]);
+    spec_index = { spec : i for i, spec in enumerate(specs) };
+    # The alignment as a matrix with one row per sequence, a mask of the sites in each sequence to skip,
+    # and a lookup for the row of each sequence
+
+    locus_scf = {};
+    # The dictionary to calculate average sCF across all nodes in the current locus
+    # <locus id> : { <node id> : <scf sum>, <num quartets>, <avg scf> }
+
+    quartet_scores = {};
+    # Dictionary to hold all counts for each quartet sampled
+
+    node_scf = [];
+    # The list of sCFs in this locus
+
+    for node in tree_dict:
+    # Calculate sCF for every eligible node in the tree
+
+        if node not in quartets:
+            continue;
+        # Cannot calculate sCF for tips, the root, or node descendant from the root
+
+        locus_scf[node] = { 'scf-sum' : 0, 'num-quartets' : 0, 'avg-scf' : "NA" };
+        # Initialize the scf dict for the current node
+
+        quartet_scores[node] = {};
+        # Dictionary to hold all counts for each quartet sampled
+
+        quartet_rows = np.array([ [ spec_index[spec] for spec in quartet[0] + quartet[1] ] for quartet in quartets[node] ], dtype=np.intp).reshape(-1, 4);
+        # The matrix rows of the 4 species in every quartet: split1-spec1, split1-spec2, split2-spec1, split2-spec2
+
+        s1a, s1b, s2a, s2b = ( aln_mat[quartet_rows[:,i]] for i in range(4) );
+        # The alleles of each quartet position at every site: one row per quartet, one column per site
+
+        full_sites = ~skip_mat[quartet_rows].any(axis=1);
+        # We only care about sites with full information for the quartet
+
+        split1_match, split2_match = s1a == s1b, s2a == s2b;
+        concordant = split1_match & split2_match & (s1a != s2a);
+        # If the alleles from split1 match and the alleles from split2 match, the site is concordant
+
+        discordant = ((s1a == s2a) & (s1b == s2b) & ~split1_match) | ((s1a == s2b) & (s1b == s2a) & ~split1_match);
+        # The other two patterns where both alleles have a count of 2: ABAB and ABBA
+
+        variable = full_sites & ~(split1_match & split2_match & (s1a == s2a));
+        decisive = full_sites & (concordant | discordant);
+        concordant = full_sites & concordant;
+        # If there is more than one allele, the site is variable, and if all alleles have a count of 2 it is decisive
+
+        variable_counts = np.count_nonzero(variable, axis=1).tolist();
+        decisive_counts = np.count_nonzero(decisive, axis=1).tolist();
+        concordant_counts = np.count_nonzero(concordant, axis=1).tolist();
+        # Count the sites of each type for every quartet
+
+        for q, quartet in enumerate(quartets[node]):
+            quartet_scores[node][quartet] = { 'variable-sites' : variable_counts[q], 'decisive-sites' : decisive_counts[q], 
+                                                'concordant-sites' : concordant_counts[q], 'scf' : "NA" };
+
+            if decisive_counts[q] != 0:
+                quartet_scores[node][quartet]['scf'] = concordant_counts[q] / decisive_counts[q];
+            # Calculate the scf for the current quartet
+        ## End quartet loop
+
+        for quartet in quartet_scores[node]:
+            if quartet_scores[node][quartet]['scf'] != "NA":
+                locus_scf[node]['scf-sum'] += quartet_scores[node][quartet]['scf'];
+                locus_scf[node]['num-quartets'] += 1;
+        # For all the quartets with sCF calculated, sum the sCF for this locus to be averaged later
+
+        if locus_scf[node]['num-quartets'] != 0:
+            locus_scf[node]['avg-scf'] = locus_scf[node]['scf-sum'] / locus_scf[node]['num-quartets'];
+            node_scf.append(locus_scf[node]['scf-sum'] / locus_scf[node]['num-quartets']);
+        # Average all sCF from each quartet for this locus
+    ## End node loop
+
+    return node_scf, locus, quartet_scores;
+
+#############################################################################
+
 def scf(globs):
 # A function to calculate site concordance factors for each input locus
 # sCFs are calculate in two ways:
@@ -494,19 +581,81 @@ def scf(globs):
 # In both cases, a number of quartets (100) are sampled for each branch in each tree and sites are counted
 # and averages are taken across quartets. See: https://doi.org/10.1093/molbev/msaa106
 
-    root_desc = getDesc(globs['root-node'], globs['tree-dict']);
-    # Get the descendants of the root node to exclude them from sCF calculations
-
-    step = "Sampling quartets";
-    step_start_time = PC.report_step(globs, step, False, "In progress...");
-    globs = sampleQuartets(globs, root_desc);
-    step_start_time = PC.report_step(globs, step, step_start_time, "Success");
-    # Sample quartets for all nodes
+    globs, qfile = initSCF(globs);
+    # Sample quartets and initialize the per-node sCF
 
     step = "Calculating per-locus sCF";
     step_start_time = PC.report_step(globs, step, False, "Processed 0 / " + str(globs['num-loci']) + " loci...", full_update=True);
     # Status update
 
+    if globs['stats-engine'] == "numpy":
+        scf_func = locusSCFNumpy;
+    else:
+        scf_func = locusSCF;
+    # Select the array based quartet counts (default) or the pure Python site loop (--pystats)
+
+    context_args = (globs['quartets'], globs['tree-dict'], globs['skip-chars']);
+    context_file = STORE.writeContext(globs, context_args);
+    # Store the quartets and tree once with the alignments so the workers only get locus indices
+
+    with globs['scf-pool'] as pool:
+        counter = 0;
+        # A counter to keep track of how many loci have been completed
+        for result in CACHE.imapCached(globs, pool, scf_func, context_file, context_args):
+            # Loop over every locus in parallel to calculate sCF per node, or load them from the cache (-cache)
+
+            node_scf, locus, quartet_scores = result;
+            # Unpack the current result
+
+            globs = addLocusSCF(globs, locus, locusSCFStats(node_scf, globs['min-scf']), nodeQuartetSums(quartet_scores));
+            # Save the per-locus sCF and add the quartet counts to the per-node sCF
+
+            if qfile:
+                writeQuartetStats(qfile, locus, quartet_scores);
+            # For --qstats, writes the quartet stats to a file for the current locus
+
+            counter += 1;
+            if counter % 100 == 0:
+                cur_scf_time = PC.report_step(globs, step, step_start_time, "Processed " + str(counter) + " / " + str(globs['num-loci']) + " loci...", full_update=True);
+            # A counter and a status update every 100 loci
+        ## End imap locus loop
+
+        PROFILE.closePool(globs, pool);
+        # With --profile, let the workers write their profiles before the pool is terminated
+    ## End pool
+
+    step_start_time = PC.report_step(globs, step, step_start_time, "Success: " + str(globs['st-loci'] ) + " st, " + str(globs['gt-loci'] ) + " gt loci.", full_update=True);
+    CACHE.reportHits(globs);
+    # Status update
+
+    globs = averageSCF(globs, qfile);
+    # Average the sCF per node across all loci
+
+    return globs;
+
+#############################################################################
+
+def initSCF(globs):
+# Samples quartets for every node and initializes the per-node sCF before any loci are processed.
+# Returns globs and the open quartet stats file for --qstats (or False)
+
+    root_desc = globs['tree-index']['desc'][globs['root-node']];
+    # Get the descendants of the root node to exclude them from sCF calculations
+
+    step = "Sampling quartets";
+    step_start_time = PC.report_step(globs, step, False, "In progress...");
+    quartet_key = CACHE.hashKey("quartets", [ (node, globs['tree-dict'][node][1], globs['tree-dict'][node][2]) for node in globs['tree-dict'] ]);
+    cached_quartets = CACHE.getQuartets(globs, quartet_key);
+    if cached_quartets:
+        globs['quartets'] = cached_quartets;
+        step_start_time = PC.report_step(globs, step, step_start_time, "Success: loaded from cache");
+    else:
+        globs = sampleQuartets(globs, root_desc);
+        CACHE.putQuartets(globs, quartet_key, globs['quartets']);
+        step_start_time = PC.report_step(globs, step, step_start_time, "Success");
+    # Sample quartets for all nodes. With -cache, the quartets sampled for the same tree topology in an earlier run
+    # are reused so that the cached sCF for each locus is still valid
+
     for node in globs['tree-dict']:
         if node in globs['tree-tips'] or node in root_desc or node == globs['root-node']:
             continue;
@@ -516,88 +665,198 @@ def scf(globs):
                                     'total-quartets' : 0, 'avg-quartet-scf' : "NA" };
         # Initialize the dictionary to calculate average sCF per node across all loci
 
+    qfile = False;
     if globs['qstats']:
         qstats_file = os.path.join(globs['outdir'], "quartet-stats.csv");
         qfile = open(qstats_file, "w");
-        headers = ["locus","node","quartet","variable-sites","decisive-sites","concordant-sites"];
-        qfile.write(",".join(headers) + "\n");
+        qfile.write(",".join(QSTATS_HEADERS) + "\n");
     # For --qstats, creates and opens a file to write site counts for each quartet within the pool loop
 
-    with globs['scf-pool'] as pool:
+    return globs, qfile;
+
+#############################################################################
+
+QSTATS_HEADERS = ["locus","node","quartet","variable-sites","decisive-sites","concordant-sites"];
+# The columns of the --qstats file
+
+#############################################################################
+
+def locusSCFStats(node_scf, min_scf):
+# Summarizes the sCF of every node in one locus for the alignment stats, and decides which model
+# the locus would be run with in adaptive mode. Loci with more than 1/3 of nodes with low sCF go
+# to the gene tree model and all others to the species tree model.
+
+    scf_stats = { 'node-scf-sum' : sum([ n for n in node_scf ]), 'num-nodes' : len(node_scf), 'node-scf-avg' : "NA",
+                    'perc-low-scf-nodes' : "NA", 'low-scf-nodes' : len([ n for n in node_scf if n < min_scf ]) };
+    if scf_stats['num-nodes'] != 0:
+        scf_stats['node-scf-avg'] = scf_stats['node-scf-sum'] / scf_stats['num-nodes'];
+        scf_stats['perc-low-scf-nodes'] = scf_stats['low-scf-nodes'] / scf_stats['num-nodes'];
+    # Average sCF per locus stored with the other alignment stats
+
+    if scf_stats['low-scf-nodes'] > math.floor(scf_stats['num-nodes'] / 3):
+        batch_type = "gt";
+    else:
+        batch_type = "st";
+    # Partition the sequences based on scf
+
+    return scf_stats, batch_type;
+
+#############################################################################
+
+def nodeQuartetSums(quartet_scores):
+# Sums the site counts and sCF over all quartets in one locus for every node, so only these sums
+# need to be added to the per-node sCF across all loci
+
+    node_sums = {};
+    for node in quartet_scores:
+        node_sums[node] = { 'variable-sites' : 0, 'decisive-sites' : 0, 'concordant-sites' : 0, 'quartet-scf-sum' : 0, 'total-quartets' : 0 };
+        for q in quartet_scores[node]:
+            node_sums[node]['variable-sites'] += quartet_scores[node][q]['variable-sites'];
+            node_sums[node]['decisive-sites'] += quartet_scores[node][q]['decisive-sites'];
+            node_sums[node]['concordant-sites'] += quartet_scores[node][q]['concordant-sites'];
+            # Sum sites for this quartet for this node
+
+            if quartet_scores[node][q]['decisive-sites'] != 0:
+                node_sums[node]['quartet-scf-sum'] += quartet_scores[node][q]['concordant-sites'] / quartet_scores[node][q]['decisive-sites'];
+                node_sums[node]['total-quartets'] += 1;
+            # If there are decisive sites, calculate sCF for this quartet
+
+    return node_sums;
+
+#############################################################################
+
+def addLocusSCF(globs, locus, locus_scf_stats, node_sums):
+# Saves the per-locus sCF from locusSCFStats with the alignment stats and adds the quartet sums
+# from nodeQuartetSums to the per-node sCF
+
+    scf_stats, batch_type = locus_scf_stats;
+    globs['aln-stats'][locus].update(scf_stats);
+    # Average sCF per locus stored with the other alignment stats
+
+    if globs['run-mode'] == 'adaptive':
+        globs['aln-stats'][locus]['batch-type'] = batch_type;
+        if batch_type == "gt":
+            globs['gt-loci'] += 1;
+        else:
+            globs['st-loci'] += 1;
+    elif globs['run-mode'] == 'st':
+        globs['st-loci'] += 1;
+    elif globs['run-mode'] == 'gt':
+        globs['gt-loci'] += 1;
+    # If the run mode is adaptive, partition loci with more than 1/3 of nodes with low sCF to the gene tree model and all others
+    # to the species tree model
+
+    for node in node_sums:
+        for col in node_sums[node]:
+            globs['scf'][node][col] += node_sums[node][col];
+    # For every node, add the sums across quartets in this locus in order to average across nodes later
+
+    return globs;
+
+#############################################################################
+
+def writeQuartetStats(qfile, locus, quartet_scores):
+# For --qstats, writes the site counts of every quartet in one locus
+
+    for node in quartet_scores:
+        for q in quartet_scores[node]:
+            q_str = ";".join(q[0]) + ";" + ";".join(q[1]);
+            outline = [locus, node, q_str] + [str(quartet_scores[node][q][col]) for col in QSTATS_HEADERS[3:]];
+            qfile.write(",".join(outline) + "\n");
+
+#############################################################################
+
+def averageSCF(globs, qfile):
+# Averages the sCF per node across all loci once every locus has been added
+
+    step = "Averaging sCF per node";
+    step_start_time = PC.report_step(globs, step, False, "In progress...");
+    for node in globs['scf']:
+        globs['scf'][node]['avg-quartet-scf'] = globs['scf'][node]['quartet-scf-sum'] / globs['scf'][node]['total-quartets'];
+    step_start_time = PC.report_step(globs, step, step_start_time, "Success");
+    # For every node, average the sCFs per quartet across all loci
+
+    if qfile:
+        qfile.close()
+    # For --qstats, closes the quartet stats file.
+
+    return globs;
+
+#############################################################################
+
+def locusStatsSCF(locus_item):
+# The fused per-locus worker for adaptive mode: calculates the alignment stats, the quartet counts for sCF, and
+# the batch type for one locus in a single task. With the numpy engine the alignment is only encoded once for
+# both. Only the stats and the per-node quartet sums are sent back, plus the full quartet counts for --qstats.
+    locus, aln, skip_chars, quartets, tree_dict, min_scf, stats_engine, qstats = locus_item;
+    # Unpack the data for the current locus
+
+    if stats_engine == "numpy":
+        aln_mat = SEQ.encodeAln(aln);
+        stats = SEQ.locusAlnStatsNumpy((locus, aln, skip_chars), aln_mat)[1];
+        node_scf, locus, quartet_scores = locusSCFNumpy((locus, aln, quartets, tree_dict, skip_chars), aln_mat);
+    else:
+        stats = SEQ.locusAlnStats((locus, aln, skip_chars))[1];
+        node_scf, locus, quartet_scores = locusSCF((locus, aln, quartets, tree_dict, skip_chars));
+    # Calculate the stats and sCF with the selected engine
+
+    return locus, stats, locusSCFStats(node_scf, min_scf), nodeQuartetSums(quartet_scores), quartet_scores if qstats else False;
+
+#############################################################################
+
+def statsSCF(globs):
+# Calculates the alignment stats and sCF for adaptive mode in a single pass over the loci, instead of one
+# pool pass in SEQ.alnStats followed by another in scf. Results are the same as running both.
+
+    globs, qfile = initSCF(globs);
+    # Sample quartets and initialize the per-node sCF, which the workers need up front
+
+    step = "Calculating alignment stats and sCF";
+    step_start_time = PC.report_step(globs, step, False, "Processed 0 / " + str(globs['num-loci']) + " loci...", full_update=True);
+    # Status update
+
+    context_args = (globs['skip-chars'], globs['quartets'], globs['tree-dict'], globs['min-scf'], globs['stats-engine'], globs['qstats']);
+    context_file = STORE.writeContext(globs, context_args);
+    # Store the alignments, quartets, and tree once so the workers only get locus indices
+
+    with globs['aln-pool'] as pool:
         counter = 0;
         # A counter to keep track of how many loci have been completed
-        for result in pool.imap_unordered(locusSCF, ((locus, globs['alns'][locus], globs['quartets'], globs['tree-dict'], globs['skip-chars']) for locus in globs['alns'])):
-            # Loop over every locus in parallel to calculate sCF per node
+        for result in CACHE.imapCached(globs, pool, locusStatsSCF, context_file, context_args):
+            # Loop over every locus in parallel to calculate stats and sCF, or load them from the cache (-cache)
 
-            node_scf, locus, quartet_scores = result;
+            locus, stats, locus_scf_stats, node_sums, quartet_scores = result;
             # Unpack the current result
 
-            globs['aln-stats'][locus]['node-scf-sum'] = sum([ n for n in node_scf ]);
-            globs['aln-stats'][locus]['num-nodes'] = len(node_scf);
-            globs['aln-stats'][locus]['node-scf-avg'] = "NA";
-            globs['aln-stats'][locus]['perc-low-scf-nodes'] = "NA";            
-            globs['aln-stats'][locus]['low-scf-nodes'] = len([ n for n in node_scf if n < globs['min-scf'] ]);
-            if globs['aln-stats'][locus]['num-nodes'] != 0:
-                globs['aln-stats'][locus]['node-scf-avg'] = globs['aln-stats'][locus]['node-scf-sum'] / globs['aln-stats'][locus]['num-nodes'];
-                globs['aln-stats'][locus]['perc-low-scf-nodes'] = globs['aln-stats'][locus]['low-scf-nodes'] / globs['aln-stats'][locus]['num-nodes'];
-            # Average sCF per locus stored with the other alignment stats
-
-            if globs['run-mode'] == 'adaptive':
-                if globs['aln-stats'][locus]['low-scf-nodes'] > math.floor(globs['aln-stats'][locus]['num-nodes'] / 3):
-                    globs['aln-stats'][locus]['batch-type'] = "gt";
-                    globs['gt-loci'] += 1;
-                else:
-                    globs['aln-stats'][locus]['batch-type'] = "st";
-                    globs['st-loci'] += 1;
-            elif globs['run-mode'] == 'st':
-                globs['st-loci'] += 1;
-            elif globs['run-mode'] == 'gt':
-                globs['gt-loci'] += 1;
-            # If the run mode is adaptive, partition loci with more than 1/3 of nodes with low sCF to the gene tree model and all others
-            # to the species tree model
-            ## Partition the sequences based on scf
-
-            for node in quartet_scores:
-                for q in quartet_scores[node]:
-
-                    if globs['qstats']:
-                        q_str = ";".join(q[0]) + ";" + ";".join(q[1]);
-                        outline = [locus, node, q_str] + [str(quartet_scores[node][q][col]) for col in headers[3:]];
-                        qfile.write(",".join(outline) + "\n");
-                    # For --qstats, writes the quartet stats to a file for the current quartet
-
-                    globs['scf'][node]['variable-sites'] += quartet_scores[node][q]['variable-sites'];
-                    globs['scf'][node]['decisive-sites'] += quartet_scores[node][q]['decisive-sites'];
-                    globs['scf'][node]['concordant-sites'] += quartet_scores[node][q]['concordant-sites'];
-                    # Sum sites for this quartet for this node
-
-                    if quartet_scores[node][q]['decisive-sites'] != 0:
-                        globs['scf'][node]['quartet-scf-sum'] += quartet_scores[node][q]['concordant-sites'] / quartet_scores[node][q]['decisive-sites'];
-                        globs['scf'][node]['total-quartets'] += 1;
-                    # If there are decisive sites, calculate sCF for this quartet
-            # For every quartet in every node, calculate sCF and sum up the number of sites in order to average
-            # across nodes later
+            globs = SEQ.addLocusStats(globs, locus, stats);
+            globs = addLocusSCF(globs, locus, locus_scf_stats, node_sums);
+            # Save the alignment stats and sCF for the current locus
+
+            if qfile:
+                writeQuartetStats(qfile, locus, quartet_scores);
+            # For --qstats, writes the quartet stats to a file for the current locus
 
             counter += 1;
             if counter % 100 == 0:
                 cur_scf_time = PC.report_step(globs, step, step_start_time, "Processed " + str(counter) + " / " + str(globs['num-loci']) + " loci...", full_update=True);
             # A counter and a status update every 100 loci
         ## End imap locus loop
+
+        PROFILE.closePool(globs, pool);
+        # With --profile, let the workers write their profiles before the pool is terminated
     ## End pool
 
+    globs = SEQ.summarizeAlnStats(globs);
+    # Summary stats across loci
+
     step_start_time = PC.report_step(globs, step, step_start_time, "Success: " + str(globs['st-loci'] ) + " st, " + str(globs['gt-loci'] ) + " gt loci.", full_update=True);
+    if globs['no-inf-sites-loci']:
+        PC.printWrite(globs['logfilename'], globs['log-v'], "# INFO: " + str(len(globs['no-inf-sites-loci'])) + " loci have 0 informative sites and will be removed from the analysis.");
+    CACHE.reportHits(globs);
     # Status update
-    
-    step = "Averaging sCF per node";
-    step_start_time = PC.report_step(globs, step, False, "In progress...");
-    for node in globs['scf']:
-        globs['scf'][node]['avg-quartet-scf'] = globs['scf'][node]['quartet-scf-sum'] / globs['scf'][node]['total-quartets'];
-    step_start_time = PC.report_step(globs, step, step_start_time, "Success");
-    # For every node, average the sCFs per quartet across all loci
 
-    if globs['qstats']:
-        qfile.close()
-    # For --qstats, closes the quartet stats file.
+    globs = averageSCF(globs, qfile);
+    # Average the sCF per node across all loci
 
     return globs;
     
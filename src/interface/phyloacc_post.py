@@ -12,9 +12,10 @@ import os
 import phyloacc_lib.core as CORE
 import phyloacc_lib.post_params as params
 import phyloacc_lib.post_opt_parse as OP
-import phyloacc_lib.plot as PLOT
-
-from collections import defaultdict
+import phyloacc_lib.runtime as RUNTIME
+import phyloacc_lib.combine as COMBINE
+import phyloacc_lib.result_store as RESULTS
+import multiprocessing as mp
 
 #############################################################################
 
@@ -55,266 +56,198 @@ if __name__ == '__main__':
     step_start_time = CORE.report_step(globs, step, False, "In progress...");
     # Status updated
 
-    file_suffixes = ["_elem_lik.txt", "_M0_elem_Z.txt", "_M1_elem_Z.txt", "_M2_elem_Z.txt", "_rate_postZ_M0.txt", "_rate_postZ_M1.txt", "_rate_postZ_M2.txt"];
-    data_headers = ["elem_lik", "M0_elem_Z", "M1_elem_Z", "M2_elem_Z", "rate_postZ_M0", "rate_postZ_M1", "rate_postZ_M2"];
-    # The files created by the various PhyloAcc runs that we care about have these suffixes
-    # _elem_lik.txt MUST be first to get the locus IDs and associated numbers for each batch
-        
-    outfiles = [];
-    # Combined output files will be created and stored in this list
-
-    for f in file_suffixes:
-        cur_outfile = os.path.join(globs['outdir'], f[1:]);
-        open(cur_outfile, "w").close()
-        outfiles.append(cur_outfile);
-    # Create the combined output file for each suffix and add it to the list
-
-    step_start_time = CORE.report_step(globs, step, step_start_time, "Success: files created");
+    outfiles = [ os.path.join(globs['outdir'], suffix[1:]) for suffix in COMBINE.FILE_SUFFIXES ];
+    # The combined output file for each suffix
+
+    id_key_file = os.path.join(globs['outdir'], "id-key.txt");
+    # The original ID and best model of each locus
+
+    batch_dirs = COMBINE.batchDirs(globs);
+    # The directories within the PhyloAcc job directory, 1 for each batch, sorted by batch number
+
+    manifest, append, manifest_msg = { 'version' : COMBINE.MANIFEST_VERSION, 'batches' : {} }, False, "";
+    if globs['incremental']:
+        prev_manifest = COMBINE.readManifest(globs, outfiles + [id_key_file]);
+        if not prev_manifest:
+            manifest_msg = "# INFO: No previous results found in " + globs['outdir'] + ". Reading all batches.";
+        else:
+            changed = COMBINE.changedBatches(globs, prev_manifest, batch_dirs);
+            if changed:
+                manifest_msg = "# WARNING: " + str(len(changed)) + " batches have changed since they were combined: " + ",".join(changed[:20]) + (",..." if len(changed) > 20 else "") + ". Reading all batches.";
+            else:
+                manifest, append = prev_manifest, True;
+                COMBINE.truncateOutputs(manifest, outfiles + [id_key_file]);
+    # With --incremental, add to the previous results unless any of the batches in them were run again, since their
+    # lines can't be removed from the combined files. Lines written after the manifest are removed first.
+
+    for batch in sorted(manifest['batches'], key=int):
+        globs['complete-batches'].append(batch);
+        globs['complete-batches-' + manifest['batches'][batch]['type']].append(batch);
+    # Batches already in the results are complete
+
+    store = RESULTS.openStore(globs['store-dir'], [ suffix[1:-4] for suffix in COMBINE.FILE_SUFFIXES ], append=append);
+    # The combined results are also written as memory-mappable arrays with one table per output file
+
+    if append:
+        step_start_time = CORE.report_step(globs, step, step_start_time, "Success: " + str(len(batch_dirs)) + " batches found, " + str(len(manifest['batches'])) + " already combined");
+    else:
+        step_start_time = CORE.report_step(globs, step, step_start_time, "Success: " + str(len(batch_dirs)) + " batches found");
     # Status update
 
+    if manifest_msg:
+        CORE.printWrite(globs['logfilename'], globs['log-v'], manifest_msg);
+
     ####################
 
     step = "Combining batch outputs";
-    step_start_time = CORE.report_step(globs, step, False, "In progress...");
-    # Status updated
-
-    batch_dirs = os.listdir(globs['phyloacc-out-dir']);
-    # The directories within the PhyloAcc job directory, 1 for each batch
-
-    id_keys = {};
-    # Most output files only have locus numbers assigned by PhyloAcc. This dict stores the association with the actual
-    # locus ID found in the _elem_lik.txt file
-    # key:value format: <batch> : { <locus number> : <locus id> }
-
-    first_file = True;
-    # The first file flag - must be _elem_lik.txt
-
-    for f in range(len(file_suffixes)):
-    ## Loop through all file types. Not sure if I mentioned this before, but _elem_lik.txt MUST be first
-
-        first_batch = True;
-        # A first batch flag - we only write the headers in the output file during the first batch
-
-        cur_data = data_headers[f];
-        globs['locus-stats'][cur_data] = defaultdict(dict);
-
-        with open(outfiles[f], "a") as outfile:
-        ## Open the current output file
-
-            for batch_dir in batch_dirs:
-            ## Go through every batch for the current file
-
-                if batch_dir.endswith("-st-out"):
-                    batch_type = "st";
-                elif batch_dir.endswith("-gt-out"):
-                    batch_type = "gt";
-
-                batch = batch_dir[0:batch_dir.index("-")];
-                # Parse the batch string (just a number)
-
-                if first_file:
-                    id_keys[batch] = {};
-                # If this is the first file (_elem_lik.txt), initialize the sub-dict in id_keys
 
-                full_batch_dir = os.path.join(globs['phyloacc-out-dir'], batch_dir);
-                cur_batch_file = os.path.join(full_batch_dir, batch + file_suffixes[f]);
-                # Get the full batch directory and current batch file
+    batch_infos = [ (batch, batch_type, os.path.join(globs['phyloacc-out-dir'], batch_dir), os.path.join(globs['interface-run-dir'], "phyloacc-job-files", "bed", batch + "-" + batch_type + ".bed"))
+                        for batch, batch_type, batch_dir in batch_dirs if batch not in manifest['batches'] ];
+    # The files to read for each batch that isn't in the results yet
 
-                if file_suffixes[f] == "_elem_lik.txt":
-                    if not os.path.isfile(cur_batch_file):
-                        globs['incomplete-batches'].append(batch);
-                        globs['incomplete-batches-' + batch_type].append(batch);
-                    else:
-                        globs['complete-batches'].append(batch);
-                        globs['complete-batches-' + batch_type].append(batch);
-                # Check if the file exists for the current batch and if not add to unfinished_batches
-                # and skip
-
-                if batch in globs['incomplete-batches']:
-                    continue;
-
-                first_line = True;
-                # The first line flag - the first line of each file contains the headers
-
-                for line in open(cur_batch_file):
-                ## Loop through every line in the current batch file
-
-                    line = line.strip().split("\t");
-                    # Parse the line into a list
-
-                    if first_line:
-                    ## If this is the first line (headers), we need to do some stuff, or just skip
-
-                        cur_headers = line;
-
-                        if first_file:
-                            cur_headers = cur_headers[1:];
-                        # Get the headers, and if this is the first file (_elem_lik.txt), remove the "No." header
-
-                        cur_headers[0] = "Locus ID";
-                        # Replace the "No." header with the "Locus ID header"
-
-                        if first_batch:
-                            outfile.write("\t".join(cur_headers) + "\n");
-                            # Write out the headers
-
-                        # if first_batch:
-                        # ## If this is also the first batch, we need to write the headers to the output file
-        
-                        #     if first_file:
-                        #         cur_headers = cur_headers[1:];
-                        #     # Get the headers, and if this is the first file (_elem_lik.txt), remove the "No." header
-
-                        #     cur_headers[0] = "Locus ID"
-                        #     # Replace the "No." header with the "Locus ID header"
-
-
-                        # ## End first batch block
-
-                        first_line = False;
-                        continue;
-                        # Skip to the next line
-                    ## End first line block
-
-                    if first_file:
-                        cur_id_key = batch + "-" + line[1];
-                        id_keys[batch][line[0]] = cur_id_key;
-                        globs['locus-stats'][cur_data][cur_id_key] = defaultdict(dict);
-                        line = line[:1] + line[2:];
-                        outline = [cur_id_key] + line[1:];
-                        
-                    # If this is the first file (_elem_lik.txt), save the locus number:locus id in the id_keys dict and
-                    # remove the "No." entry from the line
-                    else:
-                        cur_id_key = id_keys[batch][line[0]];
-                        #print(cur_id_key);
-                        outline = [cur_id_key] + line[1:];
-                    # For all other files, replace the locus number with the locus ID based on the entry in id_keys
+    step_start_time = CORE.report_step(globs, step, False, "Read 0 / " + str(len(batch_infos)) + " batches...", full_update=True);
+    # Status updated
 
-                    #print(batch);
-                    #print(cur_batch_file);
-                    #print(id_keys[batch][line[0]]);
-                    #print(cur_headers);
-                    #print(line);
-
-                    for col in range(len(cur_headers)):
-                        globs['locus-stats'][cur_data][cur_id_key][cur_headers[col]] = line[col];
-
-                    #globs['locus-stats'][id_keys[batch][line[0]]] = { cur_headers[col] : line[col] for col in range(len(cur_headers)) };
-
-                    #print(globs['locus-stats'][id_keys[batch][line[0]]]);
-                    #print("-----------------")
-                    #sys.exit();
-
-                    outfile.write("\t".join(outline) + "\n");
-                    # Write the line to the output file
-                ## End line loop
-
-                first_batch = False;
-                # Switch off the batch flag
-            ## End batch loop
-
-            first_file = False;
-            # Switch off the file flag
-        ## Close batch output file
-    ## End file loop
-
-    step_start_time = CORE.report_step(globs, step, step_start_time, "Success: files combined");
+    chunk_size = max(1, min(16, len(batch_infos) // (globs['num-procs'] * 4)));
+    update_interval = max(1, len(batch_infos) // 20);
+    # Send the batches to the workers a few at a time, and update the status every 5% of batches
+
+    headers_written, num_read, num_new = append and bool(manifest['batches']), 0, 0;
+    # When adding to the previous results, the headers have been written if any batches were combined before
+
+    pool = mp.Pool(processes=globs['num-procs']) if globs['num-procs'] > 1 else False;
+    batch_results = pool.imap(COMBINE.readBatch, batch_infos, chunksize=chunk_size) if pool else map(COMBINE.readBatch, batch_infos);
+    # With more than one process the batches are read in parallel, but imap returns them in order so the combined files
+    # are always the same
+
+    write_mode = "a" if append else "w";
+    with open(id_key_file, write_mode) as idout:
+        outfile_handles = [ open(outfile, write_mode) for outfile in outfiles ];
+
+        for batch, batch_type, result in batch_results:
+        ## Write each batch as it is read
+
+            num_read += 1;
+
+            if result is None:
+                globs['incomplete-batches'].append(batch);
+                globs['incomplete-batches-' + batch_type].append(batch);
+            else:
+                globs['complete-batches'].append(batch);
+                globs['complete-batches-' + batch_type].append(batch);
+
+                for f in range(len(outfile_handles)):
+                    if not headers_written:
+                        outfile_handles[f].write(result['headers'][f]);
+                    outfile_handles[f].write(result['lines'][f]);
+                headers_written = True;
+                # Write the headers from the first finished batch, then the lines of every batch
+
+                idout.write(result['id-key']);
+                RESULTS.addBatch(store, batch, result);
+                manifest['batches'][batch] = { 'type' : batch_type, 'files' : result['files'] };
+                num_new += 1;
+                # Only the locus IDs and the columns needed for the summary are kept, in the results store
+            # Batches without an _elem_lik.txt file are unfinished
+
+            if num_read % update_interval == 0 or num_read == len(batch_infos):
+                CORE.report_step(globs, step, step_start_time, "Read " + str(num_read) + " / " + str(len(batch_infos)) + " batches...", full_update=True);
+        ## End batch loop
+
+        for outfile in outfile_handles:
+            outfile.close();
+    ## Close the ID key file
+
+    if pool:
+        pool.close();
+        pool.join();
+
+    RESULTS.closeStore(store);
+    manifest['sizes'] = COMBINE.outputSizes(outfiles + [id_key_file]);
+    manifest['store-rows'] = store['rows'];
+    COMBINE.writeManifest(globs, manifest);
+    # Write the results store arrays and index, then the list of batches in them with the size of each combined file
+    # and the number of loci in the store, to find anything written after the manifest by an interrupted run
+
+    globs['locus-ids'], globs['locus-liks'] = COMBINE.summaryColumns(RESULTS.loadStore(globs['store-dir']));
+    # The likelihoods and Bayes factors of every locus, one row per locus in the same order as the IDs
+
+    if append:
+        step_start_time = CORE.report_step(globs, step, step_start_time, "Success: " + str(num_new) + " new batches combined", full_update=True);
+    else:
+        step_start_time = CORE.report_step(globs, step, step_start_time, "Success: files combined", full_update=True);
     # Status update
 
-    print();
+    CORE.printWrite(globs['logfilename'], globs['log-v'], "# INFO: Combined results written to the text files in " + globs['outdir'] + " and as NumPy arrays in " + globs['store-dir'] + " (read with phyloacc_lib.result_store.loadStore).");
 
-    print(globs['locus-stats']['elem_lik']['12-0']);
-    print(globs['locus-stats']['elem_lik']['44-0']);
-    #sys.exit();
     if globs['incomplete-batches']:
-        globs['incomplete-batches'] = list(set(globs['incomplete-batches']));
         num_unfinished = str(len(globs['incomplete-batches']));
         CORE.printWrite(globs['logfilename'], globs['log-v'], "# WARNING: " + num_unfinished + " batches are unfinished: " + ",".join(globs['incomplete-batches']));
 
     ####################
 
-    step = "Getting original IDs";
-    step_start_time = CORE.report_step(globs, step, False, "In progress...");
-    # Status updated
-
-    id_key_file = os.path.join(globs['outdir'], "id-key.txt");
-    with open(id_key_file, "w") as idout:
-        for batch_dir in batch_dirs:
-        ## Go through every batch for the current file
-
-            #print(batch_dir);
-
-            batch_dir = batch_dir.split("-");
-
-            if batch_dir[0] in globs['incomplete-batches']:
-                continue;
-
-            batch = batch_dir[0] + "-" + batch_dir[2];
-            # Parse the batch string
-
-            batch_bed_file = os.path.join(globs['interface-run-dir'], "phyloacc-job-files", "bed", batch + ".bed");
-
-            # print(batch);
-            # print(globs['locus-stats']['M0_elem_Z'][batch].keys());
-            # print(globs['locus-stats']['M1_elem_Z'][batch].keys());
-            # print(globs['locus-stats']['M2_elem_Z'][batch].keys());
-
-            for line in open(batch_bed_file):
-                line = line.strip().split("\t");
-                locus_id = batch[0:batch.index("-")] + "-" + line[0];
-
-                #models = ['loglik_Null_W', 'loglik_Acc_W', 'loglik_Full_W'];
-                models = ['loglik_Null', 'loglik_Acc', 'loglik_Full'];
-                marginal_liks = [ float(globs['locus-stats']['elem_lik'][locus_id][model]) for model in models ];
-
-                max_lik = max(marginal_liks);
-                max_lik_ind = marginal_liks.index(max_lik);
-                max_model = models[max_lik_ind];
-                elem_str = "M" + str(max_lik_ind) + "_elem_Z";
-
-                if batch == "44-gt":
-                    print(max_lik, max_lik_ind, max_model, elem_str);
-
-                outline = [ locus_id, line[3], max_model, str(max_lik)] #, globs['locus-stats'][elem_str][locus_id]['genetree'] ];
-                idout.write("\t".join(outline) + "\n");
-
-    step_start_time = CORE.report_step(globs, step, step_start_time, "Success");
-    # Status update
-
-    ####################
-
     step = "Getting batch runtimes";
     step_start_time = CORE.report_step(globs, step, False, "In progress...");
     # Status updated
 
-    for batch_dir in batch_dirs:
+    missing_logs = [];
+    for batch, batch_type, batch_dir in batch_dirs:
     ## Go through every batch for the current file
 
-        batch = batch_dir[0:batch_dir.index("-")];
-        # Parse the batch string (just a number)
-
         if batch in globs['incomplete-batches']:
             continue;
 
-        # print(batch_dir);
-        # print(batch);
-
         batch_logfile = os.path.join(globs['phyloacc-out-dir'], batch_dir, batch + "-phyloacc.log");
         if not os.path.isfile(batch_logfile):
-            print(batch_logfile)
+            missing_logs.append(batch);
+            continue;
+        # Batches without a PhyloAcc log are left out of the runtimes
 
+        cur_minutes = None;
         for line in open(batch_logfile):
             if line.startswith("time used:"):
                 line = list(filter(None, line.strip().split(" ")));
-                globs['batch-runtimes'].append(int(line[2]));
+                cur_minutes = int(line[2]);
+                globs['batch-runtimes'].append(cur_minutes);
+
+        cur_seconds, cur_max_rss = RUNTIME.readBenchmark(os.path.join(globs['phyloacc-out-dir'], batch_dir, batch + "-benchmark.txt"));
+        if cur_seconds is None and cur_minutes is not None:
+            cur_seconds = (cur_minutes + 0.5) * 60;
+        globs['batch-resources'][batch] = (cur_seconds, cur_max_rss);
+        # The runtime and memory from the snakemake benchmark if there is one. Otherwise, the runtime from the PhyloAcc log,
+        # which is rounded down to the minute, so the middle of that minute is used
 
     step_start_time = CORE.report_step(globs, step, step_start_time, "Success");
     # Status update
 
+    if missing_logs:
+        CORE.printWrite(globs['logfilename'], globs['log-v'], "# WARNING: " + str(len(missing_logs)) + " batches have no PhyloAcc log and were left out of the runtimes: " + ",".join(missing_logs[:20]) + (",..." if len(missing_logs) > 20 else ""));
+
+    ####################
+
+    step = "Fitting runtime model";
+    step_start_time = CORE.report_step(globs, step, False, "In progress...");
+    # Status updated
+
+    runtime_model = False;
+    if os.path.isfile(globs['batch-costs-file']):
+        runtime_model = RUNTIME.fitRuntimeModel(globs);
+
+    if runtime_model:
+        RUNTIME.writeRuntimeModel(runtime_model, globs['runtime-model-file']);
+        step_start_time = CORE.report_step(globs, step, step_start_time, "Success: model written");
+        CORE.printWrite(globs['logfilename'], globs['log-v'], "# INFO: Use -runtime-model " + globs['runtime-model-file'] + " with the interface to size batches and jobs for the next run.");
+    else:
+        step_start_time = CORE.report_step(globs, step, step_start_time, "Skipped: no batch runtimes or batch costs found");
+    # Fit a model of the runtime of each batch from the number of sites in it for the next run of the interface. Runs
+    # from before the interface wrote batch costs can't be fit
+
     ####################
 
     if globs['plot']:
+        import phyloacc_lib.plot as PLOT;
+        # matplotlib is only loaded when plotting
+
         globs = PLOT.genPlotsPost(globs);
         globs = PLOT.writeHTMLPost(globs);
 